@@ -0,0 +1,263 @@
+"""
+Genes x samples count matrix built from the per-sample outputs of htseq-count or featureCounts.
+
+The matrix is kept in a directory with one binary column per sample, so samples are added by writing their column
+without reading the other samples again and the memory used does not grow with the number of samples:
+
+-   `genes.txt`: the gene ids in the order of the rows
+-   `samples.txt`: the sample ids in the order of the columns, with the md5 checksum of the counts file each column
+    was read from. The column of a sample is written again when its counts file changes
+-   `columns/<n>.u32`: the counts of column `n` as little endian unsigned 32 bit integers or, for a sparse matrix,
+    the (row, count) pairs of the genes with a non zero count
+-   `matrix.json`: the number of genes and whether the columns are sparse
+
+The TSV is written from the columns `block_size` genes at a time.
+"""
+
+import argparse
+import array
+import hashlib
+import json
+import os
+import sys
+
+
+def read_counts(path, source):
+    """
+    Read the counts of one sample, the summary lines of htseq-count (`__no_feature` etc.) and the header of
+    featureCounts are skipped
+    :param path: the counts file
+    :param source: `htseq` or `featureCounts`
+    :return: iterator of (gene id, count)
+    """
+    f = open(path)
+    for line in f:
+        if source == 'featureCounts' and (line.startswith('#') or line.startswith('Geneid\t')):
+            continue
+        if source == 'htseq' and line.startswith('__'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 2:
+            continue
+        try:
+            count = int(fields[-1])
+        except ValueError:
+            f.close()
+            raise ValueError("%s: count of %s is not an integer: %s" % (path, fields[0], fields[-1]))
+        yield fields[0], count
+    f.close()
+
+
+def file_checksum(path):
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+        md5.update(chunk)
+    f.close()
+    return md5.hexdigest()
+
+
+def new_column():
+    column = array.array('I')
+    if column.itemsize != 4:
+        column = array.array('L')
+    return column
+
+
+class CountMatrix(object):
+    """
+    A count matrix stored as binary columns, see the module documentation for the layout
+    """
+
+    def __init__(self, path, sparse=False):
+        """
+        :param path: directory of the matrix, created when the first sample is added
+        :param sparse: store only the non zero counts, only used for a new matrix
+        """
+        self.path = path
+        self.meta_file = os.path.join(path, 'matrix.json')
+        self.genes_file = os.path.join(path, 'genes.txt')
+        self.samples_file = os.path.join(path, 'samples.txt')
+        self.meta = None
+        self.samples = []
+        self.checksums = []
+        if os.path.exists(self.meta_file):
+            self.meta = json.load(open(self.meta_file))
+            for line in open(self.samples_file):
+                fields = line.rstrip('\n').split('\t')
+                self.samples.append(fields[0])
+                self.checksums.append(fields[1] if len(fields) > 1 else None)
+        self.sparse = sparse if self.meta is None else self.meta['sparse']
+        return
+
+    def column_file(self, idx):
+        return os.path.join(self.path, 'columns', '%d.u32' % idx)
+
+    def write_atomic(self, path, lines):
+        f = open(path + ".tmp", 'w')
+        for line in lines:
+            f.write(line + "\n")
+        f.close()
+        os.rename(path + ".tmp", path)
+        return
+
+    def add_sample(self, sample, counts_file, source):
+        """
+        Add the column of a sample, or write it again if the counts file of a sample already in the matrix has
+        changed. The genes have to be in the same order as in the matrix.
+        :param sample: the sample id
+        :param counts_file: the output of htseq-count or featureCounts for the sample
+        :param source: `htseq` or `featureCounts`
+        :return: False if the sample is already in the matrix with the same counts file
+        """
+        checksum = file_checksum(counts_file)
+        if sample in self.samples:
+            idx = self.samples.index(sample)
+            if self.checksums[idx] == checksum:
+                return False
+        else:
+            idx = len(self.samples)
+        if not os.path.exists(os.path.join(self.path, 'columns')):
+            os.makedirs(os.path.join(self.path, 'columns'))
+
+        genes = None if self.meta is None else open(self.genes_file)
+        new_genes = []
+        column = new_column()
+        rows = new_column()
+        n_rows = 0
+        for gene, count in read_counts(counts_file, source):
+            if genes is None:
+                new_genes.append(gene)
+            else:
+                matrix_gene = genes.readline().rstrip('\n')
+                if matrix_gene != gene:
+                    genes.close()
+                    raise ValueError("%s: gene %d is %s but %s in the matrix" %
+                                     (counts_file, n_rows + 1, gene, matrix_gene or 'missing'))
+            if not self.sparse:
+                column.append(count)
+            elif count != 0:
+                rows.append(n_rows)
+                column.append(count)
+            n_rows += 1
+        if genes is not None:
+            genes.close()
+            if n_rows != self.meta['n_genes']:
+                raise ValueError("%s has %d genes, the matrix has %d" % (counts_file, n_rows, self.meta['n_genes']))
+
+        if self.sparse:
+            # interleave the rows and counts
+            pairs = new_column()
+            for row, count in zip(rows, column):
+                pairs.append(row)
+                pairs.append(count)
+            column = pairs
+        if sys.byteorder == 'big':
+            column.byteswap()
+        f = open(self.column_file(idx) + ".tmp", 'wb')
+        column.tofile(f)
+        f.close()
+        os.rename(self.column_file(idx) + ".tmp", self.column_file(idx))
+
+        if self.meta is None:
+            self.write_atomic(self.genes_file, new_genes)
+            self.meta = {'n_genes': n_rows, 'sparse': self.sparse}
+            f = open(self.meta_file + ".tmp", 'w')
+            json.dump(self.meta, f)
+            f.close()
+            os.rename(self.meta_file + ".tmp", self.meta_file)
+        # The sample is only part of the matrix once it is listed
+        if idx == len(self.samples):
+            self.samples.append(sample)
+            self.checksums.append(checksum)
+        else:
+            self.checksums[idx] = checksum
+        self.write_atomic(self.samples_file, ['\t'.join([x, y or '']) for x, y in zip(self.samples, self.checksums)])
+        return True
+
+    def column_blocks(self, idx, block_size):
+        """
+        Read a column `block_size` counts at a time, the file is only open while a block is read so columns of many
+        samples can be read side by side
+        :return: iterator of arrays of counts
+        """
+        n_genes = self.meta['n_genes']
+        offset = 0
+        pending = None
+        for start in range(0, n_genes, block_size):
+            end = min(start + block_size, n_genes)
+            block = new_column()
+            f = open(self.column_file(idx), 'rb')
+            f.seek(offset)
+            if not self.sparse:
+                block.fromfile(f, end - start)
+                offset = f.tell()
+            else:
+                block.fromlist([0] * (end - start))
+                while True:
+                    if pending is None:
+                        pair = new_column()
+                        try:
+                            pair.fromfile(f, 2)
+                        except EOFError:
+                            break
+                        if sys.byteorder == 'big':
+                            pair.byteswap()
+                        pending = (pair[0], pair[1])
+                        offset = f.tell()
+                    if pending[0] >= end:
+                        break
+                    block[pending[0] - start] = pending[1]
+                    pending = None
+            f.close()
+            if sys.byteorder == 'big' and not self.sparse:
+                block.byteswap()
+            yield block
+
+    def write_tsv(self, out_file, block_size=10000):
+        """
+        Write the matrix as a tab separated file with a row per gene and a column per sample
+        """
+        if self.meta is None:
+            return
+        genes = open(self.genes_file)
+        columns = [self.column_blocks(i, block_size) for i in range(len(self.samples))]
+        f = open(out_file + ".tmp", 'w')
+        f.write('\t'.join(['gene_id'] + self.samples) + "\n")
+        for start in range(0, self.meta['n_genes'], block_size):
+            blocks = [next(x) for x in columns]
+            for i in range(min(block_size, self.meta['n_genes'] - start)):
+                f.write('\t'.join([genes.readline().rstrip('\n')] + [str(x[i]) for x in blocks]) + "\n")
+        f.close()
+        genes.close()
+        os.rename(out_file + ".tmp", out_file)
+        return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the counts of samples from htseq-count or featureCounts to a "
+                                                 "genes x samples count matrix")
+    parser.add_argument('--matrix', required=True, help="directory of the matrix")
+    parser.add_argument('--source', required=True, choices=['htseq', 'featureCounts'])
+    parser.add_argument('--samples', help="file with the sample id and counts file of each sample, tab separated")
+    parser.add_argument('--sparse', action='store_true', help="store only the non zero counts of a new matrix")
+    parser.add_argument('--tsv', help="also write the matrix to this tab separated file")
+    parser.add_argument('counts', nargs='*', help="sample=counts_file")
+    opts = parser.parse_args()
+
+    samples = [x.split('=', 1) for x in opts.counts]
+    if opts.samples is not None:
+        samples += [x.rstrip('\n').split('\t')[:2] for x in open(opts.samples) if x.strip() != '']
+
+    matrix = CountMatrix(opts.matrix, opts.sparse)
+    for sample, counts_file in samples:
+        action = "Updated" if sample in matrix.samples else "Added"
+        if matrix.add_sample(sample, counts_file, opts.source):
+            print "%s %s" % (action, sample)
+    if opts.tsv is not None:
+        matrix.write_tsv(opts.tsv)
+    return
+
+
+if __name__ == '__main__':
+    main()
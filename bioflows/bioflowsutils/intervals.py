@@ -0,0 +1,116 @@
+"""
+Splitting of a reference genome into shards of about the same size, for running GATK steps on each shard in
+parallel and gathering the results afterwards.
+
+The contig lengths are read from the `.fai` index of the reference fasta or, if there is none, from the sequence
+dictionary (`.dict`). Contigs are kept in the order of the reference so the gathered BAMs and VCFs stay sorted.
+
+Steps writing BAMs are split on whole contigs only, like the sequence grouping of the GATK best practices: a read
+overlapping a cut inside a contig would be written by the shards on both sides, so the gathered BAM would have it
+twice and would not be sorted at the cut.
+"""
+
+import os
+
+
+def reference_contigs(ref_fasta):
+    """
+    Read the names and lengths of the contigs of a reference
+    :param ref_fasta: path to the reference fasta
+    :return: list of (name, length) in the order of the reference, or None if there is no index or dictionary
+    """
+    contigs = []
+    if os.path.exists(ref_fasta + ".fai"):
+        for line in open(ref_fasta + ".fai"):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2:
+                contigs.append((fields[0], int(fields[1])))
+        return contigs
+
+    dict_file = os.path.splitext(ref_fasta)[0] + ".dict"
+    if os.path.exists(dict_file):
+        for line in open(dict_file):
+            if not line.startswith("@SQ"):
+                continue
+            tags = dict(x.split(':', 1) for x in line.rstrip('\n').split('\t')[1:] if ':' in x)
+            contigs.append((tags['SN'], int(tags['LN'])))
+        return contigs
+    return None
+
+
+def split_intervals(contigs, n_shards, whole_contigs=False):
+    """
+    Split the contigs into `n_shards` shards with about the same number of bases. Small contigs are grouped together
+    and contigs longer than a shard are split.
+    :param contigs: list of (name, length)
+    :param n_shards: number of shards
+    :param whole_contigs: never split a contig, shards are then at least as long as the longest contig
+    :return: list of shards, each a list of (name, start, end) with 1-based inclusive coordinates
+    """
+    if whole_contigs:
+        return split_contigs(contigs, n_shards)
+    total = sum([x[1] for x in contigs])
+    shard_size = (total + n_shards - 1) // n_shards
+    shards = [[]]
+    filled = 0
+    for name, length in contigs:
+        start = 1
+        while start <= length:
+            end = min(length, start + shard_size - filled - 1)
+            shards[-1].append((name, start, end))
+            filled += end - start + 1
+            start = end + 1
+            if filled >= shard_size and len(shards) < n_shards:
+                shards.append([])
+                filled = 0
+    return [x for x in shards if len(x) > 0]
+
+
+def split_contigs(contigs, n_shards):
+    """
+    Group whole contigs, in the order of the reference, into at most `n_shards` shards of about the same size
+    :param contigs: list of (name, length)
+    :param n_shards: number of shards
+    :return: list of shards, each a list of (name, 1, length)
+    """
+    total = sum([x[1] for x in contigs])
+    shard_size = max((total + n_shards - 1) // n_shards, max([x[1] for x in contigs]))
+    shards = [[]]
+    filled = 0
+    for name, length in contigs:
+        if filled > 0 and filled + length > shard_size and len(shards) < n_shards:
+            shards.append([])
+            filled = 0
+        shards[-1].append((name, 1, length))
+        filled += length
+    return shards
+
+
+def write_interval_shards(ref_fasta, n_shards, out_dir, whole_contigs=False):
+    """
+    Write one GATK `.intervals` file per shard of the reference, files that already exist are reused
+    :param ref_fasta: path to the reference fasta
+    :param n_shards: number of shards
+    :param out_dir: directory for the interval files
+    :param whole_contigs: never split a contig, for the steps writing BAMs
+    :return: list of the interval files, or None if the contig lengths could not be read
+    """
+    contigs = reference_contigs(ref_fasta)
+    if contigs is None or len(contigs) == 0:
+        return None
+    shard_dir = os.path.join(out_dir, os.path.basename(ref_fasta) + "_" + str(n_shards) +
+                             ("_contig_shards" if whole_contigs else "_shards"))
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    interval_files = []
+    for idx, shard in enumerate(split_intervals(contigs, n_shards, whole_contigs)):
+        interval_file = os.path.join(shard_dir, "shard_%04d.intervals" % idx)
+        if not os.path.exists(interval_file):
+            f = open(interval_file + ".tmp", 'w')
+            for name, start, end in shard:
+                f.write("%s:%d-%d\n" % (name, start, end))
+            f.close()
+            os.rename(interval_file + ".tmp", interval_file)
+        interval_files.append(interval_file)
+    return interval_files
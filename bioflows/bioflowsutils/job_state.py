@@ -0,0 +1,349 @@
+"""
+Helpers to query the state of jobs submitted through SAGA without holding on to the SAGA job objects, and a
+tracker that follows many jobs with one scheduler query per polling interval.
+
+SAGA job ids have the form `[scheme://host]-[native_id]`, e.g. `[slurm://localhost]-[123456]`. When jobs are
+submitted without waiting, the id is written next to the checkpoint target and these helpers are used later to find
+out whether the job is still queued or running.
+"""
+
+import getpass
+import os
+import subprocess
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+# SLURM states for jobs that are still in the queue or running
+SLURM_ACTIVE_STATES = ['PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'RESIZING', 'REQUEUED', 'SUSPENDED']
+
+
+def parse_saga_job_id(saga_id):
+    """
+    Split a SAGA job id into its scheduler, host and native job id
+    :param saga_id: job id as returned by `saga.job.Job.get_id()`
+    :return: tuple of (scheduler, host, native_id)
+    """
+    url, native_id = saga_id.split(']-[')
+    url = url.strip('[')
+    native_id = native_id.strip(']')
+    scheduler, host = url.split('://')
+    return scheduler, host.strip('/'), native_id
+
+
+def native_job_id(saga_id):
+    """
+    Return only the scheduler job id, e.g. the SLURM job id, from a SAGA job id
+    """
+    return parse_saga_job_id(saga_id)[2]
+
+
+def remote_command(cmd, scheduler, host, user=None):
+    """
+    Wrap a command so it is run on the scheduler host. Only `ssh` and `+ssh` schedulers need the ssh prefix.
+    :param cmd: list with the command and its arguments
+    :return: list with the command to run locally
+    """
+    if (scheduler == 'ssh' or scheduler.endswith('+ssh')) and host not in ['localhost', '']:
+        target = host if user is None else user + '@' + host
+        return ['ssh', '-o', 'BatchMode=yes', target, ' '.join(cmd)]
+    return cmd
+
+
+def job_is_active(saga_id, user=None):
+    """
+    Check if a job submitted through SAGA is still pending or running.
+    :param saga_id: job id as returned by `saga.job.Job.get_id()`
+    :param user: ssh user for `+ssh` schedulers
+    :return: True if the job is still queued or running
+    """
+    scheduler, host, native_id = parse_saga_job_id(saga_id)
+
+    if scheduler.startswith('slurm'):
+        cmd = remote_command(['squeue', '-h', '-o', '%T', '-j', native_id], scheduler, host, user)
+        try:
+            state = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            # squeue exits non zero when the job id is no longer known to the controller
+            return False
+        # job arrays report one line per index
+        return any(x.strip() in SLURM_ACTIVE_STATES for x in state.splitlines())
+    elif scheduler == 'ssh':
+        # the ssh adaptor reports the process id of the job on the remote host
+        cmd = remote_command(['kill', '-0', native_id], scheduler, host, user)
+        return subprocess.call(cmd, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT) == 0
+    else:
+        # the fork adaptor reports the process id of the job
+        try:
+            os.kill(int(native_id), 0)
+        except (OSError, ValueError):
+            return False
+        return True
+
+
+# Job states, these are the same strings as the SAGA job states
+PENDING = 'Pending'
+RUNNING = 'Running'
+DONE = 'Done'
+FAILED = 'Failed'
+CANCELED = 'Canceled'
+# The job has left the scheduler queue and no accounting information is available for it
+EXITED = 'Exited'
+
+FINAL_STATES = [DONE, FAILED, CANCELED, EXITED]
+
+SLURM_STATE_MAP = {'PENDING': PENDING, 'CONFIGURING': PENDING, 'REQUEUED': PENDING,
+                   'RUNNING': RUNNING, 'COMPLETING': RUNNING, 'RESIZING': RUNNING, 'SUSPENDED': RUNNING,
+                   'COMPLETED': DONE, 'CANCELLED': CANCELED,
+                   'FAILED': FAILED, 'TIMEOUT': FAILED, 'NODE_FAIL': FAILED, 'OUT_OF_MEMORY': FAILED,
+                   'PREEMPTED': FAILED, 'BOOT_FAIL': FAILED, 'DEADLINE': FAILED}
+
+
+def combine_states(states):
+    """
+    Combine the states of the indices of a job array into one state for the whole array
+    """
+    if any(x not in FINAL_STATES for x in states):
+        return RUNNING if RUNNING in states else PENDING
+    elif any(x in [FAILED, CANCELED] for x in states):
+        return FAILED
+    return DONE
+
+
+def parse_slurm_states(output, sep):
+    """
+    Parse lines of `job_id<sep>STATE` as printed by squeue and sacct. Indices of job arrays are also combined into
+    a state for the array job id.
+    :return: dictionary of native job id to state
+    """
+    states = dict()
+    array_states = defaultdict(list)
+    for line in output.splitlines():
+        if sep not in line:
+            continue
+        job_id, state = line.strip().split(sep)[:2]
+        # sacct reports e.g. "CANCELLED by 1234"
+        state = SLURM_STATE_MAP.get(state.split()[0] if state else '', EXITED)
+        states[job_id] = state
+        if '_' in job_id:
+            array_states[job_id.split('_')[0]].append(state)
+    for job_id, element_states in array_states.iteritems():
+        if job_id not in states:
+            states[job_id] = combine_states(element_states)
+    return states
+
+
+def slurm_queue_states(scheduler='slurm', host='localhost', user=None):
+    """
+    The states of all the jobs of a user in the SLURM queue, with one squeue call
+    :return: dictionary of job id to state, or None if the controller could not be reached
+    """
+    if user is None:
+        user = getpass.getuser()
+    cmd = remote_command(['squeue', '-h', '-r', '-u', user, '-o', '%i,%T'], scheduler, host, user)
+    try:
+        return parse_slurm_states(subprocess.check_output(cmd, stderr=open(os.devnull, 'w')), ',')
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+# The last squeue output of each (scheduler, host, user) with the time it was read, see `job_is_queued`
+queue_cache = dict()
+queue_cache_lock = threading.Lock()
+
+
+def job_is_queued(saga_id, user=None, max_age=30):
+    """
+    Like `job_is_active`, but SLURM jobs are looked up in the queue of the user, which is read with one squeue call
+    and reused for `max_age` seconds. Checking the jobs of all the tasks of a workflow then costs one squeue call
+    per interval instead of one per job.
+    :param saga_id: job id as returned by `saga.job.Job.get_id()`
+    :param user: ssh user for `+ssh` schedulers
+    :return: True if the job is still queued or running, or if the controller could not be reached
+    """
+    scheduler, host, native_id = parse_saga_job_id(saga_id)
+    if not scheduler.startswith('slurm'):
+        return job_is_active(saga_id, user)
+    key = (scheduler, host, user)
+    with queue_cache_lock:
+        read_time, states = queue_cache.get(key, (0, None))
+        if states is None or time.time() - read_time > max_age:
+            states = slurm_queue_states(scheduler, host, user)
+            if states is None:
+                # the job may still be running, it is not submitted again
+                return True
+            queue_cache[key] = (time.time(), states)
+    return states.get(native_id) in [PENDING, RUNNING]
+
+
+def slurm_job_states(native_ids, scheduler='slurm', host='localhost', user=None):
+    """
+    Get the state of many SLURM jobs with one squeue call, and one sacct call for the jobs that have left the queue
+    :param native_ids: list of SLURM job ids, array indices as `jobid_index`
+    :return: dictionary of job id to state
+    """
+    if user is None:
+        user = getpass.getuser()
+    states = dict()
+    queued = slurm_queue_states(scheduler, host, user)
+    if queued is None:
+        # Do not report jobs as finished when the controller could not be reached
+        return states
+    for job_id in native_ids:
+        if job_id in queued:
+            states[job_id] = queued[job_id]
+
+    finished = [x for x in native_ids if x not in states]
+    for i in range(0, len(finished), 500):
+        cmd = remote_command(['sacct', '-n', '-X', '-P', '-o', 'JobID,State', '-j', ','.join(finished[i:i + 500])],
+                             scheduler, host, user)
+        try:
+            accounted = parse_slurm_states(subprocess.check_output(cmd, stderr=open(os.devnull, 'w')), '|')
+        except (subprocess.CalledProcessError, OSError):
+            accounted = dict()
+        for job_id in finished[i:i + 500]:
+            states[job_id] = accounted.get(job_id, EXITED)
+    return states
+
+
+def slurm_queue_counts(scheduler='slurm', host='localhost', user=None):
+    """
+    Count the jobs of a user in the SLURM queue, with each index of a job array counted as a job
+    :return: tuple of (pending, total) or None if the controller could not be reached
+    """
+    if user is None:
+        user = getpass.getuser()
+    cmd = remote_command(['squeue', '-h', '-r', '-u', user, '-o', '%T'], scheduler, host, user)
+    try:
+        states = subprocess.check_output(cmd, stderr=open(os.devnull, 'w')).split()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return len([x for x in states if SLURM_STATE_MAP.get(x) == PENDING]), len(states)
+
+
+class JobTracker(object):
+    """
+    Track the state of many jobs with one scheduler query per polling interval.
+
+    SLURM jobs are queried together with one `squeue` call (and `sacct` for the jobs that have left the queue), jobs
+    from other SAGA backends such as `fork` are queried through their SAGA job objects. The polling interval starts
+    at `min_interval` and grows by `backoff` each time nothing changes, up to `max_interval`. Polling happens in a
+    background thread and callers of `wait` are woken up as soon as a poll sees their jobs finish.
+    """
+
+    def __init__(self, user=None, min_interval=5, max_interval=120, backoff=1.5, verbose=True):
+        self.user = user
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.verbose = verbose
+        self.jobs = OrderedDict()
+        self.states = dict()
+        self.condition = threading.Condition()
+        self.new_jobs = threading.Event()
+        self.thread = None
+        return
+
+    def add(self, job):
+        """
+        Track a job
+        :param job: a SAGA job object or a SAGA job id
+        :return: the SAGA job id
+        """
+        if isinstance(job, basestring):
+            saga_id, job_obj = job, None
+        else:
+            saga_id, job_obj = job.get_id(), job
+        with self.condition:
+            self.jobs[saga_id] = job_obj
+            self.states.setdefault(saga_id, PENDING)
+        self.new_jobs.set()
+        return saga_id
+
+    def state(self, saga_id):
+        with self.condition:
+            return self.states[saga_id]
+
+    def outstanding(self):
+        with self.condition:
+            return [x for x in self.jobs.keys() if self.states[x] not in FINAL_STATES]
+
+    def saga_job_state(self, saga_id):
+        job_obj = self.jobs[saga_id]
+        if job_obj is not None:
+            state = job_obj.get_state()
+            return state if state in [PENDING, RUNNING] + FINAL_STATES else PENDING
+        return RUNNING if job_is_active(saga_id, self.user) else EXITED
+
+    def poll(self):
+        """
+        Query the state of all outstanding jobs
+        :return: list of the job ids whose state changed
+        """
+        new_states = dict()
+        slurm_jobs = defaultdict(list)
+        for saga_id in self.outstanding():
+            scheduler, host, native_id = parse_saga_job_id(saga_id)
+            if scheduler.startswith('slurm'):
+                slurm_jobs[(scheduler, host)].append((saga_id, native_id))
+            else:
+                new_states[saga_id] = self.saga_job_state(saga_id)
+
+        for (scheduler, host), jobs in slurm_jobs.iteritems():
+            native_states = slurm_job_states([x[1] for x in jobs], scheduler, host, self.user)
+            for saga_id, native_id in jobs:
+                if native_id in native_states:
+                    new_states[saga_id] = native_states[native_id]
+
+        changed = []
+        with self.condition:
+            for saga_id, state in new_states.iteritems():
+                if self.states[saga_id] != state:
+                    self.states[saga_id] = state
+                    changed.append(saga_id)
+                    if self.verbose:
+                        print ' * Job %s status: %s' % (saga_id, state)
+            if len(changed) > 0:
+                self.condition.notify_all()
+        return changed
+
+    def run(self):
+        interval = self.min_interval
+        while len(self.outstanding()) > 0:
+            if self.new_jobs.is_set():
+                self.new_jobs.clear()
+                interval = self.min_interval
+            if len(self.poll()) > 0:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            self.new_jobs.wait(interval)
+        with self.condition:
+            self.thread = None
+            self.condition.notify_all()
+        return
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="JobTracker")
+                self.thread.daemon = True
+                self.thread.start()
+        return
+
+    def wait(self, job_ids=None):
+        """
+        Block until the jobs have finished
+        :param job_ids: the SAGA job ids to wait for, defaults to all tracked jobs
+        :return: dictionary of job id to final state
+        """
+        self.start()
+        with self.condition:
+            if job_ids is None:
+                job_ids = self.jobs.keys()
+            while any(self.states[x] not in FINAL_STATES for x in job_ids):
+                if self.thread is None:
+                    self.start()
+                # Wake up from time to time so the wait can be interrupted
+                self.condition.wait(5)
+            return dict((x, self.states[x]) for x in job_ids)
@@ -0,0 +1,251 @@
+"""
+Cache of the indexes derived from a reference, shared between workflows and users.
+
+Each index is kept in `<cache_dir>/<index>/<name>-<key>`, where the key is made from the checksums of the source
+files (reference fasta, gtf, transcripts) and the versions of the tools building the index, so an index is only
+built once for the same sources and tools:
+
+-   `fasta`: a copy of the reference fasta with its `.fai` (samtools faidx) and `.dict` (picard
+    CreateSequenceDictionary)
+-   `bwa`: the BWA index of the reference
+-   `salmon`: the salmon index of the transcripts
+-   `gsnap`: the gmap/gsnap database of the reference, with the splice sites of the gtf in `<db>.splicesites.iit`
+
+An index is built in a temporary directory next to its entry and renamed into place when it is complete, so a
+partially written index is never used. Builds of the same entry wait for each other on a lock file.
+
+The checksums of the sources are kept in `<cache_dir>/checksums` by path, size and modification time, so the
+sources are only read again when they change.
+"""
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+
+# The sources and tools of each index
+INDEXES = {'fasta': (['fasta'], ['samtools', 'picard']),
+           'bwa': (['fasta'], ['bwa']),
+           'salmon': (['transcripts'], ['salmon']),
+           'gsnap': (['fasta', 'gtf'], ['gsnap'])}
+
+VERSION_COMMANDS = {'samtools': "samtools --version | head -n 1",
+                    'picard': "picard CreateSequenceDictionary --version 2>&1 | tail -n 1",
+                    'bwa': "bwa 2>&1 | grep '^Version'",
+                    'salmon': "salmon --version 2>&1 | head -n 1",
+                    'gsnap': "gsnap --version 2>&1 | head -n 1"}
+
+
+def file_checksum(path, cache_dir):
+    """
+    The sha1 of a file, kept in the cache by the path, size and modification time of the file
+    :param path: the file
+    :param cache_dir: the cache directory
+    :return: the hex digest
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    record_file = os.path.join(cache_dir, 'checksums', hashlib.sha1(path).hexdigest() + ".json")
+    if os.path.exists(record_file):
+        record = json.load(open(record_file))
+        if record['size'] == st.st_size and record['mtime'] == st.st_mtime:
+            return record['sha1']
+
+    sha1 = hashlib.sha1()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b''):
+        sha1.update(block)
+    f.close()
+    record = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1.hexdigest()}
+    make_dirs(os.path.dirname(record_file))
+    tmp_file = "%s.%s.%d" % (record_file, socket.gethostname(), os.getpid())
+    f = open(tmp_file, 'w')
+    json.dump(record, f)
+    f.close()
+    os.rename(tmp_file, record_file)
+    return record['sha1']
+
+
+def tool_version(tool, conda_command=None):
+    """
+    The version of a tool as printed by the tool
+    :param conda_command: command setting up the environment the tool is run in
+    :return: the version, or None if the tool could not be run
+    """
+    cmd = VERSION_COMMANDS[tool]
+    if conda_command is not None:
+        cmd = conda_command + " > /dev/null 2>&1; " + cmd
+    try:
+        version = subprocess.check_output(['bash', '-c', cmd]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return version or None
+
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return
+
+
+def source_name(path):
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return name
+
+
+def index_key(index, sources, versions, cache_dir):
+    """
+    The name of the cache entry of an index
+    :param index: one of INDEXES
+    :param sources: dictionary of the source files, `fasta`, `gtf` and `transcripts`
+    :param versions: dictionary of the versions of the tools
+    :return: `<name>-<key>`, with the name of the first source
+    """
+    source_keys, tools = INDEXES[index]
+    content = [[x, file_checksum(sources[x], cache_dir)] for x in source_keys if sources.get(x) is not None]
+    content += [[x, versions[x]] for x in tools]
+    key = hashlib.sha1(json.dumps(content)).hexdigest()[:16]
+    return os.path.splitext(source_name(sources[source_keys[0]]))[0] + "-" + key
+
+
+def index_paths(index, entry, sources):
+    """
+    The paths in a cache entry that are given to the programs, they can be used in the options of the
+    `workflow_sequence` as `ref_cache:<name>`
+    :return: dictionary of name to path
+    """
+    if index == 'fasta':
+        return {'fasta': os.path.join(entry, source_name(sources['fasta']))}
+    elif index == 'bwa':
+        return {'bwa': os.path.join(entry, source_name(sources['fasta']))}
+    elif index == 'salmon':
+        return {'salmon': os.path.join(entry, 'index')}
+    db = os.path.splitext(source_name(sources['fasta']))[0]
+    paths = {'gsnap_dir': entry, 'gsnap_db': db}
+    if sources.get('gtf') is not None:
+        paths['splicesites'] = db + ".splicesites"
+    return paths
+
+
+def run(cmd):
+    print cmd
+    sys.stdout.flush()
+    subprocess.check_call(['bash', '-o', 'pipefail', '-c', cmd])
+    return
+
+
+def build_index(index, build_dir, sources, threads):
+    """
+    Build an index into an empty directory
+    """
+    if index == 'fasta':
+        fasta = index_paths(index, build_dir, sources)['fasta']
+        run("zcat -f %s > %s" % (sources['fasta'], fasta))
+        run("samtools faidx " + fasta)
+        run("picard CreateSequenceDictionary R=%s O=%s" % (fasta, os.path.splitext(fasta)[0] + ".dict"))
+    elif index == 'bwa':
+        run("bwa index -p %s %s" % (index_paths(index, build_dir, sources)['bwa'], sources['fasta']))
+    elif index == 'salmon':
+        run("salmon index -p %d -t %s -i %s" % (threads, sources['transcripts'],
+                                                index_paths(index, build_dir, sources)['salmon']))
+    else:
+        paths = index_paths(index, build_dir, sources)
+        db = paths['gsnap_db']
+        gunzip = ' -g' if sources['fasta'].endswith('.gz') else ''
+        run("gmap_build -t %d%s -D %s -d %s %s" % (threads, gunzip, build_dir, db, sources['fasta']))
+        if 'splicesites' in paths.keys():
+            maps_dir = os.path.join(build_dir, db, db + ".maps")
+            make_dirs(maps_dir)
+            run("zcat -f %s | gtf_splicesites | iit_store -o %s" % (sources['gtf'],
+                                                                    os.path.join(maps_dir, paths['splicesites'])))
+    return
+
+
+def publish(cache_dir, index, key, build, info=None):
+    """
+    Build a cache entry if it does not exist. The entry is built by `build` in a temporary directory that is renamed
+    to the entry once it is complete, concurrent builds of the entry wait on a lock and reuse the first one.
+    :param build: function building the index into the directory it is given
+    :param info: written to `BUILD_INFO.json` in the entry
+    :return: the entry
+    """
+    index_dir = os.path.join(cache_dir, index)
+    entry = os.path.join(index_dir, key)
+    if os.path.isdir(entry):
+        return entry
+    make_dirs(index_dir)
+    with open(entry + ".lock", 'a') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.isdir(entry):
+                return entry
+            build_dir = os.path.join(index_dir, ".%s.%s.%d" % (key, socket.gethostname(), os.getpid()))
+            make_dirs(build_dir)
+            try:
+                build(build_dir)
+                f = open(os.path.join(build_dir, 'BUILD_INFO.json'), 'w')
+                json.dump(info or dict(), f, indent=2)
+                f.close()
+                # readable by the other users of the cache
+                for root, dirs, files in os.walk(build_dir):
+                    for x in dirs:
+                        os.chmod(os.path.join(root, x), 0o755)
+                    for x in files:
+                        os.chmod(os.path.join(root, x), 0o644)
+                os.chmod(build_dir, 0o755)
+                os.rename(build_dir, entry)
+            except:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a reference index into the reference cache")
+    parser.add_argument('action', choices=['build'])
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--index', required=True, choices=sorted(INDEXES.keys()))
+    parser.add_argument('--key', required=True, help="the name of the entry, from the workflow")
+    parser.add_argument('--fasta')
+    parser.add_argument('--gtf')
+    parser.add_argument('--transcripts')
+    parser.add_argument('--threads', type=int, default=1)
+    opts = parser.parse_args()
+
+    if os.path.isdir(os.path.join(opts.cache_dir, opts.index, opts.key)):
+        print "Already built " + os.path.join(opts.cache_dir, opts.index, opts.key)
+        return
+    sources = {'fasta': opts.fasta, 'gtf': opts.gtf, 'transcripts': opts.transcripts}
+    versions = dict()
+    for tool in INDEXES[opts.index][1]:
+        versions[tool] = tool_version(tool)
+        if versions[tool] is None:
+            sys.exit("Could not get the version of " + tool)
+    # The sources or tools may have changed since the workflow worked out the key
+    key = index_key(opts.index, sources, versions, opts.cache_dir)
+    if key != opts.key:
+        sys.exit("The sources or tool versions of %s changed, expected %s but found %s" % (opts.index, opts.key, key))
+    info = {'index': opts.index, 'versions': versions,
+            'sources': dict((k, [v, file_checksum(v, opts.cache_dir)]) for k, v in sources.iteritems()
+                            if v is not None)}
+    entry = publish(opts.cache_dir, opts.index, key,
+                    lambda build_dir: build_index(opts.index, build_dir, sources, opts.threads), info)
+    print "Built " + entry
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+A process wide pool of SAGA sessions and job services.
+
+Creating a `saga.job.Service` for `slurm+ssh` or `ssh` opens a new ssh connection and bootstraps the adaptor on the
+remote host, which takes seconds. The pool keeps one session per (host, user) and one job service per
+(scheduler, host, user) and hands them out again on the next request. Services that have been idle for longer than
+`health_check_after` seconds are checked before they are reused and services idle for longer than `max_idle` seconds
+are closed.
+
+The pool is tied to the process that created it, a forked child starts with an empty pool and never closes the
+connections of its parent. With more than one luigi worker, luigi runs every task in a new forked process, so the
+workflow driver runs a `SubmitServer` before luigi starts: the workers send their job descriptions to the driver
+over a unix socket and the driver submits them with the services of its pool, so all the jobs share the same
+connections.
+"""
+
+import atexit
+import os
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import saga
+
+import bioflows.bioflowsutils.submit_governor as submit_governor
+
+
+class SagaPool(object):
+
+    def __init__(self, max_idle=900, health_check_after=120, health_timeout=30):
+        """
+        :param max_idle: seconds after which an unused job service is closed
+        :param health_check_after: seconds of idle time after which a job service is checked before it is reused
+        :param health_timeout: seconds after which a job service that has not answered the check is dropped
+        """
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self.health_timeout = health_timeout
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        self.sessions = dict()
+        self.services = dict()
+        return
+
+    def check_pid(self):
+        """
+        Drop the connections inherited from the parent after a fork without closing them
+        """
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.sessions = dict()
+            self.services = dict()
+        return
+
+    def get_session(self, host='localhost', user=None):
+        """
+        Return the shared session for a host, with an ssh context for remote hosts
+        """
+        with self.lock:
+            self.check_pid()
+            key = (host, user)
+            if key not in self.sessions:
+                session = saga.Session()
+                if host != 'localhost':
+                    ctx = saga.Context("ssh")
+                    if user is not None:
+                        ctx.user_id = user
+                    session.add_context(ctx)
+                self.sessions[key] = session
+            return self.sessions[key]
+
+    def get_job_service(self, scheduler='fork', host='localhost', user=None):
+        """
+        Return a job service for the scheduler and host, reusing an open one if it is still healthy
+        """
+        with self.lock:
+            self.check_pid()
+            self.evict_idle()
+            key = (scheduler, host, user)
+            now = time.time()
+            if key in self.services:
+                js, last_used = self.services[key]
+                if now - last_used < self.health_check_after or self.is_healthy(js):
+                    self.services[key] = (js, now)
+                    return js
+                self.close_service(key)
+
+            js = saga.job.Service(scheduler + "://" + host, session=self.get_session(host, user))
+            self.services[key] = (js, now)
+            return js
+
+    def is_healthy(self, js):
+        """
+        Check that the connection behind a job service still works by listing its jobs. A connection that hangs is
+        given up after `health_timeout` seconds
+        """
+        result = []
+
+        def probe():
+            try:
+                js.list()
+                result.append(True)
+            except saga.SagaException:
+                result.append(False)
+        thread = threading.Thread(target=probe, name="SagaPoolProbe")
+        thread.daemon = True
+        thread.start()
+        thread.join(self.health_timeout)
+        return result == [True]
+
+    def close_service(self, key):
+        js, last_used = self.services.pop(key)
+        try:
+            js.close()
+        except saga.SagaException:
+            pass
+        return
+
+    def evict_idle(self):
+        """
+        Close the job services that have not been used for `max_idle` seconds
+        """
+        with self.lock:
+            now = time.time()
+            for key in [k for k, v in self.services.iteritems() if now - v[1] > self.max_idle]:
+                self.close_service(key)
+        return
+
+    def close_all(self):
+        with self.lock:
+            if os.getpid() != self.pid:
+                return
+            for key in self.services.keys():
+                self.close_service(key)
+            self.sessions = dict()
+        return
+
+
+pool = SagaPool()
+atexit.register(pool.close_all)
+
+
+def get_session(host='localhost', user=None):
+    return pool.get_session(host, user)
+
+
+def get_job_service(scheduler='fork', host='localhost', user=None):
+    return pool.get_job_service(scheduler, host, user)
+
+
+def run_job(description, service, job_parms, count=1):
+    """
+    Submit a job with the pooled job service, through the submit governor of the workflow
+    :param description: dictionary of the attributes of the `saga.job.Description`
+    :param service: tuple of the scheduler, host and user of the job service
+    :param job_parms: the job parameters with the `saga_*` and `submit_*` settings and the `scripts_dir`
+    :param count: number of jobs, the size of a job array
+    :return: the started SAGA job
+    """
+    jd = saga.job.Description()
+    for k, v in description.iteritems():
+        setattr(jd, k, v)
+    js = get_job_service(*service)
+    governor = submit_governor.from_job_parms(job_parms, job_parms.get('scripts_dir'))
+    return submit_governor.run_job(js, jd, governor, count=count)
+
+
+class SubmitServer(object):
+    """
+    Submits the jobs of the forked luigi workers from the workflow driver, so they share the job services of the
+    pool of the driver. Each request is answered with the SAGA job id, the workers follow their jobs by id.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.authkey = os.urandom(16)
+        self.listener = Listener(family='AF_UNIX', authkey=self.authkey)
+        self.address = self.listener.address
+        # jobs are submitted one at a time, the submissions are throttled by the governor anyway
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve, name="SubmitServer")
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+    def serve(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (IOError, EOFError):
+                return
+            handler = threading.Thread(target=self.handle, args=(conn,), name="SubmitHandler")
+            handler.daemon = True
+            handler.start()
+
+    def handle(self, conn):
+        try:
+            description, service, job_parms, count = conn.recv()
+            with self.lock:
+                job = run_job(description, service, job_parms, count)
+            conn.send(('ok', job.get_id()))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        finally:
+            conn.close()
+        return
+
+    def close(self):
+        if os.getpid() == self.pid:
+            self.listener.close()
+        return
+
+
+server = None
+
+
+def start_submit_server():
+    """
+    Start the submit server in the workflow driver, the luigi workers forked afterwards send their jobs to it
+    """
+    global server
+    if server is None:
+        server = SubmitServer()
+        atexit.register(server.close)
+    return server
+
+
+def submit(description, service, job_parms, count=1):
+    """
+    Submit a job, through the submit server of the driver when called from a forked luigi worker
+    :param description: dictionary of the attributes of the `saga.job.Description`
+    :param service: tuple of the scheduler, host and user of the job service
+    :param job_parms: the job parameters with the `saga_*` and `submit_*` settings and the `scripts_dir`
+    :param count: number of jobs, the size of a job array
+    :return: tuple of the SAGA job id and the SAGA job, the job is None when it was submitted by the driver
+    """
+    if server is None or os.getpid() == server.pid:
+        job = run_job(description, service, job_parms, count)
+        return job.get_id(), job
+    conn = Client(server.address, family='AF_UNIX', authkey=server.authkey)
+    try:
+        conn.send((description, service, job_parms, count))
+        status, result = conn.recv()
+    finally:
+        conn.close()
+    if status != 'ok':
+        raise RuntimeError("The submission of the job failed in the workflow driver:\n" + result)
+    return result, None
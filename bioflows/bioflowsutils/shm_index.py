@@ -0,0 +1,172 @@
+"""
+Genome indexes loaded once per node into shared memory and used by all the aligner jobs running on the node.
+
+Before aligning, a job registers itself as a user of the index with `acquire`, which loads the index if it is not
+in shared memory yet (`bwa shm`, `gsnap --preload-shared-memory`). The job releases the index when it exits and the
+last user unloads it. The users of each index are kept in a small json file in `/dev/shm`, updated under an `fcntl`
+lock, with the pid of the job script of each user so users that were killed without releasing the index are
+dropped. `cleanup` unloads the indexes that no running job uses.
+
+`bwa shm -d` removes all the BWA indexes of the node at once, so the users of all BWA indexes are counted together.
+"""
+
+import argparse
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+
+
+def index_size(tool, index, db_dir=None):
+    """
+    The size of an index in MB, 0 if its files are not found
+    :param tool: `bwa` or `gsnap`
+    :param index: the BWA index prefix or the gsnap database name
+    :param db_dir: the gsnap database directory (`-D`)
+    """
+    if tool == 'bwa':
+        files = [index + x for x in ['.bwt', '.sa', '.pac', '.ann', '.amb']]
+    elif db_dir is not None:
+        files = glob.glob(os.path.join(db_dir, index, '*'))
+    else:
+        files = []
+    return sum([os.path.getsize(x) for x in files if os.path.isfile(x)]) // (1024 * 1024)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class SharedIndex(object):
+
+    def __init__(self, tool, index, db_dir=None):
+        self.tool = tool
+        self.index = index
+        self.db_dir = db_dir
+        key = 'bwa' if tool == 'bwa' else ':'.join([tool, str(db_dir), index])
+        self.state_file = os.path.join(SHM_DIR, "bioflows_shm_%s_%s.json" % (
+            os.environ.get('USER', 'user'), hashlib.sha1(key).hexdigest()))
+
+    def gsnap_args(self):
+        args = ['gsnap', '-d', self.index]
+        if self.db_dir is not None:
+            args += ['-D', self.db_dir]
+        return args
+
+    def load(self):
+        if self.tool == 'bwa':
+            cmd = ['bwa', 'shm', self.index]
+        else:
+            cmd = self.gsnap_args() + ['--preload-shared-memory']
+        try:
+            return subprocess.call(cmd) == 0
+        except OSError:
+            return False
+
+    def unload(self):
+        if self.tool == 'bwa':
+            cmd = ['bwa', 'shm', '-d']
+        else:
+            cmd = self.gsnap_args() + ['--unload-shared-memory']
+        try:
+            subprocess.call(cmd)
+        except OSError:
+            print >> sys.stderr, "Could not unload %s from shared memory" % self.index
+        return
+
+    def locked_update(self, update):
+        """
+        Apply `update` to the state of the index while holding the lock, the state has the indexes that are loaded
+        and the pids of their users
+        """
+        with open(self.state_file + ".lock", 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.load(open(self.state_file))
+                except (IOError, ValueError):
+                    state = dict(loaded=[], owners=[])
+                state.update(tool=self.tool, db_dir=self.db_dir)
+                state['owners'] = [x for x in state['owners'] if pid_alive(x)]
+                update(state)
+                f = open(self.state_file + ".tmp", 'w')
+                json.dump(state, f)
+                f.close()
+                os.rename(self.state_file + ".tmp", self.state_file)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        return
+
+    def acquire(self, owner):
+        """
+        Register `owner` as a user of the index and load the index if needed. If the index cannot be loaded the
+        aligner falls back to loading it into its own memory.
+        """
+        def update(state):
+            if self.index not in state['loaded']:
+                if self.load():
+                    state['loaded'].append(self.index)
+                else:
+                    print >> sys.stderr, "Could not load %s into shared memory" % self.index
+            state['owners'].append(owner)
+        self.locked_update(update)
+        return
+
+    def release(self, owner):
+        """
+        Remove `owner` from the users of the index and unload the index when no user is left
+        """
+        def update(state):
+            state['owners'] = [x for x in state['owners'] if x != owner]
+            if len(state['owners']) == 0 and len(state['loaded']) > 0:
+                self.unload()
+                state['loaded'] = []
+        self.locked_update(update)
+        return
+
+
+def cleanup():
+    """
+    Unload the indexes of this user that are not used by any running job
+    """
+    for state_file in glob.glob(os.path.join(SHM_DIR, "bioflows_shm_%s_*.json" % os.environ.get('USER', 'user'))):
+        state = json.load(open(state_file))
+        for index in state.get('loaded', []):
+            shared = SharedIndex(state['tool'], index, state.get('db_dir'))
+            shared.state_file = state_file
+            shared.release(None)
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share genome indexes in memory between the aligner jobs of a node")
+    parser.add_argument('action', choices=['acquire', 'release', 'cleanup'])
+    parser.add_argument('--tool', choices=['bwa', 'gsnap'])
+    parser.add_argument('--index', help="the BWA index prefix or the gsnap database name")
+    parser.add_argument('--db-dir', help="the gsnap database directory")
+    parser.add_argument('--owner', type=int, help="pid of the job script using the index")
+    opts = parser.parse_args()
+
+    if opts.action == 'cleanup':
+        cleanup()
+        return
+    shared = SharedIndex(opts.tool, opts.index, opts.db_dir)
+    if opts.action == 'acquire':
+        shared.acquire(opts.owner)
+    else:
+        shared.release(opts.owner)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Conversion of the SRA runs of a sample to gzipped fastqs.
+
+Each run is converted by `fasterq-dump` with several threads and compressed with `pigz`, and the runs of a sample
+are converted at the same time in a directory of their own. Once all the runs are done their fastqs are
+concatenated, in the order of the runs given, into `<sample>.fq.gz` or `<sample>_1.fq.gz` and `<sample>_2.fq.gz`.
+gzip files can be concatenated as they are, so the reads are not compressed again. The fastqs of the sample are
+written under a temporary name and renamed when they are complete, so a partial fastq is never used.
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+
+def run_name(sra):
+    name = os.path.basename(sra)
+    if name.endswith('.sra'):
+        name = name[:-len('.sra')]
+    return name
+
+
+def read_suffixes(paired_end):
+    return ['_1', '_2'] if paired_end else ['']
+
+
+def convert_run(sra, run_dir, paired_end, threads, temp_dir):
+    """
+    Convert a run to gzipped fastqs with fasterq-dump and pigz
+    :param sra: the .sra file or accession of the run
+    :param run_dir: directory the fastqs of the run are written to
+    :param paired_end: split the reads of each spot into `_1` and `_2`, otherwise all reads are written to one fastq
+    :param threads: threads of fasterq-dump and pigz
+    :param temp_dir: directory for the temporary files of fasterq-dump
+    :return: the gzipped fastqs of the run, one per read
+    """
+    name = run_name(sra)
+    cmd = ['fasterq-dump', '--threads', str(threads), '--temp', temp_dir, '--outdir', run_dir,
+           '--outfile', name + '.fastq', '--split-3' if paired_end else '--split-spot', sra]
+    print ' '.join(cmd)
+    sys.stdout.flush()
+    subprocess.check_call(cmd)
+    fastqs = [os.path.join(run_dir, name + x + '.fastq') for x in read_suffixes(paired_end)]
+    subprocess.check_call(['pigz', '-p', str(threads)] + fastqs)
+    return [x + '.gz' for x in fastqs]
+
+
+def convert_sample(sample, runs, fastq_dir, paired_end=False, threads=8, parallel_runs=None, temp_dir=None,
+                   convert=convert_run):
+    """
+    Convert the runs of a sample at the same time and concatenate their fastqs in the order of the runs
+    :param sample: the sample id
+    :param runs: the .sra files of the sample, in the order their reads are written
+    :param fastq_dir: directory of the fastqs of the sample
+    :param threads: threads shared by the runs converted at the same time
+    :param parallel_runs: number of runs converted at the same time, by default one per 4 threads
+    :param temp_dir: directory for the temporary files of fasterq-dump, `$TMPDIR` by default
+    :param convert: function converting one run, with the arguments of `convert_run`
+    :return: the fastqs of the sample
+    """
+    if parallel_runs is None:
+        parallel_runs = max(threads // 4, 1)
+    parallel_runs = max(min(parallel_runs, len(runs)), 1)
+    run_threads = max(threads // parallel_runs, 1)
+    temp_dir = temp_dir or tempfile.gettempdir()
+
+    work_dir = os.path.join(fastq_dir, ".%s.sra.%s.%d" % (sample, socket.gethostname(), os.getpid()))
+    run_dirs = [os.path.join(work_dir, "%04d" % i) for i in range(len(runs))]
+    for run_dir in run_dirs:
+        os.makedirs(run_dir)
+    try:
+        pool = ThreadPool(parallel_runs)
+        try:
+            # map keeps the order of the runs whatever order they finish in
+            run_fastqs = pool.map(lambda x: convert(x[0], x[1], paired_end, run_threads, temp_dir),
+                                  zip(runs, run_dirs))
+        finally:
+            pool.close()
+            pool.join()
+
+        fastqs = []
+        for i, suffix in enumerate(read_suffixes(paired_end)):
+            fastq = os.path.join(fastq_dir, sample + suffix + '.fq.gz')
+            tmp_fastq = os.path.join(work_dir, os.path.basename(fastq))
+            f = open(tmp_fastq, 'wb')
+            for x in run_fastqs:
+                with open(x[i], 'rb') as run_fastq:
+                    shutil.copyfileobj(run_fastq, f, 1 << 20)
+            f.close()
+            fastqs.append((tmp_fastq, fastq))
+        for tmp_fastq, fastq in fastqs:
+            os.rename(tmp_fastq, fastq)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return [x[1] for x in fastqs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the SRA runs of a sample to gzipped fastqs")
+    parser.add_argument('runs', nargs='+', help="the .sra files of the sample, in the order of their reads")
+    parser.add_argument('--sample', required=True)
+    parser.add_argument('--fastq-dir', required=True)
+    parser.add_argument('--paired-end', action='store_true')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--parallel-runs', type=int, help="runs converted at the same time, one per 4 threads by "
+                                                          "default")
+    parser.add_argument('--temp-dir', help="directory for the temporary files of fasterq-dump, $TMPDIR by default")
+    opts = parser.parse_args()
+
+    fastqs = convert_sample(opts.sample, opts.runs, opts.fastq_dir, opts.paired_end, opts.threads,
+                            opts.parallel_runs, opts.temp_dir)
+    print "Wrote " + ' '.join(fastqs)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Throttling of job submissions so large cohorts do not trip the SLURM submission limits
+(e.g. `QOSMaxSubmitJobPerUserLimit`).
+
+A submission has to get past three checks:
+
+-   a token bucket that allows `rate` submissions per second with bursts of up to `burst` submissions, a `rate` of 0
+    turns it off
+-   a limit on the number of jobs of the user in the queue, pending or running (`max_in_flight`)
+-   a limit on the number of pending jobs of the user (`max_pending`)
+
+The luigi workers run their tasks in separate processes, so the state of the governor is kept in a small json file
+that is updated under an `fcntl` lock and shared by all the processes of a workflow. The queue counts come from
+`squeue` and are refreshed at most every `queue_check_interval` seconds, submissions made in between are added to
+the last counts. The state is reset when a workflow starts, see `reset`.
+"""
+
+import fcntl
+import json
+import os
+import time
+
+import saga
+
+from bioflows.bioflowsutils.job_state import slurm_queue_counts
+
+# Messages of sbatch when a submission limit has been reached
+SUBMIT_LIMIT_ERRORS = ['QOSMaxSubmitJobPerUserLimit', 'AssocMaxSubmitJobLimit', 'MaxSubmitJobLimit',
+                       'Resource temporarily unavailable']
+
+
+class SubmitGovernor(object):
+
+    def __init__(self, state_file, rate=1.0, burst=10, max_in_flight=None, max_pending=None,
+                 queue_check_interval=30, scheduler='slurm', host='localhost', user=None):
+        """
+        :param state_file: the file shared by the processes of a workflow
+        :param rate: submissions per second, 0 or None for no limit
+        :param burst: number of submissions that can be made at once after an idle period
+        :param max_in_flight: maximum number of jobs of the user in the queue, None for no limit
+        :param max_pending: maximum number of pending jobs of the user, None for no limit
+        :param queue_check_interval: seconds between two squeue calls
+        """
+        self.state_file = state_file
+        self.rate = float(rate) if rate is not None and float(rate) > 0 else None
+        self.burst = max(float(burst), 1.0)
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.queue_check_interval = queue_check_interval
+        self.scheduler = scheduler
+        self.host = host
+        self.user = user
+        return
+
+    def new_state(self, now):
+        return dict(tokens=self.burst, last=now, hold_until=0, queue_time=0, pending=0, in_flight=0)
+
+    def locked_update(self, update):
+        """
+        Read the shared state, apply `update` to it and write it back while holding the lock
+        :param update: function taking the state dictionary and the current time, its return value is passed on
+        """
+        with open(self.state_file + ".lock", 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.load(open(self.state_file))
+                except (IOError, ValueError):
+                    state = self.new_state(time.time())
+                result = update(state, time.time())
+                tmp_file = self.state_file + ".tmp"
+                f = open(tmp_file, 'w')
+                json.dump(state, f)
+                f.close()
+                os.rename(tmp_file, self.state_file)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        return result
+
+    def check_queue(self, state, now):
+        if self.max_in_flight is None and self.max_pending is None:
+            return
+        if now - state['queue_time'] < self.queue_check_interval:
+            return
+        counts = slurm_queue_counts(self.scheduler, self.host, self.user)
+        if counts is not None:
+            state['pending'], state['in_flight'] = counts
+            state['queue_time'] = now
+        return
+
+    def try_acquire(self, count):
+        """
+        Take the tokens for `count` jobs if all the checks pass
+        :return: 0 if the jobs can be submitted, else the number of seconds to wait before trying again
+        """
+        def update(state, now):
+            if self.rate is not None:
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['last']) * self.rate)
+            state['last'] = now
+            if now < state['hold_until']:
+                return state['hold_until'] - now
+            self.check_queue(state, now)
+            if self.max_in_flight is not None and state['in_flight'] + count > self.max_in_flight:
+                if state['in_flight'] > 0:
+                    return self.queue_check_interval
+                # it would never fit, submit it on an empty queue and leave it to the retries of run_job
+                print ' * Job array of %d jobs is larger than max_jobs_in_queue (%d)' % (count, self.max_in_flight)
+            if self.max_pending is not None and state['pending'] >= self.max_pending:
+                return self.queue_check_interval
+            # Every job of an array takes a token. A job array larger than the bucket is let through once the
+            # bucket is full and the bucket goes below zero, so the next submissions wait for the whole array
+            if self.rate is not None:
+                needed = min(count, self.burst)
+                if state['tokens'] < needed:
+                    return (needed - state['tokens']) / self.rate
+                state['tokens'] -= count
+            state['pending'] += count
+            state['in_flight'] += count
+            return 0
+        return self.locked_update(update)
+
+    def acquire(self, count=1):
+        """
+        Block until `count` jobs can be submitted
+        """
+        wait = self.try_acquire(count)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire(count)
+        return
+
+    def reset(self):
+        """
+        Start again from a full bucket and no queue counts or hold, so the state left by an earlier run of the
+        workflow is not used
+        """
+        def update(state, now):
+            state.clear()
+            state.update(self.new_state(now))
+        self.locked_update(update)
+        return
+
+    def hold(self, seconds):
+        """
+        Stop all submissions for some time, used after the scheduler refused a job. The queue counts are refreshed
+        before the next submission.
+        """
+        def update(state, now):
+            state['hold_until'] = max(state['hold_until'], now + seconds)
+            state['tokens'] = 0
+            state['queue_time'] = 0
+        self.locked_update(update)
+        return
+
+
+def is_submit_limit_error(error):
+    return any(x in str(error) for x in SUBMIT_LIMIT_ERRORS)
+
+
+def run_job(js, jd, governor=None, count=1, retries=20, retry_wait=60):
+    """
+    Create and start a job through the governor, retrying when the scheduler refuses it because of a submission
+    limit
+    :param js: the SAGA job service
+    :param jd: the SAGA job description
+    :param governor: a `SubmitGovernor`, or None to submit right away
+    :param count: number of jobs, the size of a job array
+    :return: the started SAGA job
+    """
+    attempt = 0
+    while True:
+        if governor is not None:
+            governor.acquire(count)
+        myjob = js.create_job(jd)
+        try:
+            myjob.run()
+            return myjob
+        except saga.SagaException as e:
+            if not is_submit_limit_error(e) or attempt >= retries:
+                raise
+            attempt += 1
+            wait = min(retry_wait * attempt, 600)
+            print ' * Submission limit reached, retrying in %d seconds' % wait
+            if governor is not None:
+                governor.hold(wait)
+            else:
+                time.sleep(wait)
+
+
+def from_job_parms(job_parms, state_dir):
+    """
+    Create the governor for the submission settings in the job parameters of a workflow
+    :param job_parms: the job parameters with the `saga_*` and `submit_*` settings
+    :param state_dir: directory for the shared state file, e.g. the scripts directory of the workflow
+    :return: a `SubmitGovernor` or None when jobs are not submitted to SLURM
+    """
+    scheduler = job_parms.get('saga_scheduler', 'fork')
+    if not scheduler.startswith('slurm'):
+        return None
+    return SubmitGovernor(os.path.join(state_dir, ".submit_governor"),
+                          rate=job_parms.get('submit_rate', 1.0),
+                          burst=job_parms.get('submit_burst', 10),
+                          max_in_flight=job_parms.get('max_jobs_in_queue'),
+                          max_pending=job_parms.get('max_pending_jobs'),
+                          scheduler=scheduler, host=job_parms.get('saga_host', 'localhost'),
+                          user=job_parms.get('ssh_user'))
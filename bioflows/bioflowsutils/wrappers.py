@@ -21,16 +21,70 @@ A series of wrappers for external calls to various bioinformatics tools.
 """
 
 import copy
+import gzip
 import hashlib
 import os
 import subprocess
 import sys
+from collections import OrderedDict
 from itertools import chain
 
 # import config
 # import diagnostics
+import shm_index
 import utils
 
+# The node local disk for temporary files when `scratch_dir` is not set in the run_parms, SLURM sets TMPDIR for jobs
+SCRATCH_DIR = '${TMPDIR:-/tmp}'
+
+
+def fastq_read_group(sample, fastq, library=None):
+    """
+    Work out the read group of a sample from the name of the first read in its fastq. Illumina read names give the
+    flowcell and lane (and the barcode for Casava 1.8 and later), when the fastq cannot be read or the read names
+    are in another format the read group is named after the sample.
+    :param sample: the sample id
+    :param fastq: the fastq file, can be gzipped
+    :param library: the library name, defaults to the sample id
+    :return: ordered dictionary of the ID, SM, LB, PL and PU fields
+    """
+    read_group = OrderedDict([('ID', sample), ('SM', sample), ('LB', library or sample), ('PL', 'ILLUMINA'),
+                              ('PU', sample)])
+    try:
+        f = gzip.open(fastq) if fastq.endswith('.gz') else open(fastq)
+        header = f.readline().strip()
+        f.close()
+    except IOError:
+        # e.g. the fastqs are only written by the workflow (SRA, trimming), the read group has no flowcell or lane
+        print "Warning!!! Could not read %s, the read group of %s is named after the sample" % (fastq, sample)
+        return read_group
+
+    fields = header.lstrip('@').split()
+    if len(fields) == 0:
+        return read_group
+    name = fields[0].split(':')
+    if len(name) == 7:
+        # @instrument:run:flowcell:lane:tile:x:y read:filtered:control:barcode
+        flowcell, lane = name[2], name[3]
+        comment = fields[1].split(':') if len(fields) > 1 else []
+        barcode = comment[3] if len(comment) == 4 else ''
+    elif len(name) == 5:
+        # @instrument:lane:tile:x:y#barcode/read
+        flowcell, lane = name[0], name[1]
+        barcode = name[4].split('#')[1].split('/')[0] if '#' in name[4] else ''
+    else:
+        return read_group
+    read_group['ID'] = '.'.join([flowcell, lane, sample])
+    read_group['PU'] = '.'.join([x for x in [flowcell, lane, barcode] if x != ''])
+    return read_group
+
+
+def alignment_index(suffix):
+    """
+    The suffix of the index samtools and picard write for an alignment, `.crai` for CRAM and `.bai` for BAM
+    """
+    return suffix + (".crai" if suffix.endswith(".cram") else ".bai")
+
 
 class BaseWrapper(object):
     """
@@ -75,6 +129,13 @@ class BaseWrapper(object):
     stdout = ''
     args = []
     input = ''
+    # set on the shards of a step scattered over intervals of the reference and on the step gathering them
+    scatter_group = None
+    gather_group = None
+    # arguments of bioflows-shm-index when the aligner uses an index in shared memory
+    shm_args = None
+    # set by the workflow on the steps reading an intermediate that is removed once all its readers are done
+    cleanup_command = None
 
     def __init__(self, name, **kwargs):
 
@@ -107,7 +168,10 @@ class BaseWrapper(object):
         self.stdout = kwargs.get('stdout')
         self.stderr = kwargs.get('stderr')
         self.stdout_append = kwargs.get('stdout_append')
-        # self.pipe = kwargs.get('pipe')
+        # A command that stdout is piped into instead of being written to a file
+        self.pipe = kwargs.get('pipe')
+        # Extra settings for this step from the YAML, e.g. stream
+        self.step_parms = kwargs.get('step_parms', dict())
         self.env = os.environ.copy()
         self.max_concurrency = kwargs.get('max_concurrency', 1)
         self.prog_args = dict()
@@ -290,7 +354,9 @@ class BaseWrapper(object):
         # Write to a stdout file if it was set by the derived class.
         # Otherwise, stdout and stderr will be combined into the log file.
 
-        if self.stdout:
+        if self.pipe:
+            self.args.append('| ' + self.pipe)
+        elif self.stdout:
             stdout = os.path.abspath(self.stdout)
             self.args.append('1>' + stdout)
         elif self.stdout_append:
@@ -301,12 +367,90 @@ class BaseWrapper(object):
 
         cmd = ' '.join(chain(cmd, map(str, self.args)))
 
+        # Commands run before the program and when the job exits. The first command comes first in the run command
+        # so it can be run by srun
+        pre_cmds = []
+        exit_cmds = []
+        if self.step_parms.get('stage', False):
+            stage_dir = self.scratch_path('_'.join(['bioflows', self.input, self.prog_id, '$$']), **self.prog_args)
+            cmd = self.stage_command(cmd, stage_dir)
+            pre_cmds.append('mkdir -p ' + stage_dir)
+            exit_cmds.append('rm -rf ' + stage_dir)
+
         if add_command is not None:
             cmd += "; " + add_command
 
+        if self.shm_args is not None:
+            # the index is released when the job exits
+            shm_args = ' '.join(self.shm_args + ['--owner $$'])
+            pre_cmds.insert(0, "bioflows-shm-index acquire " + shm_args)
+            exit_cmds.insert(0, "bioflows-shm-index release " + shm_args)
+
+        if len(pre_cmds) > 0:
+            cmd = '; '.join(pre_cmds[:1] + ["trap '" + '; '.join(exit_cmds) + "' EXIT"] + pre_cmds[1:] + [cmd])
+
         self.run_command = cmd
         return
 
+    def scratch_path(self, name, **kwargs):
+        """
+        A path on the node local disk of the job, in the `scratch_dir` of the run_parms or `$TMPDIR`
+        :param name: the file or directory name
+        :param kwargs: Generic options passed to bioflows
+        """
+        return os.path.join(kwargs.get('scratch_dir') or SCRATCH_DIR, name)
+
+    def stage_command(self, cmd, stage_dir):
+        """
+        With `stage: True` for the step the program reads and writes its files on the node local disk. The inputs of
+        the program, with their indexes, are copied to `stage_dir` and the outputs are moved back when the program is
+        done, to a temporary name next to the output first and then renamed so a partly copied output is never seen.
+        Only the inputs and outputs given by `consumes` and `produces` that are in the command are staged, outputs
+        written in place of an input are left where they are.
+        :param cmd: the command of the program
+        :param stage_dir: the directory on the local disk
+        :return: the command with the copies of the inputs and outputs
+        """
+        dirs = [self.align_dir, self.qc_dir, os.path.join(self.cwd, 'fastq')]
+        names = [self.input, self.input + "_1", self.input + "_2"]
+
+        def staged_paths(suffixes):
+            paths = [os.path.join(d, n + x) for x in suffixes for d in dirs for n in names]
+            return list(OrderedDict.fromkeys(paths))
+
+        def with_indexes(path):
+            return [path] + [path + x for x in ['.bai', '.crai', '.csi', '.tbi']] + \
+                   [os.path.splitext(path)[0] + x for x in ['.bai', '.crai']]
+
+        inputs = [x for x in staged_paths(self.consumes()) if x in cmd]
+        outputs = staged_paths(self.produces())
+        in_place = set(inputs) & set(outputs)
+        inputs = [x for x in inputs if x not in in_place]
+        # outputs written next to an input, e.g. its index, end up in the staging directory too
+        outputs = [x for x in outputs if x not in in_place and
+                   (x in cmd or any(x.startswith(i + '.') or os.path.splitext(x)[0] == os.path.splitext(i)[0]
+                                    for i in inputs))]
+        if len(inputs) + len(outputs) == 0:
+            return cmd
+        for path in sorted(inputs + outputs, key=len, reverse=True):
+            cmd = cmd.replace(path, os.path.join(stage_dir, os.path.basename(path)))
+
+        stage_in = []
+        for path in inputs:
+            stage_in.append("for f in %s; do if [ -e $f ]; then cp $f %s/; fi; done" % (
+                ' '.join(OrderedDict.fromkeys(with_indexes(path))), stage_dir))
+        staged_names = set(os.path.basename(x) for p in inputs for x in with_indexes(p))
+        out_names = OrderedDict()
+        for path in outputs:
+            for name in with_indexes(os.path.basename(path)):
+                if name not in staged_names or name == os.path.basename(path):
+                    out_names.setdefault(os.path.dirname(path), OrderedDict())[name] = None
+        stage_out = []
+        for out_dir, names in out_names.iteritems():
+            stage_out.append("for f in %s; do if [ -e %s/$f ]; then mv %s/$f %s/.$f.tmp$$; mv %s/.$f.tmp$$ %s/$f; fi; "
+                             "done" % (' '.join(names), stage_dir, stage_dir, out_dir, out_dir, out_dir))
+        return '; '.join(stage_in + [cmd] + stage_out)
+
     def run_jar(self, mem=None):
         '''
         Special case of run() when the executable is a JAR file. This may be deprecated as we  will use conda for all
@@ -365,6 +509,11 @@ class BaseWrapper(object):
             else:
                 print "Error!!! you need to specify an input suffix"
                 sys.exit(0)
+        self.in_suffix = self.cram_suffix(self.in_suffix, **kwargs)
+        self.out_suffix = self.cram_suffix(self.out_suffix, **kwargs)
+        # Each shard of a scattered step writes its own output, e.g. sample.shard0003.gatk.recal.bam
+        if kwargs.get('shard') is not None:
+            self.out_suffix = ".shard" + kwargs['shard'] + self.out_suffix
         return
 
     def reset_add_args(self):
@@ -402,6 +551,122 @@ class BaseWrapper(object):
 
         return tmp_args
 
+    def cram_suffix(self, file_suffix, **kwargs):
+        """
+        With `alignment_format: cram` the BAMs in `cram_suffixes`, worked out by the workflow from the programs that
+        write and read them, are stored as CRAM
+        :param file_suffix: the suffix of the file
+        :return: the suffix ending in `.cram` instead of `.bam` if the file is stored as CRAM
+        """
+        if file_suffix in kwargs.get('cram_suffixes', []):
+            return file_suffix[:-len(".bam")] + ".cram"
+        return file_suffix
+
+    def reads_cram(self):
+        """
+        Whether the program can read its input alignments from CRAM, with the reference of the workflow
+        """
+        return False
+
+    def writes_cram(self):
+        """
+        Whether the program can write its output alignments as CRAM, with the reference of the workflow
+        """
+        return False
+
+    def stream_output_suffix(self, default, **kwargs):
+        """
+        The output suffix of an aligner that writes SAM to stdout, depending on whether the `stream` setting of the
+        step pipes the SAM into samtools
+        :param default: the suffix when the SAM is written to a file
+        :return: suffix
+        """
+        stream = kwargs.get('step_parms', dict()).get('stream')
+        if stream is None:
+            return default
+        elif stream == 'bam':
+            return '.bam'
+        elif stream == 'sorted_bam':
+            return '.srtd.bam'
+        print "Error!!! stream has to be bam or sorted_bam"
+        sys.exit(0)
+
+    def stream_to_bam(self, out_file):
+        """
+        Pipe the SAM written to stdout into samtools so only a BAM is written, sorted by coordinate with
+        `stream: sorted_bam`. Half of the memory of the job is left to the aligner.
+        :param out_file: the BAM file, or the CRAM file with `alignment_format: cram`
+        """
+        threads = self.job_parms.get('ncpus', 1)
+        stderr = os.path.join(self.log_dir, '_'.join([self.input, self.prog_id, 'err.log']))
+        # CRAM with `alignment_format: cram`, compressed against the reference
+        cram = ['--reference', self.prog_args['ref_fasta_path'], '-O', 'cram'] if out_file.endswith(".cram") else []
+        if self.step_parms.get('stream') == 'sorted_bam':
+            mem_per_thread = max(int(self.job_parms.get('mem', 4000) / threads / 2), 100)
+            tmp_prefix = self.scratch_path(os.path.basename(out_file) + '.tmp', **self.prog_args)
+            self.pipe = ' '.join(['samtools sort -@', str(threads), '-m', str(mem_per_thread) + 'M',
+                                  '-T', tmp_prefix] + cram + ['-o', out_file, '-', '2>>' + stderr])
+        else:
+            self.pipe = ' '.join(['samtools view -@', str(threads)] + (cram or ['-b']) +
+                                 ['-o', out_file, '-', '2>>' + stderr])
+        return
+
+    def read_group(self, input):
+        """
+        The read group of the sample from the first fastq, or None if read groups are turned off with
+        `read_groups: False` for the step
+        """
+        if not self.step_parms.get('read_groups', True):
+            return None
+        if self.paired_end:
+            fastq = os.path.join(self.cwd, 'fastq', input + "_1" + self.in_suffix)
+        else:
+            fastq = os.path.join(self.cwd, 'fastq', input + self.in_suffix)
+        return fastq_read_group(input, fastq, self.step_parms.get('library'))
+
+    def use_shared_index(self, tool, index, db_dir=None):
+        """
+        With `shared_memory: True` for the step, load the index of the aligner once per node into shared memory and
+        share it with the other jobs on the node. Each job keeps its full memory, as the shared memory is charged to
+        the job that loads the index. With `shm_reserve: False` the memory of the job is lowered by the size of the
+        index, which is kept in `shm_mem` and only added back once to the job running a pool of samples.
+        :param tool: `bwa` or `gsnap`
+        :param index: the BWA index prefix or the gsnap database name
+        :param db_dir: the gsnap database directory
+        :return: True if the index is shared
+        """
+        if not self.step_parms.get('shared_memory', False) or index is None:
+            return False
+        if not self.step_parms.get('shm_reserve', True):
+            index_mb = shm_index.index_size(tool, index, db_dir)
+            # the default job parameters are shared by all the steps
+            self.job_parms = copy.deepcopy(self.job_parms)
+            self.job_parms['mem'] = max(self.job_parms.get('mem', 2000) - index_mb, 1000)
+            self.job_parms['shm_mem'] = index_mb
+        self.shm_args = ['--tool', tool, '--index', index]
+        if db_dir is not None:
+            self.shm_args += ['--db-dir', db_dir]
+        return True
+
+    def consumes(self):
+        """
+        The file suffixes read by this program. Together with `produces` this is used by the workflow to work out
+        which steps depend on each other
+        :return: list of suffixes
+        """
+        if self.in_suffix in ['', 'default', None]:
+            return []
+        return [self.in_suffix]
+
+    def produces(self):
+        """
+        The file suffixes written by this program that later steps can read
+        :return: list of suffixes
+        """
+        if self.out_suffix in ['', 'default', None]:
+            return []
+        return [self.out_suffix]
+
 ### Third-party command line tools ###
 
 class FastQC(BaseWrapper):
@@ -468,13 +733,18 @@ class Gsnap(BaseWrapper):
         self.input = input
 
         ## Setup the inputs/output
-        self.update_file_suffix(input_default=".fq.gz", output_default=".sam", **kwargs)
+        self.update_file_suffix(input_default=".fq.gz", output_default=self.stream_output_suffix(".sam", **kwargs),
+                                **kwargs)
         ## set the checkpoint target file
         kwargs['target'] = input + "_" + name + "_" + self.out_suffix + "_" + hashlib.sha224(
             input + "_" + name + "_" + self.out_suffix).hexdigest() + ".txt"
 
         kwargs['stdout'] = os.path.join(kwargs['align_dir'], input + self.out_suffix)
         kwargs['prog_id'] = name
+        if kwargs.get('shard') is not None:
+            # A chunk of the reads of a scattered alignment
+            self.scatter_group = name
+            kwargs['prog_id'] = name + "_shard" + kwargs['shard']
 
         name = self.prog_name_clean(name)
         self.init(name, **kwargs)
@@ -494,8 +764,23 @@ class Gsnap(BaseWrapper):
 
         self.setup_args(*args)
 
-        self.args += args
+        read_group = None
+        if not any("--read-group" in a for a in args):
+            read_group = self.read_group(input)
+        if read_group is not None:
+            self.args += ["--read-group-id=" + read_group['ID'], "--read-group-name=" + read_group['SM'],
+                          "--read-group-library=" + read_group['LB'], "--read-group-platform=" + read_group['PL']]
 
+        self.args += args
+        # the genome database given with -d/--db and its directory with -D/--dir
+        db_args = ' '.join(args).replace('=', ' ').split()
+        db = [db_args[i + 1] for i, a in enumerate(db_args[:-1]) if a in ['-d', '--db']]
+        db_dir = [db_args[i + 1] for i, a in enumerate(db_args[:-1]) if a in ['-D', '--dir']]
+        self.use_shared_index('gsnap', (db or [None])[0], (db_dir or [None])[0])
+
+        if kwargs.get('shard') is not None:
+            # the chunk of the fastqs written by FastqSplit
+            self.in_suffix = ".shard" + kwargs['shard'] + self.in_suffix
         if self.paired_end:
             self.args.append(os.path.join(self.cwd, 'fastq', input + "_1" + self.in_suffix))
             self.args.append(os.path.join(self.cwd, 'fastq', input + "_2" + self.in_suffix))
@@ -503,6 +788,8 @@ class Gsnap(BaseWrapper):
             self.args.append(os.path.join(self.cwd, 'fastq', input + self.in_suffix))
         # self.cmd = ' '.join(chain(self.cmd, map(str, self.args), map(str,input)))
 
+        if self.step_parms.get('stream') is not None:
+            self.stream_to_bam(kwargs['stdout'])
         self.setup_run()
         return
 
@@ -524,12 +811,18 @@ class Gsnap(BaseWrapper):
             pass
         else:
             self.args += ["-N1"]
-        if any("--use-shared-memory=0" in a for a in args):
+        if any("--use-shared-memory" in a for a in args):
             pass
+        elif self.step_parms.get('shared_memory', False):
+            self.args += ["--use-shared-memory=1"]
         else:
             self.args += ["--use-shared-memory=0"]
         return
 
+    def writes_cram(self):
+        # the SAM of the aligner is only written as CRAM when it is piped into samtools
+        return self.step_parms.get('stream') is not None
+
 
 class Kneaddata(BaseWrapper):
     """
@@ -545,21 +838,29 @@ class Kneaddata(BaseWrapper):
 
 class Biobambam(BaseWrapper):
     """
-    Wrapper class to mark duplicates in a bam using biobambam
+    Wrapper class to mark duplicates in a bam using biobambam. `bamsormadup` sorts, marks duplicates and indexes
+    the BAM written by the aligner in one pass.
     """
     # TODO: Clean up
 
     def __init__(self, name, input, *args, **kwargs):
         self.input = input
+        self.subcommand = name.split("_")[0]
         # TODO add update to input/output suffixes here
         if name.split("_")[0] == "bammarkduplicates2":
             self.update_file_suffix(input_default=".srtd.bam", output_default=".dup.srtd.bam", **kwargs)
         elif name.split("_")[0] == "bamsort":
             self.update_file_suffix(input_default=".bam", output_default=".srtd.bam", **kwargs)
+        elif name.split("_")[0] == "bamsormadup":
+            self.update_file_suffix(input_default=".bam", output_default=".dup.srtd.bam", **kwargs)
 
         kwargs['target'] = input + "_" + name + "_" + self.out_suffix + "_" + hashlib.sha224(
             input + "_" + name + "_" + self.out_suffix).hexdigest() + ".txt"
-        kwargs['stdout'] = os.path.join(kwargs['log_dir'], input + "_" + name + '.log')
+        if self.subcommand == "bamsormadup":
+            # bamsormadup writes the BAM to stdout
+            kwargs['stdout'] = os.path.join(kwargs['align_dir'], input + self.out_suffix)
+        else:
+            kwargs['stdout'] = os.path.join(kwargs['log_dir'], input + "_" + name + '.log')
         kwargs['prog_id'] = name
         name = self.prog_name_clean(name)
 
@@ -570,13 +871,30 @@ class Biobambam(BaseWrapper):
         else:
             self.job_parms.update({'mem': 10000, 'time': 300, 'ncpus': 1})
 
-        self.args = ["I=" + os.path.join(self.align_dir, input + self.in_suffix),
-                     "O=" + os.path.join(self.align_dir, input + self.out_suffix),
-                     "M=" + os.path.join(self.qc_dir, input + ".dup.metrics.txt")]
-        self.args += args
+        if self.subcommand == "bamsormadup":
+            out_file = os.path.join(self.align_dir, input + self.out_suffix)
+            self.args = ["threads=" + str(self.job_parms.get('ncpus', 1)),
+                         "inputformat=" + ("sam" if self.in_suffix.endswith(".sam") else "bam"),
+                         "indexfilename=" + out_file + ".bai",
+                         "M=" + os.path.join(self.qc_dir, input + ".dup.metrics.txt"),
+                         "tmpfile=" + self.scratch_path(os.path.basename(out_file) + ".tmp", **kwargs)]
+            self.args += args
+            self.args.append("< " + os.path.join(self.align_dir, input + self.in_suffix))
+        else:
+            self.args = ["I=" + os.path.join(self.align_dir, input + self.in_suffix),
+                         "O=" + os.path.join(self.align_dir, input + self.out_suffix),
+                         "M=" + os.path.join(self.qc_dir, input + ".dup.metrics.txt")]
+            if not any(str(x).startswith("tmpfile=") for x in args):
+                self.args += ["tmpfile=" + self.scratch_path(input + self.out_suffix + ".tmp", **kwargs)]
+            self.args += args
         self.setup_run()
         return
 
+    def produces(self):
+        if self.subcommand == "bamsormadup":
+            return [self.out_suffix, self.out_suffix + ".bai"]
+        return BaseWrapper.produces(self)
+
 
 
 
@@ -730,6 +1048,7 @@ class HtSeqCounts(BaseWrapper):
     # TODO: Clean up
     cmd = ''
     args = []
+    counts_source = 'htseq'
 
     def __init__(self, name, input, *args, **kwargs):
         self.input = input
@@ -744,6 +1063,8 @@ class HtSeqCounts(BaseWrapper):
 
         kwargs['stdout'] = os.path.join(kwargs.get('expression_dir', os.path.join(kwargs.get('work_dir'), 'expression'))
                                         , input + "_htseq_counts")
+        # read by the count matrix of the project
+        self.counts_file = kwargs['stdout']
 
         kwargs['prog_id'] = name
         name = self.prog_name_clean(name)
@@ -785,7 +1106,8 @@ class Bwa(BaseWrapper):
 
     def __init__(self, name, input, *args, **kwargs):
         self.input = input
-        self.update_file_suffix(input_default=".fq.gz", output_default=".sam", **kwargs)
+        self.update_file_suffix(input_default=".fq.gz", output_default=self.stream_output_suffix(".sam", **kwargs),
+                                **kwargs)
 
         ## set the checkpoint target file
         kwargs['target'] = input + "_" + name + "_" + self.out_suffix + "_" + hashlib.sha224(
@@ -793,6 +1115,10 @@ class Bwa(BaseWrapper):
         kwargs['stdout'] = os.path.join(kwargs['align_dir'], input + self.out_suffix)
 
         kwargs['prog_id'] = name
+        if kwargs.get('shard') is not None:
+            # A chunk of the reads of a scattered alignment
+            self.scatter_group = name
+            kwargs['prog_id'] = name + "_shard" + kwargs['shard']
         name = self.prog_name_clean(name)
 
         new_name = ' '.join(name.split("_"))
@@ -809,17 +1135,127 @@ class Bwa(BaseWrapper):
 
         #TODO add update default args if needed
 
+        # Set the read groups here so the BAM does not have to be rewritten by AddOrReplaceReadGroups
+        read_group = None
+        if not any("-R" in a.split() for a in args):
+            read_group = self.read_group(input)
+        if read_group is not None:
+            self.args += ["-R '@RG\\t" + '\\t'.join([k + ':' + v for k, v in read_group.iteritems()]) + "'"]
+
         self.args += args
+        # the index prefix is the only argument that is not an option
+        index = [a for a in args if not a.startswith('-')]
+        self.use_shared_index('bwa', (index or [None])[-1])
 
+        if kwargs.get('shard') is not None:
+            # the chunk of the fastqs written by FastqSplit
+            self.in_suffix = ".shard" + kwargs['shard'] + self.in_suffix
         if self.paired_end:
             self.args.append(os.path.join(self.cwd, 'fastq', input + "_1" + self.in_suffix))
             self.args.append(os.path.join(self.cwd, 'fastq', input + "_2" + self.in_suffix))
         else:
             self.args.append(os.path.join(self.cwd, 'fastq', input + self.in_suffix))
 
+        if self.step_parms.get('stream') is not None:
+            self.stream_to_bam(kwargs['stdout'])
         self.setup_run()
         return
 
+    def writes_cram(self):
+        # the SAM of the aligner is only written as CRAM when it is piped into samtools
+        return self.step_parms.get('stream') is not None
+
+
+class FastqSplit(BaseWrapper):
+    """
+    Splits the fastqs of a sample into chunks with the same number of reads, for aligning the chunks as separate jobs.
+    The number of reads per chunk is worked out from the read count when the job runs, so the chunks are balanced
+    whatever the depth of the sample. The pairs of paired end fastqs stay in the same chunk.
+    """
+
+    def __init__(self, input, step, n_chunks, **kwargs):
+        """
+        :param input: the sample id
+        :param step: the wrapper of the aligner run on all the reads
+        :param n_chunks: the number of chunks
+        :param kwargs: Generic options passed to bioflows
+        """
+        self.input = input
+        self.in_suffix = step.in_suffix
+        self.out_suffix = ''
+        self.chunk_suffixes = [".shard%04d" % i + step.in_suffix for i in range(n_chunks)]
+
+        name = step.prog_id + "_split"
+        kwargs['target'] = input + "_" + name + "_" + str(n_chunks) + "_" + hashlib.sha224(
+            input + "_" + name + "_" + str(n_chunks)).hexdigest() + ".txt"
+        kwargs['prog_id'] = name
+        self.init('split', **kwargs)
+        self.job_parms = copy.deepcopy(step.job_parms)
+        self.job_parms.update({'mem': 2000, 'ncpus': 2})
+
+        fastq_dir = os.path.join(self.cwd, 'fastq')
+        reads = ["_1", "_2"] if self.paired_end else [""]
+        stderr = os.path.join(self.log_dir, '_'.join([input, self.prog_id, 'err.log']))
+        first_fastq = os.path.join(fastq_dir, input + reads[0] + self.in_suffix)
+        chunk_files = ' '.join([os.path.join(fastq_dir, input + read + x) for read in reads
+                                for x in self.chunk_suffixes])
+        # The job runs the first command with srun, so the command line starts with a program rather than a
+        # variable assignment. Chunks left by an earlier run are removed first.
+        cmds = ["rm -f " + chunk_files,
+                "lines=$(( ($(zcat " + first_fastq + " | wc -l) / 4 + " + str(n_chunks - 1) + ") / " +
+                str(n_chunks) + " * 4 ))",
+                "[ $lines -gt 0 ] || lines=4"]
+        for read in reads:
+            # e.g. sample_1.fq.gz is split into sample_1.shard0000.fq.gz, sample_1.shard0001.fq.gz, ...
+            cmds.append(' '.join(["zcat", os.path.join(fastq_dir, input + read + self.in_suffix), "|",
+                                  "split -l $lines -d -a 4 --additional-suffix=" + self.in_suffix,
+                                  "--filter='gzip -1 > $FILE'", "-",
+                                  os.path.join(fastq_dir, input + read + ".shard"), "2>>" + stderr]))
+        # Samples with fewer reads than chunks get empty chunks
+        cmds.append("for f in " + chunk_files + "; do [ -e $f ] || gzip -c < /dev/null > $f; done")
+        self.run_command = '; '.join(cmds)
+        return
+
+    def produces(self):
+        return list(self.chunk_suffixes)
+
+
+class AlignmentMerge(BaseWrapper):
+    """
+    Merges the sorted BAMs of the chunks of a scattered alignment into the file the aligner writes when run on all
+    the reads, and writes the checkpoint of the aligner so nothing downstream changes.
+    """
+
+    def __init__(self, input, step, chunks, **kwargs):
+        """
+        :param input: the sample id
+        :param step: the wrapper of the aligner run on all the reads
+        :param chunks: the wrappers of the aligner run on the chunks
+        :param kwargs: Generic options passed to bioflows
+        """
+        self.input = input
+        self.gather_group = step.prog_id
+        self.in_suffix = step.in_suffix
+        self.out_suffix = step.out_suffix
+        self.chunk_suffixes = [x.out_suffix for x in chunks]
+
+        kwargs['target'] = os.path.basename(step.luigi_target)
+        kwargs['prog_id'] = step.prog_id + "_merge"
+        self.init('samtools merge', **kwargs)
+        self.job_parms = copy.deepcopy(step.job_parms)
+        self.job_parms['ncpus'] = min(self.job_parms.get('ncpus', 1), 8)
+
+        self.args = ['-@ ' + str(self.job_parms['ncpus']), '-c', '-p', '-f']
+        if self.out_suffix.endswith('.sam'):
+            self.args += ['-O SAM']
+        self.args += [os.path.join(kwargs['align_dir'], input + self.out_suffix)]
+        self.args += [os.path.join(kwargs['align_dir'], input + x) for x in self.chunk_suffixes]
+        self.setup_run()
+        return
+
+    def consumes(self):
+        return list(self.chunk_suffixes)
+
 
 class BedtoolsCounts(BaseWrapper):
     """
@@ -848,6 +1284,7 @@ class FeatureCounts(BaseWrapper):
     """
 
     # TODO: Clean up
+    counts_source = 'featureCounts'
 
     def __init__(self, name, input, *args, **kwargs):
         self.input = input
@@ -867,11 +1304,121 @@ class FeatureCounts(BaseWrapper):
         self.reset_add_args()
         self.add_args = self.update_default_args(default_args, *args, **kwargs)
         self.args += self.add_args
+        # read by the count matrix of the project
+        self.counts_file = os.path.join(
+            kwargs.get('expression_dir', os.path.join(kwargs.get('work_dir'), 'expression')), input + self.out_suffix)
+        self.bam_file = os.path.join(kwargs.get('align_dir'), input + self.in_suffix)
         self.args += ["-a " + kwargs.get('gtf_file'),
-                      "-o " + os.path.join(
-                          kwargs.get('expression_dir', os.path.join(kwargs.get('work_dir'), 'expression')),
-                          input + self.out_suffix),
-                      os.path.join(kwargs.get('align_dir'), input + self.in_suffix)]
+                      "-o " + self.counts_file,
+                      self.bam_file]
+        self.setup_run()
+        return
+
+
+class FeatureCountsBatch(BaseWrapper):
+    """
+    Runs featureCounts once on the BAMs of a batch of samples, so the GTF is only read once, and splits the counts
+    and the summary back into the files featureCounts writes for each sample on its own. The checkpoint of each
+    sample is written once its files are in place.
+    """
+
+    def __init__(self, cohort, batch, members, **kwargs):
+        """
+        :param cohort: the name of the project
+        :param batch: the index of the batch
+        :param members: the `FeatureCounts` wrappers of the samples of the batch
+        :param kwargs: Generic options passed to bioflows
+        """
+        self.input = cohort
+        self.members = members
+        name = members[0].prog_id + "_batch%04d" % batch
+        kwargs['prog_id'] = name
+        kwargs['target'] = cohort + "_" + name + "_" + hashlib.sha224(
+            cohort + "_" + name + "_" + ','.join([x.luigi_target for x in members])).hexdigest() + ".txt"
+        kwargs['stdout'] = os.path.join(kwargs['log_dir'], cohort + "_" + name + '.log')
+        self.init('featureCounts', **kwargs)
+        self.job_parms = copy.deepcopy(members[0].job_parms)
+
+        batch_counts = os.path.join(os.path.dirname(members[0].counts_file), cohort + "_" + name + ".featureCounts.txt")
+        self.args = list(members[0].add_args)
+        if not any(str(x).split(' ')[0] == '-T' for x in self.args):
+            self.args += ["-T " + str(self.job_parms.get('ncpus', 1))]
+        self.args += ["-a " + kwargs.get('gtf_file'), "-o " + batch_counts]
+        self.args += [x.bam_file for x in members]
+
+        # The first six columns are the gene and its length, then one column per BAM
+        split_cmds = []
+        for i, prog in enumerate(members):
+            split_cmds.append("{ head -n 1 %s; tail -n +2 %s | cut -f1-6,%d; } > %s" %
+                              (batch_counts, batch_counts, 7 + i, prog.counts_file))
+            split_cmds.append("cut -f1,%d %s.summary > %s.summary" % (2 + i, batch_counts, prog.counts_file))
+            split_cmds.append("echo 'DONE' > " + prog.luigi_target)
+        self.setup_run(add_command='; '.join(split_cmds))
+        return
+
+
+class CountMatrixBuilder(BaseWrapper):
+    """
+    Adds the counts of the samples to the genes x samples count matrix of the project with `bioflows-count-matrix`,
+    see `count_matrix`. Samples already in the matrix are only read again if their counts
+    file has changed.
+    """
+
+    def __init__(self, cohort, source, sample_list, **kwargs):
+        """
+        :param cohort: the name of the project, used in place of the sample id
+        :param source: `htseq` or `featureCounts`
+        :param sample_list: file with the sample id and counts file of each sample, tab separated
+        :param kwargs: Generic options passed to bioflows, `cohort_digest` identifies the samples so the step is run
+        again when samples are added
+        """
+        self.input = cohort
+        name = "count_matrix_" + source
+        kwargs['prog_id'] = name
+        kwargs['target'] = cohort + "_" + name + "_" + hashlib.sha224(
+            cohort + "_" + name + "_" + kwargs.get('cohort_digest', '')).hexdigest() + ".txt"
+        kwargs['stdout'] = os.path.join(kwargs['log_dir'], cohort + "_" + name + '.log')
+        self.init('bioflows-count-matrix', **kwargs)
+        self.job_parms = copy.deepcopy(self.job_parms)
+        self.job_parms.update({'mem': 2000, 'time': 60, 'ncpus': 1})
+
+        matrix = os.path.join(kwargs['expression_dir'], cohort + "_" + source + "_matrix")
+        self.args = ["--matrix " + matrix, "--source " + source, "--samples " + sample_list,
+                     "--tsv " + matrix + ".tsv"]
+        if kwargs.get('sparse', False):
+            self.args += ["--sparse"]
+        self.setup_run()
+        return
+
+
+class ReferenceIndex(BaseWrapper):
+    """
+    Builds an index of the reference into the reference cache with `bioflows-ref-cache`, see `reference_cache`. The
+    checkpoint is kept next to the entry in the cache, so an index built by another workflow is not built again.
+    """
+
+    def __init__(self, cohort, index, cache_dir, key, sources, **kwargs):
+        """
+        :param cohort: the name of the project, used in place of the sample id
+        :param index: the index to build, `fasta`, `bwa`, `salmon` or `gsnap`
+        :param cache_dir: the directory of the cache
+        :param key: the name of the entry of the index in the cache
+        :param sources: dictionary of the source files, `fasta`, `gtf` and `transcripts`
+        :param kwargs: Generic options passed to bioflows, `ref_job_parms` are the job parameters of the build
+        """
+        self.input = cohort
+        name = "ref_cache_" + index
+        kwargs['prog_id'] = name
+        kwargs['target'] = os.path.join(cache_dir, index, key + ".done")
+        kwargs['stdout'] = os.path.join(kwargs['log_dir'], cohort + "_" + name + '.log')
+        self.init('bioflows-ref-cache build', **kwargs)
+        self.job_parms = copy.deepcopy(self.job_parms)
+        self.job_parms.update({'mem': 16000, 'time': 720, 'ncpus': 8})
+        self.job_parms.update(kwargs.get('ref_job_parms') or dict())
+
+        self.args = ["--cache-dir " + cache_dir, "--index " + index, "--key " + key,
+                     "--threads " + str(self.job_parms['ncpus'])]
+        self.args += ["--%s %s" % (k, v) for k, v in sorted(sources.iteritems()) if v is not None]
         self.setup_run()
         return
 
@@ -1,4 +1,4 @@
-# import copy
+import copy
 import hashlib
 import os
 
@@ -14,6 +14,15 @@ from wrappers import BaseWrapper
 # import utils
 
 
+# The programs gathering the outputs of the steps that can be scattered over intervals of the reference
+GATHER_TOOLS = {'BaseRecalibrator': 'GatherBQSRReports',
+                'PrintReads': 'GatherBamFiles',
+                'HaplotypeCaller': 'MergeVcfs'}
+# The steps whose shards can end inside a contig, the others are split on whole contigs so the reads overlapping a
+# cut are not written twice
+SPLIT_CONTIG_TOOLS = ['BaseRecalibrator', 'HaplotypeCaller']
+
+
 class Gatk(BaseWrapper):
     """
         A wrapper for GATK
@@ -24,12 +33,18 @@ class Gatk(BaseWrapper):
         self.input = input
 
         kwargs['prog_id'] = name
+        # A shard of a step scattered over intervals of the reference
+        if kwargs.get('shard') is not None:
+            self.scatter_group = name
+            kwargs['prog_id'] = name + "_shard" + kwargs['shard']
         # Remove the round from the name
         name = self.prog_name_clean(name)
 
         ## set the checkpoint target file
 
         self.make_target(name, input, *args, **kwargs)
+        if kwargs.get('scatter_interval') is not None:
+            self.add_interval_args(name, *args, **kwargs)
         kwargs['target'] = self.target
         kwargs['stdout'] = self.stdout
 
@@ -81,6 +96,8 @@ class Gatk(BaseWrapper):
 
     def make_target(self, name, input, *args, **kwargs):
         name_str = "_" + name + "_"
+        self.subcommand = name.split('_')[1]
+        self.bqsr = "-BQSR" in args
         if name.split('_')[1] == "RealignerTargetCreator":
             self.update_file_suffix(input_default=".dedup.rg.srtd.bam", output_default='_realign_targets.intervals',
                                     **kwargs)
@@ -133,6 +150,46 @@ class Gatk(BaseWrapper):
             self.add_args_analyze_covariates(input, *args, **kwargs)
         return
 
+    def scatterable(self):
+        """
+        Whether the step can be run on interval shards of the reference and gathered by `GatkGather`. The recalibration
+        tables are gathered with the GATK4 GatherBQSRReports, so BaseRecalibrator is only scattered with GATK4
+        """
+        if self.subcommand == "BaseRecalibrator":
+            return self.prog_id.split('_')[0] == "gatk4" and not self.bqsr
+        return self.subcommand in GATHER_TOOLS.keys()
+
+    def add_interval_args(self, name, *args, **kwargs):
+        # Restrict the step to the shard, intersected with the intervals given in the options, e.g. exome targets
+        self.add_args += ["-L " + kwargs['scatter_interval']]
+        if any(str(x).split(' ')[0] in ['-L', '--intervals', '-intervals'] for x in args):
+            if name.split('_')[0] == "gatk4":
+                self.add_args += ["--interval-set-rule INTERSECTION"]
+            else:
+                self.add_args += ["-isr INTERSECTION"]
+        return
+
+    def consumes(self):
+        # Files used by GATK that are not given by the input suffix
+        if self.subcommand == "IndelRealigner":
+            return [self.in_suffix, '_realign_targets.intervals']
+        elif self.subcommand == "BaseRecalibrator" and self.bqsr:
+            return [self.in_suffix, self.out_suffix]
+        elif self.subcommand == "PrintReads":
+            return [self.in_suffix, '_recal_table.txt']
+        elif self.subcommand == "AnalyzeCovariates":
+            return [self.in_suffix, '_post' + self.in_suffix]
+        return BaseWrapper.consumes(self)
+
+    def reads_cram(self):
+        # the reference is always given with -R, the BAMs written by GATK are gathered with picard as BAM
+        return True
+
+    def produces(self):
+        if self.subcommand == "BaseRecalibrator" and self.bqsr:
+            return ['_post' + self.out_suffix]
+        return BaseWrapper.produces(self)
+
     def add_args_realigner_target_creator(self, input, *args, **kwargs):
         # gatk -Xmx20G -T RealignerTargetCreator -R $my.fasta -I $my.bam\
         #  -known /gpfs/data/cbc/references/ftp.broadinstitute.org/bundle/hg19/Mills_and_1000G_gold_standard.indels.hg19.sites.vcf \
@@ -271,3 +328,121 @@ class Gatk(BaseWrapper):
                          "-plots " + os.path.join(kwargs.get('gatk_dir'), input + self.out_suffix)
                          ]
         return
+
+
+class GatkGather(BaseWrapper):
+    """
+    Gathers the outputs of a GATK step that was run on interval shards of the reference into the file the step writes
+    when run on the whole genome, and writes the checkpoint of the whole genome step so nothing downstream changes.
+    The shards are given in the order of the reference, with the unmapped reads last for PrintReads.
+    """
+
+    def __init__(self, input, step, shards, **kwargs):
+        """
+        :param input: the sample id
+        :param step: the `Gatk` wrapper of the step run on the whole genome
+        :param shards: the `Gatk` wrappers of the shards
+        :param kwargs: Generic options passed to bioflows
+        """
+        self.input = input
+        self.subcommand = GATHER_TOOLS[step.subcommand]
+        self.gather_group = step.prog_id
+        self.in_suffix = step.in_suffix
+        self.out_suffix = step.out_suffix
+        self.shard_suffixes = [x.out_suffix for x in shards]
+
+        kwargs['target'] = step.target
+        kwargs['prog_id'] = step.prog_id + "_gather"
+        kwargs['stdout'] = os.path.join(kwargs['log_dir'], input + "_" + kwargs['prog_id'] + '.log')
+        if self.subcommand == "GatherBQSRReports":
+            self.init('gatk4 ' + self.subcommand, **kwargs)
+        else:
+            self.init('picard ' + self.subcommand, **kwargs)
+        self.job_parms = copy.deepcopy(step.job_parms)
+        self.job_parms['ncpus'] = 1
+
+        out_dir = kwargs.get('gatk_dir')
+        if self.subcommand == "GatherBamFiles":
+            out_dir = kwargs.get('align_dir')
+        shard_files = [os.path.join(out_dir, input + x) for x in self.shard_suffixes]
+        out_file = os.path.join(out_dir, input + self.out_suffix)
+
+        if self.subcommand == "GatherBQSRReports":
+            self.args = ["-I " + x for x in shard_files] + ["-O " + out_file]
+        else:
+            self.args = [' -Xmx' + str(self.job_parms['mem']) + 'M']
+            self.args += ["I=" + x for x in shard_files] + ["O=" + out_file]
+            if self.subcommand == "GatherBamFiles":
+                # PrintReads indexes its output
+                self.args += ["CREATE_INDEX=true"]
+        self.setup_run()
+        return
+
+    def consumes(self):
+        return list(self.shard_suffixes)
+
+
+class GatkCohort(BaseWrapper):
+    """
+    A step of the joint genotyping of the gVCFs of a cohort, run on one interval shard of the reference:
+    CombineGVCFs of a batch of gVCFs, GenomicsDBImport of all the gVCFs, GenotypeGVCFs of the combined gVCF or
+    GenomicsDB workspace, or MergeVcfs of the genotyped shards.
+    """
+
+    def __init__(self, name, cohort, step_id, inputs, output, *args, **kwargs):
+        """
+        :param name: the GATK program and the tool, e.g. gatk4_CombineGVCFs or picard_MergeVcfs
+        :param cohort: the name of the cohort, used in place of the sample id
+        :param step_id: identifies the step among the steps of the cohort, e.g. shard0003_l1_b0002
+        :param inputs: the gVCFs or VCFs read by the step
+        :param output: the file or GenomicsDB workspace written by the step
+        :param args: options for the tool from the YAML
+        :param kwargs: Generic options passed to bioflows, `cohort_digest` identifies the gVCFs of the cohort so all
+        the steps are run again when samples are added
+        """
+        self.input = cohort
+        self.subcommand = name.split('_')[1]
+        self.in_suffix = ''
+        self.out_suffix = ''
+        self.output = output
+
+        kwargs['prog_id'] = name + "_" + step_id
+        kwargs['target'] = cohort + "_" + kwargs['prog_id'] + "_" + hashlib.sha224(
+            cohort + "_" + kwargs['prog_id'] + "_" + output + "_" + kwargs.get('cohort_digest', '')
+        ).hexdigest() + ".txt"
+        kwargs['stdout'] = os.path.join(kwargs['log_dir'], cohort + "_" + kwargs['prog_id'] + '.log')
+        kwargs['job_parms'] = copy.deepcopy(kwargs['job_parms'])
+        if kwargs.get('add_job_parms'):
+            kwargs['job_parms'].update(kwargs.get('add_job_parms'))
+        mem_str = '-Xmx' + str(kwargs['job_parms'].get('mem', 10000)) + 'M'
+
+        tool = name.split('_')[0]
+        if tool == "picard":
+            self.init(' '.join([tool, self.subcommand]), **kwargs)
+            self.args = [' ' + mem_str] + ["I=" + x for x in inputs] + ["O=" + output]
+            self.setup_run()
+            return
+
+        gatk4 = tool == "gatk4"
+        if gatk4:
+            self.init(' '.join([tool, '--java-options "' + mem_str + '"', self.subcommand]), **kwargs)
+        else:
+            self.init(' '.join([tool, ' ' + mem_str, '-T', self.subcommand]), **kwargs)
+
+        self.args = ["-R " + kwargs.get("ref_fasta_path")]
+        if kwargs.get('interval') is not None:
+            self.args += ["-L " + kwargs['interval']]
+            if gatk4 and self.subcommand == "GenotypeGVCFs":
+                # a variant spanning the end of a shard is only written by the shard it starts in
+                self.args += ["--only-output-calls-starting-in-intervals"]
+        if self.subcommand == "GenomicsDBImport":
+            self.args += ["--sample-name-map " + kwargs['sample_map'],
+                          "--batch-size " + str(kwargs.get('batch_size', 50)),
+                          "--genomicsdb-workspace-path " + output,
+                          "--overwrite-existing-genomicsdb-workspace true"]
+        else:
+            self.args += [("-V " if gatk4 else "--variant ") + x for x in inputs]
+            self.args += [("-O " if gatk4 else "-o ") + output]
+        self.args += args
+        self.setup_run()
+        return
@@ -1,8 +1,9 @@
-# import copy
+import copy
 import hashlib
 import os
+import sys
 
-from wrappers import BaseWrapper
+from wrappers import BaseWrapper, alignment_index
 
 
 # import subprocess
@@ -14,6 +15,19 @@ from wrappers import BaseWrapper
 # import utils
 
 
+# The metric programs that CollectMultipleMetrics can run, with the file written by CollectMultipleMetrics for each
+# output argument of the program when run on its own
+MULTIPLE_METRICS = {'CollectAlignmentSummaryMetrics': {'OUTPUT': '.alignment_summary_metrics'},
+                    'CollectInsertSizeMetrics': {'OUTPUT': '.insert_size_metrics',
+                                                 'HISTOGRAM_FILE': '.insert_size_histogram.pdf'},
+                    'CollectGcBiasMetrics': {'OUTPUT': '.gc_bias.detail_metrics', 'CHART': '.gc_bias.pdf',
+                                             'SUMMARY_OUTPUT': '.gc_bias.summary_metrics'},
+                    'MeanQualityByCycle': {'OUTPUT': '.quality_by_cycle_metrics',
+                                           'CHART_OUTPUT': '.quality_by_cycle.pdf'},
+                    'QualityScoreDistribution': {'OUTPUT': '.quality_distribution_metrics',
+                                                 'CHART_OUTPUT': '.quality_distribution.pdf'}}
+
+
 class Picard(BaseWrapper):
     """
         A wrapper for picardtools
@@ -32,6 +46,8 @@ class Picard(BaseWrapper):
         # TODO add remove duprun function
 
         kwargs['prog_id'] = name
+        # the options given in the workflow_sequence, on top of the defaults of the program
+        self.user_args = [x for x in args if x.strip() != '']
         # Remove the round from the name
         name = self.prog_name_clean(name)
 
@@ -61,9 +77,18 @@ class Picard(BaseWrapper):
             self.args += [' -Xmx10000M']
 
         kwargs['source'] = input + self.in_suffix + hashlib.sha224(input + self.in_suffix).hexdigest() + ".txt"
+        # CRAM is read and written with the reference
+        cram = [x for x in [self.in_suffix, self.out_suffix] if x.endswith(".cram")]
+        if len(cram) > 0 and not any(a.startswith(("REFERENCE_SEQUENCE=", "R=")) for a in self.add_args):
+            self.add_args += ["REFERENCE_SEQUENCE=" + kwargs.get("ref_fasta_path")]
         self.args += self.add_args
 
-        self.setup_run()
+        if self.subcommand == "MarkDuplicates" and self.out_suffix.endswith(".cram"):
+            # picard does not index CRAM
+            self.setup_run(add_command="samtools index " + os.path.join(kwargs.get('align_dir'),
+                                                                         input + self.out_suffix))
+        else:
+            self.setup_run()
         return
 
     def make_target(self, name, input, *args, **kwargs):
@@ -75,6 +100,7 @@ class Picard(BaseWrapper):
         :param kwargs: Generic options passed to bioflows
         :return:
         '''
+        self.subcommand = name.split('_')[1]
         if name.split('_')[1] == "CollectWgsMetrics":
             self.update_file_suffix(input_default=".dup.srtd.bam", output_default='_wgs_stats_picard.txt', **kwargs)
             self.target = input + "_" + name + "_" + self.out_suffix + "_" + hashlib.sha224(
@@ -95,7 +121,9 @@ class Picard(BaseWrapper):
             self.add_args_quality_score_distribution(input, *args, **kwargs)
 
         elif name.split('_')[1] == "MarkDuplicates":
-            self.update_file_suffix(input_default=".rg.srtd.bam", output_default=".rg.srtd.bam", **kwargs)
+            # the output suffix is only known once the options are read, see add_args_markduplicates
+            self.update_file_suffix(input_default=".rg.srtd.bam", output_default=".rg.srtd.bam",
+                                    **dict(kwargs, cram_suffixes=[]))
             self.target = input + "_" + name + "_" + 'mark_dup_picard.txt' + "_" + hashlib.sha224(
                 input + "_" + name + "_" + 'mark_dup_picard.txt').hexdigest() + ".txt"
             self.add_args_markduplicates(input, *args, **kwargs)
@@ -148,6 +176,20 @@ class Picard(BaseWrapper):
             self.add_args_collect_insert_size_metrics(input, *args, **kwargs)
         return
 
+    def produces(self):
+        if self.subcommand == "BuildBamIndex":
+            return [self.in_suffix + ".bai"]
+        elif self.subcommand == "MarkDuplicates":
+            # CREATE_INDEX=true is always set, CRAM is indexed with samtools
+            return [self.out_suffix, alignment_index(self.out_suffix)]
+        return BaseWrapper.produces(self)
+
+    def reads_cram(self):
+        return self.subcommand != "BuildBamIndex"
+
+    def writes_cram(self):
+        return self.subcommand in ["MarkDuplicates", "AddOrReplaceReadGroups"]
+
     def add_args_collect_alignment_summary_metrics(self, input, *args, **kwargs):
         self.reset_add_args()
         self.add_args = ["INPUT=" + os.path.join(kwargs.get('align_dir'), input + self.in_suffix),
@@ -202,7 +244,7 @@ class Picard(BaseWrapper):
         self.reset_add_args()
 
         self.add_args = ["INPUT=" + os.path.join(kwargs.get('align_dir'), input + self.in_suffix),
-                         "OUTPUT=" + os.path.join(kwargs.get('qc_dir'), input + + self.out_suffix + '.txt'),
+                         "OUTPUT=" + os.path.join(kwargs.get('qc_dir'), input + self.out_suffix + '.txt'),
                          "REFERENCE_SEQUENCE=" + kwargs.get("ref_fasta_path"),
                          "CHART_OUTPUT=" + os.path.join(kwargs.get('qc_dir'), input + self.out_suffix + '.pdf'),
                          "VALIDATION_STRINGENCY=LENIENT"]
@@ -235,20 +277,21 @@ class Picard(BaseWrapper):
     def add_args_markduplicates(self, input, *args, **kwargs):
         self.reset_add_args()
 
-        self.add_args = ["INPUT=" + os.path.join(kwargs.get('align_dir'), input + self.in_suffix),
-                         "M=" + os.path.join(kwargs.get('qc_dir'), input + '_mark_duplicates_picard.txt'),
-                         "CREATE_INDEX=true VALIDATION_STRINGENCY=LENIENT"
-                         ]
         if "REMOVE_DUPLICATES=true" in args:
-            # TODO add update to input/output suffixes here
             self.out_suffix = ".dedup" + self.out_suffix
-
-            self.add_args += ["OUTPUT=" + os.path.join(kwargs.get('align_dir'), input + self.out_suffix)]
         else:
-            # TODO add update to input/output suffixes here
             self.out_suffix = ".picdup" + self.out_suffix
+        self.in_suffix = self.cram_suffix(self.in_suffix, **kwargs)
+        self.out_suffix = self.cram_suffix(self.out_suffix, **kwargs)
 
-            self.add_args += ["OUTPUT=" + os.path.join(kwargs.get('align_dir'), input + self.out_suffix)]
+        self.add_args = ["INPUT=" + os.path.join(kwargs.get('align_dir'), input + self.in_suffix),
+                         "M=" + os.path.join(kwargs.get('qc_dir'), input + '_mark_duplicates_picard.txt'),
+                         "CREATE_INDEX=" + str(not self.out_suffix.endswith(".cram")).lower(),
+                         "VALIDATION_STRINGENCY=LENIENT"
+                         ]
+        if not any("TMP_DIR=" in a for a in args):
+            self.add_args += ["TMP_DIR=" + self.scratch_path('', **kwargs).rstrip('/')]
+        self.add_args += ["OUTPUT=" + os.path.join(kwargs.get('align_dir'), input + self.out_suffix)]
 
         self.add_args += args
         return
@@ -270,3 +313,67 @@ class Picard(BaseWrapper):
                          "VALIDATION_STRINGENCY=LENIENT"]
         self.add_args += args
         return
+
+
+class PicardMultipleMetrics(BaseWrapper):
+    """
+    Runs several of the Picard metric programs in `MULTIPLE_METRICS` on the same BAM with one CollectMultipleMetrics,
+    so the BAM is only read once by one JVM. The metric files are moved to the names the programs write when run on
+    their own and the checkpoint of each program is written, so nothing downstream changes.
+    """
+
+    def __init__(self, name, input, metrics, **kwargs):
+        """
+        :param name: the name of the step
+        :param input: the sample id
+        :param metrics: the `Picard` wrappers of the metric programs, all reading the same BAM
+        :param kwargs: Generic options passed to bioflows, those of the first of the metric programs
+        """
+        if kwargs.get("ref_fasta_path") is None:
+            print "Error!!! picard CollectMultipleMetrics needs the reference_fasta_path"
+            sys.exit(0)
+        self.input = input
+        self.metrics = metrics
+        self.subcommand = "CollectMultipleMetrics"
+        self.in_suffix = metrics[0].in_suffix
+        self.out_suffix = ''
+
+        metric_ids = ','.join([x.prog_id for x in metrics])
+        kwargs['target'] = input + "_" + name + "_" + hashlib.sha224(
+            input + "_" + name + "_" + metric_ids).hexdigest() + ".txt"
+        kwargs['stdout'] = os.path.join(kwargs['log_dir'], input + "_" + name + '.log')
+        kwargs['prog_id'] = name
+        self.init('picard CollectMultipleMetrics', **kwargs)
+
+        # One job big enough for the largest of the programs
+        self.job_parms = copy.deepcopy(metrics[0].job_parms)
+        for k in ['mem', 'time', 'ncpus']:
+            self.job_parms[k] = max([x.job_parms.get(k, 0) for x in metrics])
+
+        prefix = os.path.join(kwargs.get('qc_dir'), input + "_" + name)
+        self.args = [' -Xmx' + str(self.job_parms['mem']) + 'M',
+                     "INPUT=" + os.path.join(kwargs.get('align_dir'), input + self.in_suffix),
+                     "OUTPUT=" + prefix,
+                     "REFERENCE_SEQUENCE=" + kwargs.get("ref_fasta_path"),
+                     "VALIDATION_STRINGENCY=LENIENT",
+                     "PROGRAM=null"]
+        self.args += ["PROGRAM=" + x.subcommand for x in metrics]
+
+        move_cmds = []
+        for prog in metrics:
+            prog_outputs = dict(x.split('=', 1) for x in prog.add_args if '=' in x and ' ' not in x)
+            for arg, extension in sorted(MULTIPLE_METRICS[prog.subcommand].iteritems()):
+                if arg in prog_outputs:
+                    # CollectMultipleMetrics skips the files it has no data for, e.g. the insert sizes of
+                    # single end reads
+                    move_cmds.append("[ -e %s ] && mv %s %s" % (prefix + extension, prefix + extension,
+                                                                 prog_outputs[arg]))
+            move_cmds.append("echo 'DONE' > " + prog.luigi_target)
+        self.setup_run(add_command='; '.join(move_cmds))
+        return
+
+    def produces(self):
+        return sorted(set([y for x in self.metrics for y in x.produces()]))
+
+    def reads_cram(self):
+        return True
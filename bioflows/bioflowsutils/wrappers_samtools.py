@@ -2,7 +2,7 @@
 import hashlib
 import os
 
-from wrappers import BaseWrapper
+from wrappers import BaseWrapper, alignment_index
 
 
 # import subprocess
@@ -52,6 +52,8 @@ class SamTools(BaseWrapper):
                         self.args += [' -m ' + str(mem_per_thread) + "M"]
         else:
             self.job_parms.update({'mem': 4000, 'time': 300, 'ncpus': 1})
+        if self.subcommand == "sormadup":
+            self.setup_sormadup(input, **kwargs)
         # print self.add_args
         self.args += self.add_args
         self.setup_run()
@@ -60,6 +62,7 @@ class SamTools(BaseWrapper):
     def make_target(self, name, input, *args, **kwargs):
         # Make sure output suffix is enforced
         name_str = "_" + name + "_"
+        self.subcommand = name.split('_')[1]
         # if kwargs['suffix_type'] != "custom":
         #     print "Error1!!! you need to specify an output suffix"
         #     sys.exit(0)
@@ -91,6 +94,12 @@ class SamTools(BaseWrapper):
                 input + name_str + self.out_suffix).hexdigest() + ".txt"
             self.add_args_sort(input, *args, **kwargs)
 
+        elif name.split('_')[1] == "sormadup":
+            self.update_file_suffix(input_default='.bam', output_default='.dup.srtd.bam', **kwargs)
+            self.target = input + name_str + self.out_suffix + "_" + hashlib.sha224(
+                input + name_str + self.out_suffix).hexdigest() + ".txt"
+            self.add_args += args
+
         elif name.split('_')[1] == "index":
             self.update_file_suffix(input_default='.bam', output_default='default', **kwargs)
             self.target = input + name_str + self.in_suffix + ".bai." + "_" + hashlib.sha224(
@@ -98,6 +107,54 @@ class SamTools(BaseWrapper):
             self.add_args_index(input, *args, **kwargs)
         return
 
+    def produces(self):
+        if self.subcommand == "index" and self.out_suffix == "default":
+            return [alignment_index(self.in_suffix)]
+        elif self.subcommand == "sormadup":
+            return [self.out_suffix, alignment_index(self.out_suffix)]
+        return BaseWrapper.produces(self)
+
+    def reads_cram(self):
+        return self.subcommand in ["sort", "sormadup", "index"]
+
+    def writes_cram(self):
+        return self.subcommand in ["sort", "sormadup"]
+
+    def cram_args(self, **kwargs):
+        """
+        The reference of CRAM inputs and the format of CRAM outputs, for `alignment_format: cram`
+        """
+        cram_args = []
+        if self.in_suffix.endswith(".cram") or self.out_suffix.endswith(".cram"):
+            cram_args += ['--reference', kwargs['ref_fasta_path']]
+        if self.out_suffix.endswith(".cram"):
+            cram_args += ['-O', 'cram']
+        return cram_args
+
+    def setup_sormadup(self, input, **kwargs):
+        """
+        Sort, mark duplicates and index the BAM of an aligner in one pipeline,
+        `samtools fixmate -m | samtools sort | samtools markdup --write-index`. The input has to be grouped by read
+        name as written by the aligner. The options from the YAML are passed to markdup.
+        """
+        threads = self.job_parms.get('ncpus', 1)
+        mem_per_thread = max(int(self.job_parms.get('mem', 4000) * 0.75 / threads), 100)
+        in_file = os.path.join(kwargs['align_dir'], input + self.in_suffix)
+        out_file = os.path.join(kwargs['align_dir'], input + self.out_suffix)
+        stderr = os.path.join(self.log_dir, '_'.join([input, self.prog_id, 'err.log']))
+        reference = ['--reference', kwargs['ref_fasta_path']] if in_file.endswith(".cram") else []
+        self.cmd = ['samtools', 'fixmate', '-m', '-u', '-@', str(threads)] + reference + \
+                   [in_file, '-', '2>>' + stderr, '|',
+                    'samtools', 'sort', '-u', '-@', str(threads), '-m', str(mem_per_thread) + 'M',
+                    '-T', self.scratch_path(os.path.basename(out_file) + '.tmp', **kwargs), '-', '2>>' + stderr, '|',
+                    'samtools', 'markdup', '-@', str(threads)]
+        if out_file.endswith(".cram"):
+            self.cmd += ['--reference', kwargs['ref_fasta_path'], '-O', 'cram']
+        self.add_args += ['-f', os.path.join(kwargs['qc_dir'], input + ".dup.metrics.txt"), '--write-index',
+                          '-', out_file + '##idx##' + os.path.join(kwargs['align_dir'],
+                                                                   input + alignment_index(self.out_suffix))]
+        return
+
     def add_args_view(self, input, *args, **kwargs):
         self.add_args += args
         self.add_args += ["-o", os.path.join(kwargs['align_dir'], input + self.out_suffix)]
@@ -110,13 +167,20 @@ class SamTools(BaseWrapper):
             idx_to_replace = [i for i, s in enumerate(self.add_args) if '-T' in s][0]
             tmpdir_string = self.add_args[idx_to_replace] + "_" + input
             self.add_args[idx_to_replace] = tmpdir_string
+        else:
+            # the temporary files of the sort are written to the local disk of the node
+            self.add_args += ["-T", self.scratch_path(input + self.out_suffix + ".tmp", **kwargs)]
 
+        self.add_args += self.cram_args(**kwargs)
         self.add_args += ["-o", os.path.join(kwargs['align_dir'], input + self.out_suffix)]
         self.add_args.append(os.path.join(kwargs['align_dir'], input + self.in_suffix))
         return
 
     def add_args_index(self, input, *args, **kwargs):
-        if any("-b" or "-c" or "-m" not in a for a in args):
+        if self.in_suffix.endswith(".cram"):
+            # CRAM is always indexed as .crai
+            self.add_args += args
+        elif any("-b" or "-c" or "-m" not in a for a in args):
             self.add_args += ["-b"]
             self.add_args += args
         else:
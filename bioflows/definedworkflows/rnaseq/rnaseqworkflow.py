@@ -1,9 +1,13 @@
 import copy
+import fnmatch
+import hashlib
+import multiprocessing
 import os
+import re
 import subprocess
 import sys
 import time
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 
 import jsonpickle
 import luigi
@@ -11,11 +15,16 @@ import saga
 import yaml
 from luigi.parameter import ParameterVisibility
 
+import bioflows.bioflowsutils.intervals as intervals
+import bioflows.bioflowsutils.ref_cache as ref_cache
 import bioflows.bioflowsutils.wrappers as wr
 import bioflows.bioflowsutils.wrappers_gatk as wr_gatk
 import bioflows.bioflowsutils.wrappers_picard as wr_picard
 import bioflows.bioflowsutils.wrappers_qiime2 as wr_qiime2
+import bioflows.bioflowsutils.saga_pool as saga_pool
+import bioflows.bioflowsutils.submit_governor as submit_governor
 import bioflows.bioflowsutils.wrappers_samtools as wr_samtools
+from bioflows.bioflowsutils.job_state import JobTracker, job_is_queued, native_job_id
 from bioflows.bioutils.access_sra.sra import SraUtils
 
 
@@ -43,42 +52,189 @@ def ordered_load(stream, loader=yaml.SafeLoader, object_pairs_hook=OrderedDict):
     )
     return yaml.load(stream, OrderedLoader)
 
+
+# The parts of a wrapper needed to submit its job
+TaskSpec = namedtuple('TaskSpec', ['name', 'prog_id', 'input', 'run_command', 'conda_command', 'cwd', 'log_dir',
+                                   'scripts_dir', 'luigi_target', 'luigi_local_target', 'local_target', 'job_parms',
+                                   'cleanup_command'])
+
+# Decoded task specs by their jsonpickled wrapper, shared by all tasks in the process
+task_specs = dict()
+
+
+def task_spec(prog_input):
+    """
+    Decode a jsonpickled wrapper into a TaskSpec. Luigi checks the outputs and requirements of each task many times
+    while scheduling, so each wrapper is only decoded once per process.
+    :param prog_input: the jsonpickled wrapper
+    :return: TaskSpec
+    """
+    if prog_input not in task_specs:
+        prog = jsonpickle.decode(prog_input)
+        task_specs[prog_input] = TaskSpec(name=prog.name, prog_id=prog.prog_id, input=prog.input,
+                                          run_command=prog.run_command, conda_command=prog.conda_command,
+                                          cwd=prog.cwd, log_dir=prog.log_dir, scripts_dir=prog.scripts_dir,
+                                          luigi_target=prog.luigi_target,
+                                          luigi_local_target=getattr(prog, 'luigi_local_target', None),
+                                          local_target=prog.local_target, job_parms=prog.job_parms,
+                                          cleanup_command=getattr(prog, 'cleanup_command', None))
+    return task_specs[prog_input]
+
+
+# Encoded wrappers by the sha1 of their content, and chains of wrappers as lists of sha1s by chain id. The chains are
+# stored here once when the workflow is compiled so tasks only carry a chain id and a step
+spec_store = dict()
+chain_table = dict()
+
+
+def store_chain(prog_inputs):
+    """
+    Add the encoded wrappers of a chain to the spec store
+    :param prog_inputs: list of jsonpickled wrappers
+    :return: the chain id
+    """
+    spec_ids = []
+    for prog_input in prog_inputs:
+        spec_id = hashlib.sha1(prog_input).hexdigest()
+        spec_store[spec_id] = prog_input
+        spec_ids.append(spec_id)
+    chain_id = hashlib.sha1(':'.join(spec_ids)).hexdigest()
+    chain_table[chain_id] = spec_ids
+    return chain_id
+
+
+def chain_step(chain_id, step):
+    """
+    Return the jsonpickled wrapper of a step of a chain
+    """
+    return spec_store[chain_table[chain_id][step]]
+
+
+# Groups of chains by group id, e.g. the chains of all samples for the steps that are run together in one job
+group_table = dict()
+
+
+def store_group(chain_ids):
+    """
+    Add a group of chains to the group table
+    :return: the group id
+    """
+    group_id = hashlib.sha1(':'.join(chain_ids)).hexdigest()
+    group_table[group_id] = list(chain_ids)
+    return group_id
+
+
+# Batches of chains whose step is run by one program for all of them, e.g. featureCounts on the BAMs of many samples.
+# batch_table holds the spec id of the program and the chains of each batch, chain_batches the batch of a chain step
+batch_table = dict()
+chain_batches = dict()
+
+
+def store_batch(prog_input, chain_ids, step):
+    """
+    Add a batch to the batch table
+    :param prog_input: the jsonpickled wrapper running the step for the batch
+    :param chain_ids: the chains of the batch
+    :param step: the step run for the batch
+    :return: the batch id
+    """
+    spec_id = hashlib.sha1(prog_input).hexdigest()
+    spec_store[spec_id] = prog_input
+    batch_id = hashlib.sha1(':'.join([spec_id] + list(chain_ids))).hexdigest()
+    batch_table[batch_id] = (spec_id, list(chain_ids))
+    for chain_id in chain_ids:
+        chain_batches[(chain_id, step)] = batch_id
+    return batch_id
+
+
+# For the steps of a cohort chain, the jsonpickled tasks of the samples whose outputs each step reads
+cohort_inputs = dict()
+
+# The jsonpickled tasks building the indexes of the reference cache
+reference_tasks = []
+
+
+def reference_requires(step_deps, step):
+    """
+    The reference indexes are built before the steps that do not depend on other steps, and so before all the steps
+    """
+    if len(step_deps[step]) > 0:
+        return []
+    return [jsonpickle.decode(x) for x in reference_tasks]
+
+
+class SubmittedTarget(luigi.LocalTarget):
+    """
+    Checkpoint target for jobs submitted without waiting for them to finish (`job_submit_mode: poll`).
+    The SAGA job id is recorded in a `.jobid` file next to the checkpoint and the target is considered to exist
+    while the job is still queued or running, so that dependent jobs can be submitted right away.
+    """
+
+    def __init__(self, path, ssh_user=None):
+        super(SubmittedTarget, self).__init__(path)
+        self.job_id_file = path + ".jobid"
+        self.ssh_user = ssh_user
+
+    def checkpoint_exists(self):
+        return super(SubmittedTarget, self).exists()
+
+    def job_id(self):
+        if not os.path.exists(self.job_id_file):
+            return None
+        with open(self.job_id_file, 'r') as f:
+            return f.read().strip()
+
+    def exists(self):
+        if self.checkpoint_exists():
+            return True
+        job_id = self.job_id()
+        # the queue is read once for the checks of all the tasks, see job_is_queued
+        return job_id is not None and job_is_queued(job_id, self.ssh_user)
+
+
+def collect_tasks(task, seen=None):
+    """
+    Walk the luigi dependency graph below `task` and return all the tasks that submit jobs
+    :param task: the root luigi task
+    :param seen: task ids already visited
+    :return: list of tasks
+    """
+    if seen is None:
+        seen = set()
+    tasks = []
+    for t in luigi.task.flatten(task.requires()):
+        if t.task_id in seen:
+            continue
+        seen.add(t.task_id)
+        if isinstance(t, BaseTask):
+            tasks.append(t)
+        tasks += collect_tasks(t, seen)
+    return tasks
+
+
 class BaseTask:
 
     # Variable for suffix for multiple run of a program
 
     def setup(self, prog_input):
-        self.parms = jsonpickle.decode(prog_input)
-        self.jobparms = self.parms.job_parms
+        # The job script is only built the first time for each task
+        if getattr(self, 'prog_input', None) == prog_input:
+            return
+        self.parms = task_spec(prog_input)
+        self.jobparms = copy.deepcopy(self.parms.job_parms)
         self.jobparms['name'] = self.parms.name
         self.jobparms['workdir'] = self.parms.cwd
         self.jobparms['scripts_dir'] = self.parms.scripts_dir
 
-        # todo fix:  Hack to get the command to work for now
-        #              Clear all the environment variables
-        self.jobparms['command'] = "\n#SBATCH --export=NONE\n\n"
-        self.jobparms['command'] += "set -e\necho '***** Old PATH *****'\necho $PATH\n"
-        self.jobparms['command'] += "echo '**** Conda command***'\necho '" + self.parms.conda_command + "'\n"
-        self.jobparms['command'] += self.parms.conda_command + "\n"
-        # todo Fix hack because CCV loads global modules
-        # with conda activate a new shell is created and the PATH gets muddled
-        # need to figure out how to clear out the env
-        # self.jobparms['command'] += "export PATH=$CONDA_PREFIX/bin:$PATH"
-
-        self.jobparms['command'] += "\necho '***** New PATH *****'\necho $PATH\n\n"
-        self.jobparms['command'] += "\necho '***** checking Java ****'\njava -version 2>&1 \n\n"
-        self.jobparms['command'] += "\necho '***** checking env *****'\nprintenv\n\n"
-
-        # self.jobparms['command'] += 'conda activate $CONDA_PREFIX\n'
-        self.jobparms['command'] += "\necho '***** printing JOB INFO *****'\n"
-        self.jobparms['command'] += "\nSCRIPT_TMP_FILE=`mktemp`\n"
-        self.jobparms['command'] += "\nscontrol write batch_script $SLURM_JOBID $SCRIPT_TMP_FILE\n"
-        self.jobparms['command'] += "\ncat $SCRIPT_TMP_FILE \n\nrm -f $SCRIPT_TMP_FILE\n\n\n"
+        self.jobparms['command'] = self.job_script_header(self.parms)
 
         # Add a script here to print out the actual commands used by the slurm using sbatch script
-        self.jobparms['command'] += 'srun --export=ALL '
+        if self.jobparms.get('executor', 'saga') != 'local':
+            self.jobparms['command'] += 'srun --export=ALL '
         self.jobparms['command'] += self.parms.run_command + "\n"
         self.jobparms['command'] += " echo 'DONE' > " + self.parms.luigi_target
+        if self.parms.cleanup_command is not None:
+            self.jobparms['command'] += "\n" + self.parms.cleanup_command
 
         # self.jobparms['name'] = self.parms.name.replace(" ", "_")
         # self.jobparms['script_name'] = self.parms.input + "_" + self.jobparms['name']
@@ -90,37 +246,146 @@ class BaseTask:
         if self.jobparms['saga_host'] != 'localhost':
             self.jobparms['outfilesource'] = 'ssh.ccv.brown.edu:' + self.parms.luigi_target
             self.jobparms['outfiletarget'] = '' + os.path.dirname(self.parms.luigi_local_target) + "/"
+        self.jobparms['job_id_file'] = self.checkpoint_path() + ".jobid"
         # print self.jobparms
+        if self.jobparms.get('executor', 'saga') == 'local':
+            # luigi only runs tasks together while their cpus and memory fit in the [resources] of the machine.
+            # luigi asks for the resources after checking the output so they are set here
+            self.resources = {'cpu': min(self.jobparms.get('ncpus', 1), self.jobparms['local_cpus']),
+                              'mem': min(self.jobparms.get('mem', 2000), self.jobparms['local_mem'])}
+        self.prog_input = prog_input
+        return
+
+    def job_script_header(self, parms):
+        """
+        The part of the job script that sets up the environment before the program is run
+        :param parms: the decoded wrapper for the program
+        :return: the script as a string
+        """
+        # todo fix:  Hack to get the command to work for now
+        #              Clear all the environment variables
+        command = "\n#SBATCH --export=NONE\n\n"
+        command += "set -e\nset -o pipefail\necho '***** Old PATH *****'\necho $PATH\n"
+        command += "echo '**** Conda command***'\necho '" + parms.conda_command + "'\n"
+        command += parms.conda_command + "\n"
+        # todo Fix hack because CCV loads global modules
+        # with conda activate a new shell is created and the PATH gets muddled
+        # need to figure out how to clear out the env
+        # command += "export PATH=$CONDA_PREFIX/bin:$PATH"
+
+        command += "\necho '***** New PATH *****'\necho $PATH\n\n"
+        command += "\necho '***** checking Java ****'\njava -version 2>&1 \n\n"
+        command += "\necho '***** checking env *****'\nprintenv\n\n"
+
+        # command += 'conda activate $CONDA_PREFIX\n'
+        if self.jobparms.get('executor', 'saga') != 'local':
+            command += "\necho '***** printing JOB INFO *****'\n"
+            command += "\nSCRIPT_TMP_FILE=`mktemp`\n"
+            command += "\nscontrol write batch_script $SLURM_JOBID $SCRIPT_TMP_FILE\n"
+            command += "\ncat $SCRIPT_TMP_FILE \n\nrm -f $SCRIPT_TMP_FILE\n\n\n"
+        return command
+
+    def checkpoint_path(self, parms=None):
+        if parms is None:
+            parms = self.parms
+        if parms.local_target:
+            # lcs.RemoteFileSystem("ssh.ccv.brown.edu").get( self.parms.luigi_target,self.parms.luigi_local_target)
+            return parms.luigi_local_target
+        else:
+            return parms.luigi_target
+
+    def checkpoint_target(self, parms=None):
+        """
+        The luigi target for the checkpoint of this task. When jobs are submitted without waiting the target also
+        tracks the submitted job
+        """
+        if self.jobparms.get('submit_mode', 'wait') == 'poll':
+            return SubmittedTarget(self.checkpoint_path(parms), self.jobparms.get('ssh_user'))
+        return luigi.LocalTarget(self.checkpoint_path(parms))
+
+    def submit_job(self):
+        """
+        Submit the job for this task. When jobs are submitted without waiting, jobs for upstream tasks may still
+        be queued, so the job is made to depend on them through the scheduler
+        """
+        jobparms = dict(self.jobparms)
+        if jobparms.get('submit_mode', 'wait') == 'poll':
+            upstream = [t.job_id() for t in luigi.task.flatten(self.input())
+                        if isinstance(t, SubmittedTarget) and not t.checkpoint_exists()]
+            upstream = [native_job_id(x) for x in upstream if x is not None]
+            dependency = "afterok"
+            if 'job_id_files' in jobparms.keys():
+                # Job arrays depend index by index on the upstream arrays
+                dependency = "aftercorr"
+                upstream = [x.split('_')[0] for x in upstream]
+            upstream = sorted(set(upstream))
+            if len(upstream) > 0:
+                jobparms['command'] = "\n#SBATCH --dependency=" + dependency + ":" + ':'.join(upstream) + \
+                                      "\n#SBATCH --kill-on-invalid-dep=yes" + jobparms['command']
+        if jobparms.get('executor', 'saga') == 'local':
+            return self.run_local_job(**jobparms)
+        return self.create_saga_job(**jobparms)
+
+    def run_local_job(self, **kwargs):
+        """
+        Run the job script with bash on this machine and wait for it, used with `executor: local`
+        """
+        script = os.path.join(kwargs.get('scripts_dir'), kwargs.get('script_name') + "_local_cmds")
+        f = open(script, 'w')
+        f.write("#!/bin/bash\n\n#*************\n")
+        f.write(kwargs.get('command'))
+        f.write("\n\n#*************\n")
+        f.close()
+
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(self.resources['cpu'])
+        print ' * Running %s locally with %d cpus' % (kwargs.get('script_name'), self.resources['cpu'])
+        out = open(kwargs.get('out'), 'w')
+        err = open(kwargs.get('error'), 'w')
+        try:
+            ret = subprocess.call(['bash', script], cwd=kwargs.get('work_dir', os.getcwd()), env=env,
+                                  stdout=out, stderr=err)
+        finally:
+            # the job has been reaped, long local runs would otherwise keep two descriptors per job open
+            out.close()
+            err.close()
+        if ret != 0:
+            raise RuntimeError("%s exited with status %d, see %s" % (script, ret, kwargs.get('error')))
+        return
+
+    def fetch_remote_checkpoint(self):
+        """
+        Copy the checkpoint of a finished job from the remote host when targets are kept locally
+        """
+        if self.jobparms['saga_host'] != 'localhost' and self.parms.local_target:
+            subprocess.call(' '.join(['scp ', self.jobparms['outfilesource'], self.jobparms['outfiletarget']]),
+                            shell=True)
         return
 
     def create_saga_job(self, **kwargs):
-        ctx = saga.Context("ssh")
         # Fix the default user
-        ctx.user_id = kwargs.get('saga_user', 'aragaven')
+        user = kwargs.get('saga_user', 'aragaven')
         host = kwargs.get('saga_host', 'localhost')
         scheduler = kwargs.get('saga_scheduler', 'fork')
 
-        session = saga.Session()
-        if host != 'localhost':
-            session.add_context(ctx)
         # describe our job
         # these parameters are standard saga parameters that map tp slurm specific ones:
         # ref: line 410+ https://github.com/radical-cybertools/saga-python/blob/devel/src/saga/adaptors/slurm/slurm_job.py
 
-        jd = saga.job.Description()
-        jd.executable = ''
-        jd.arguments = [kwargs.get('command')]  # cmd
-        jd.working_directory = kwargs.get('work_dir', os.getcwd())
-        jd.wall_time_limit = kwargs.get('time', 60)
-        jd.total_physical_memory = kwargs.get('mem', 2000)
-        jd.number_of_processes = 1
-        jd.processes_per_host = 1
-        jd.total_cpu_count = kwargs.get('ncpus', 1)
+        # the attributes of the saga.job.Description, the job may be submitted by the workflow driver
+        jd = dict()
+        jd['executable'] = ''
+        jd['arguments'] = [kwargs.get('command')]  # cmd
+        jd['working_directory'] = kwargs.get('work_dir', os.getcwd())
+        jd['wall_time_limit'] = kwargs.get('time', 60)
+        jd['total_physical_memory'] = kwargs.get('mem', 2000)
+        jd['number_of_processes'] = 1
+        jd['processes_per_host'] = 1
+        jd['total_cpu_count'] = kwargs.get('ncpus', 1)
         if 'condo' in kwargs.keys():
-            jd.project = kwargs.get('condo')
-        jd.output = kwargs.get('out', os.path.join(jd.working_directory, "slurmlog.stdout"))
-        jd.error = kwargs.get('error', "slurmlog.stderr")
-        js = saga.job.Service(scheduler + "://" + host, session=session)
+            jd['project'] = kwargs.get('condo')
+        jd['output'] = kwargs.get('out', os.path.join(jd['working_directory'], "slurmlog.stdout"))
+        jd['error'] = kwargs.get('error', "slurmlog.stderr")
 
         f = open(os.path.join(kwargs.get('scripts_dir'), kwargs.get('script_name') + "_sbatch_cmds"), 'w')
         f.write("#/bin/bash\n\n#*************\n")
@@ -128,12 +393,46 @@ class BaseTask:
         f.write("\n\n#*************\n")
         f.close()
 
-        myjob = js.create_job(jd)
-        # Now we can start our job.
+        # Now we can start our job, waiting for the submission limits if needed.
         # print " \n ***** SAGA: job Started ****\n"
-        myjob.run()
-
-        myjob.wait()
+        # The job service is shared with the other jobs of the workflow, the forked luigi workers submit through
+        # the driver
+        job_id, myjob = saga_pool.submit(jd, (scheduler, host, user), kwargs,
+                                         count=len(kwargs.get('job_id_files', [None])))
+
+        if kwargs.get('submit_mode', 'wait') == 'poll':
+            # Record the job id next to the checkpoint and return right away,
+            # completion is detected later through the checkpoint target
+            if 'job_id_files' in kwargs.keys():
+                # one id per array index, e.g. [slurm://localhost]-[1234_5]
+                for idx, job_id_file in enumerate(kwargs.get('job_id_files')):
+                    f = open(job_id_file, 'w')
+                    f.write(job_id.rstrip(']') + "_" + str(idx) + "]\n")
+                    f.close()
+            elif 'pool_job_id_files' in kwargs.keys():
+                # all the steps run in the same job
+                for job_id_file in kwargs.get('pool_job_id_files'):
+                    f = open(job_id_file, 'w')
+                    f.write(job_id + "\n")
+                    f.close()
+            else:
+                f = open(kwargs.get('job_id_file'), 'w')
+                f.write(job_id + "\n")
+                f.close()
+            return job_id
+
+        if 'job_id_files' in kwargs.keys():
+            # Wait for all the indices of the job array
+            tracker = JobTracker(user=kwargs.get('ssh_user'), min_interval=30)
+            tracker.add(job_id)
+            tracker.wait()
+        elif myjob is None:
+            # submitted by the driver, only the job id is known here
+            tracker = JobTracker(user=kwargs.get('ssh_user'))
+            tracker.add(job_id)
+            tracker.wait()
+        else:
+            myjob.wait()
         # print " \n ***** SAGA: job Done ****\n"
         # print kwargs.get('outfilesource')
         # out = saga.filesystem.File(kwargs.get('outfilesource'), session=session)
@@ -144,8 +443,7 @@ class BaseTask:
             subprocess.call(' '.join(['scp ', kwargs.get('outfilesource'), kwargs.get('outfiletarget')]), shell=True)
         # print "\n **** SAGA: copy Done ***** \n"
         # out.close()
-        js.close()
-        return
+        return job_id
 
 
 class TopTask(luigi.Task, BaseTask):
@@ -155,50 +453,368 @@ class TopTask(luigi.Task, BaseTask):
 
         self.setup(self.prog_parms[0])
         self.__class__.__name__ = str(self.jobparms['name'])
-        job = self.create_saga_job(**self.jobparms)
+        job = self.submit_job()
         return
 
     def output(self):
         self.setup(self.prog_parms[0])
         self.__class__.__name__ = str(self.jobparms['name'])
-        if self.parms.local_target:
-            # lcs.RemoteFileSystem("ssh.ccv.brown.edu").get( self.parms.luigi_target,self.parms.luigi_local_target)
-            return luigi.LocalTarget(self.parms.luigi_local_target)
-        else:
-            return luigi.LocalTarget(self.parms.luigi_target)
+        return self.checkpoint_target()
 
 
 class TaskSequence(luigi.Task, BaseTask):
-    prog_parms = luigi.ListParameter()  #positional=False)#, visibility=ParameterVisibility.HIDDEN)
+    """
+    Runs step `step` of a chain after the steps that follow it in the chain, the chain is in reverse order of the
+    `workflow_sequence`
+    """
+    chain_id = luigi.Parameter()
     n_tasks = luigi.IntParameter()
-    def requires(self):
-        self.setup(self.prog_parms[0])
-        newParms = [x for x in self.prog_parms]
+    step = luigi.IntParameter(default=0)
 
+    def requires(self):
         # Test if only one command is submitted or more commands are submitted
-        if self.n_tasks > 1:
-            del newParms[0]
-            if len(newParms) > 1:
-                return TaskSequence(prog_parms=newParms, n_tasks=self.n_tasks)
-            else:
-                return TopTask(prog_parms=newParms)
+        if self.step + 1 < self.n_tasks:
+            return TaskSequence(chain_id=self.chain_id, n_tasks=self.n_tasks, step=self.step + 1)
         else:
             return []
-            # return TopTask(prog_parms=newParms)
 
     def run(self):
-        self.setup(self.prog_parms[0])
+        self.setup(chain_step(self.chain_id, self.step))
         self.__class__.__name__ = str(self.jobparms['name'])
-        job = self.create_saga_job(**self.jobparms)
+        job = self.submit_job()
         return
 
     def output(self):
-        self.setup(self.prog_parms[0])
+        self.setup(chain_step(self.chain_id, self.step))
         self.__class__.__name__ = str(self.jobparms['name'])
-        if self.parms.local_target:
-            return luigi.LocalTarget(self.parms.luigi_local_target)
-        else:
-            return luigi.LocalTarget(self.parms.luigi_target)
+        return self.checkpoint_target()
+
+
+class StepTask(luigi.Task, BaseTask):
+    """
+    Runs one step of the chain of programs for a sample. `chain_id` refers to the programs of the chain in the order
+    of the `workflow_sequence` and `step_deps` holds, for each step, the steps whose outputs it reads.
+    """
+    chain_id = luigi.Parameter()
+    step = luigi.IntParameter()
+    step_deps = luigi.ListParameter()
+    group_id = luigi.Parameter(default='')
+    pool_steps = luigi.ListParameter(default=[])
+
+    def requires(self):
+        return [chain_step_task(self.chain_id, self.group_id, x, self.step_deps, self.pool_steps)
+                for x in self.step_deps[self.step]] + reference_requires(self.step_deps, self.step)
+
+    def run(self):
+        self.setup(chain_step(self.chain_id, self.step))
+        self.__class__.__name__ = str(self.jobparms['name'])
+        job = self.submit_job()
+        return
+
+    def output(self):
+        self.setup(chain_step(self.chain_id, self.step))
+        self.__class__.__name__ = str(self.jobparms['name'])
+        return self.checkpoint_target()
+
+
+class ArrayTask(luigi.Task, BaseTask):
+    """
+    Runs one step for all the samples as a single SLURM job array. `chain_ids` holds the chain of each sample in the
+    same order for every step, so that index `i` of every array is the same sample. Each index looks up its command
+    in a command table and writes the checkpoint of its sample, samples that are already done are skipped.
+    `step_deps` is the same as for `StepTask`.
+    """
+    chain_ids = luigi.ListParameter()
+    step = luigi.IntParameter()
+    step_deps = luigi.ListParameter()
+
+    def requires(self):
+        return [ArrayTask(chain_ids=self.chain_ids, step=x, step_deps=self.step_deps)
+                for x in self.step_deps[self.step]] + reference_requires(self.step_deps, self.step)
+
+    def step_inputs(self):
+        return [chain_step(x, self.step) for x in self.chain_ids]
+
+    def setup_array(self, prog_inputs):
+        if getattr(self, 'array_input', None) == prog_inputs:
+            return
+        self.sample_parms = [task_spec(x) for x in prog_inputs]
+
+        # Job parameters are the same for all samples in a step
+        self.setup(prog_inputs[0])
+        parms = self.parms
+
+        self.jobparms['script_name'] = parms.prog_id + "_array"
+        self.jobparms['command_table'] = os.path.join(parms.scripts_dir, parms.prog_id + "_array_cmds.txt")
+        self.jobparms['out'] = os.path.join(parms.log_dir, parms.prog_id + "_array_%A_%a_slurm.stdout")
+        self.jobparms['error'] = os.path.join(parms.log_dir, parms.prog_id + "_array_%A_%a_slurm.stderr")
+        self.jobparms['job_id_files'] = [self.checkpoint_path(p) + ".jobid" for p in self.sample_parms]
+        if self.jobparms['saga_host'] != 'localhost':
+            self.jobparms['outfilesource'] = ' '.join(['ssh.ccv.brown.edu:' + p.luigi_target
+                                                       for p in self.sample_parms])
+
+        array_range = "0-" + str(len(self.sample_parms) - 1)
+        if self.jobparms.get('array_max_running') is not None:
+            array_range += "%" + str(self.jobparms['array_max_running'])
+
+        self.jobparms['command'] = "\n#SBATCH --array=" + array_range + self.job_script_header(parms)
+        self.jobparms['command'] += "CMD_LINE=`sed -n \"$((SLURM_ARRAY_TASK_ID + 1))p\" " + \
+                                    self.jobparms['command_table'] + "`\n"
+        self.jobparms['command'] += "SAMPLE=`echo \"$CMD_LINE\" | cut -f1`\n"
+        self.jobparms['command'] += "TARGET=`echo \"$CMD_LINE\" | cut -f2`\n"
+        self.jobparms['command'] += "CLEANUP=`echo \"$CMD_LINE\" | cut -f3`\n"
+        self.jobparms['command'] += "CMD=`echo \"$CMD_LINE\" | cut -f4-`\n"
+        self.jobparms['command'] += "echo \"***** Sample: $SAMPLE *****\"\n"
+        self.jobparms['command'] += "if [ -e \"$TARGET\" ]; then echo \"Checkpoint $TARGET exists\"; exit 0; fi\n"
+        self.jobparms['command'] += "eval \"srun --export=ALL $CMD\"\n"
+        self.jobparms['command'] += " echo 'DONE' > $TARGET\n"
+        self.jobparms['command'] += "eval \"$CLEANUP\""
+        self.array_input = prog_inputs
+        return
+
+    def write_command_table(self):
+        """
+        Write the sample, checkpoint, cleanup and command for each index of the array, one line per index
+        """
+        f = open(self.jobparms['command_table'], 'w')
+        for p in self.sample_parms:
+            f.write('\t'.join([p.input, p.luigi_target, p.cleanup_command or '', p.run_command]) + "\n")
+        f.close()
+        return
+
+    def run(self):
+        self.setup_array(self.step_inputs())
+        self.__class__.__name__ = str(self.jobparms['name'])
+        self.write_command_table()
+        job = self.submit_job()
+        return
+
+    def output(self):
+        self.setup_array(self.step_inputs())
+        self.__class__.__name__ = str(self.jobparms['name'])
+        return [self.checkpoint_target(p) for p in self.sample_parms]
+
+
+class PoolTask(luigi.Task, BaseTask):
+    """
+    Runs one short step for all the chains of a group inside a single larger allocation. Each chain gets a small
+    script that writes its own checkpoint and the scripts are run `htc_ncpus / ncpus` at a time with `xargs`, so the
+    queue wait and the setup of the job are paid once for the whole group. The samples are split into groups of
+    `htc_batch` chains. `pool_steps` are the steps that are run this way, the other steps are run with a `StepTask`
+    per chain.
+    """
+    group_id = luigi.Parameter()
+    step = luigi.IntParameter()
+    step_deps = luigi.ListParameter()
+    pool_steps = luigi.ListParameter()
+
+    def requires(self):
+        deps = []
+        for x in self.step_deps[self.step]:
+            if x in self.pool_steps:
+                deps.append(PoolTask(group_id=self.group_id, step=x, step_deps=self.step_deps,
+                                     pool_steps=self.pool_steps))
+            else:
+                deps += [chain_step_task(c, self.group_id, x, self.step_deps, self.pool_steps)
+                         for c in group_table[self.group_id]]
+        return deps + reference_requires(self.step_deps, self.step)
+
+    def step_inputs(self):
+        return [chain_step(x, self.step) for x in group_table[self.group_id]]
+
+    def setup_pool(self, prog_inputs):
+        if getattr(self, 'pool_input', None) == prog_inputs:
+            return
+        self.sample_parms = [task_spec(x) for x in prog_inputs]
+
+        # Job parameters are the same for all samples in a step
+        self.setup(prog_inputs[0])
+        parms = self.parms
+
+        step_cpus = self.jobparms.get('ncpus', 1)
+        self.jobparms['ncpus'] = max(self.jobparms.get('htc_ncpus') or 16, step_cpus)
+        n_parallel = self.jobparms['ncpus'] // step_cpus
+        n_rounds = (len(self.sample_parms) + n_parallel - 1) // n_parallel
+        # the samples of the pool share one copy of an index in shared memory
+        self.jobparms['mem'] = self.jobparms.get('htc_mem') or (parms.job_parms.get('mem', 2000) * n_parallel +
+                                                                self.jobparms.get('shm_mem', 0))
+        self.jobparms['time'] = self.jobparms.get('htc_time') or self.jobparms.get('time', 60) * n_rounds
+        if self.jobparms['time'] > self.jobparms.get('htc_max_time', 1440):
+            print "Warning!!! %d rounds of %s need %d minutes, the job is limited to htc_max_time, lower htc_batch" % (
+                n_rounds, parms.prog_id, self.jobparms['time'])
+            self.jobparms['time'] = self.jobparms.get('htc_max_time', 1440)
+
+        self.jobparms['script_name'] = parms.prog_id + "_pool"
+        self.jobparms['script_list'] = os.path.join(parms.scripts_dir, parms.prog_id + "_pool_scripts.txt")
+        self.jobparms['out'] = os.path.join(parms.log_dir, parms.prog_id + "_pool_slurm.stdout")
+        self.jobparms['error'] = os.path.join(parms.log_dir, parms.prog_id + "_pool_slurm.stderr")
+        self.jobparms['pool_job_id_files'] = [self.checkpoint_path(p) + ".jobid" for p in self.sample_parms]
+        if self.jobparms['saga_host'] != 'localhost':
+            self.jobparms['outfilesource'] = ' '.join(['ssh.ccv.brown.edu:' + p.luigi_target
+                                                       for p in self.sample_parms])
+
+        self.jobparms['command'] = self.job_script_header(parms)
+        self.jobparms['command'] += "xargs -P " + str(n_parallel) + " -n 1 bash < " + self.jobparms['script_list']
+        self.pool_input = prog_inputs
+        return
+
+    def step_script(self, p):
+        return os.path.join(p.scripts_dir, p.input + "_" + p.prog_id + "_pool.sh")
+
+    def write_step_scripts(self):
+        """
+        Write the script of each sample and the list of scripts run by the job
+        """
+        f_list = open(self.jobparms['script_list'], 'w')
+        for p in self.sample_parms:
+            f = open(self.step_script(p), 'w')
+            f.write("exec > " + os.path.join(p.log_dir, p.input + "_" + p.prog_id + "_pool.log") + " 2>&1\n")
+            f.write("echo '***** Sample: " + p.input + " *****'\n")
+            f.write("if [ -e " + p.luigi_target + " ]; then echo 'Checkpoint exists'; exit 0; fi\n")
+            f.write("set -e\nset -o pipefail\n")
+            f.write(p.run_command + "\n")
+            f.write("echo 'DONE' > " + p.luigi_target + "\n")
+            if p.cleanup_command is not None:
+                f.write(p.cleanup_command + "\n")
+            f.close()
+            f_list.write(self.step_script(p) + "\n")
+        f_list.close()
+        return
+
+    def run(self):
+        self.setup_pool(self.step_inputs())
+        self.__class__.__name__ = str(self.jobparms['name'])
+        self.write_step_scripts()
+        job = self.submit_job()
+        return
+
+    def output(self):
+        self.setup_pool(self.step_inputs())
+        self.__class__.__name__ = str(self.jobparms['name'])
+        return [self.checkpoint_target(p) for p in self.sample_parms]
+
+
+class BatchTask(luigi.Task, BaseTask):
+    """
+    Runs one step for a batch of chains with a single program, e.g. featureCounts on the BAMs of many samples. The
+    program writes the outputs and the checkpoint of each chain, so the steps that follow are unchanged.
+    """
+    batch_id = luigi.Parameter()
+    step = luigi.IntParameter()
+    step_deps = luigi.ListParameter()
+    group_id = luigi.Parameter(default='')
+    pool_steps = luigi.ListParameter(default=[])
+
+    def requires(self):
+        deps = OrderedDict()
+        for chain_id in batch_table[self.batch_id][1]:
+            for x in self.step_deps[self.step]:
+                task = chain_step_task(chain_id, self.group_id, x, self.step_deps, self.pool_steps)
+                deps[task.task_id] = task
+        return deps.values() + reference_requires(self.step_deps, self.step)
+
+    def setup_batch(self):
+        if getattr(self, 'sample_parms', None) is not None:
+            return
+        self.setup(spec_store[batch_table[self.batch_id][0]])
+        self.sample_parms = [task_spec(chain_step(x, self.step)) for x in batch_table[self.batch_id][1]]
+        self.jobparms['pool_job_id_files'] = [self.checkpoint_path(p) + ".jobid" for p in self.sample_parms]
+        if self.jobparms['saga_host'] != 'localhost':
+            # the checkpoint of every sample of the batch is copied back
+            self.jobparms['outfilesource'] = ' '.join(['ssh.ccv.brown.edu:' + p.luigi_target
+                                                       for p in self.sample_parms])
+        for p in self.sample_parms:
+            if p.cleanup_command is not None:
+                self.jobparms['command'] += "\n" + p.cleanup_command
+        return
+
+    def run(self):
+        self.setup_batch()
+        self.__class__.__name__ = str(self.jobparms['name'])
+        job = self.submit_job()
+        return
+
+    def output(self):
+        self.setup_batch()
+        self.__class__.__name__ = str(self.jobparms['name'])
+        return [self.checkpoint_target(p) for p in self.sample_parms]
+
+
+def chain_step_task(chain_id, group_id, step, step_deps, pool_steps):
+    """
+    The task for a step of a chain, the steps in `pool_steps` are run for the whole group of chains by a `PoolTask`
+    and batched steps by the `BatchTask` of the batch of the chain
+    """
+    if step in pool_steps:
+        return PoolTask(group_id=group_id, step=step, step_deps=step_deps, pool_steps=pool_steps)
+    if (chain_id, step) in chain_batches:
+        return BatchTask(batch_id=chain_batches[(chain_id, step)], step=step, step_deps=step_deps, group_id=group_id,
+                         pool_steps=pool_steps)
+    return StepTask(chain_id=chain_id, group_id=group_id, step=step, step_deps=step_deps, pool_steps=pool_steps)
+
+
+class CohortTask(luigi.Task, BaseTask):
+    """
+    Runs one step of the chain of a cohort, e.g. joint genotyping. Like `StepTask` it depends on the steps in
+    `step_deps`, and on the tasks of the samples whose outputs the step reads, which are kept in `cohort_inputs`.
+    The step is run again when the checkpoint of one of these sample tasks is missing or newer than its own, so
+    a cohort output is rebuilt after the outputs of a sample are.
+    """
+    chain_id = luigi.Parameter()
+    step = luigi.IntParameter()
+    step_deps = luigi.ListParameter()
+
+    def requires(self):
+        deps = [CohortTask(chain_id=self.chain_id, step=x, step_deps=self.step_deps)
+                for x in self.step_deps[self.step]]
+        deps += [jsonpickle.decode(x) for x in cohort_inputs[self.chain_id][self.step]]
+        return deps
+
+    def sample_inputs(self):
+        """
+        The sample tasks read by this step and by the cohort steps it depends on
+        """
+        steps = set()
+        pending = [self.step]
+        while len(pending) > 0:
+            step = pending.pop()
+            if step not in steps:
+                steps.add(step)
+                pending += self.step_deps[step]
+        inputs = set()
+        for step in steps:
+            inputs.update(cohort_inputs[self.chain_id][step])
+        return [jsonpickle.decode(x) for x in sorted(inputs)]
+
+    def complete(self):
+        output = self.output()
+        if not output.exists():
+            return False
+        if isinstance(output, SubmittedTarget) and not output.checkpoint_exists():
+            # the job of this step is still queued or running
+            return True
+        done = os.path.getmtime(output.path)
+        for task in self.sample_inputs():
+            for target in luigi.task.flatten(task.output()):
+                if isinstance(target, SubmittedTarget):
+                    if not target.checkpoint_exists():
+                        return False
+                elif not target.exists():
+                    return False
+                if os.path.getmtime(target.path) > done:
+                    return False
+        return True
+
+    def run(self):
+        self.setup(chain_step(self.chain_id, self.step))
+        self.__class__.__name__ = str(self.jobparms['name'])
+        job = self.submit_job()
+        return
+
+    def output(self):
+        self.setup(chain_step(self.chain_id, self.step))
+        self.__class__.__name__ = str(self.jobparms['name'])
+        return self.checkpoint_target()
 
 
 class TaskFlow(luigi.WrapperTask):
@@ -228,6 +844,7 @@ class BaseWorkflow:
     dna_seq_flag = False
 
     prog_job_parms = dict()
+    prog_step_parms = dict()
     prog_suffix_type = dict()
     prog_output_suffix = dict()
     prog_input_suffix = dict()
@@ -242,8 +859,10 @@ class BaseWorkflow:
                               'samtools_view': wr_samtools.SamTools,
                               'samtools_index': wr_samtools.SamTools,
                               'samtools_sort': wr_samtools.SamTools,
+                              'samtools_sormadup': wr_samtools.SamTools,
                               'bammarkduplicates2': wr.Biobambam,
                               'bamsort': wr.Biobambam,
+                              'bamsormadup': wr.Biobambam,
                               'salmon': wr.SalmonCounts,
                               'htseq-count': wr.HtSeqCounts,
                               'featureCounts': wr.FeatureCounts,
@@ -256,6 +875,8 @@ class BaseWorkflow:
                               'picard_CollectAlignmentSummaryMetrics': wr_picard.Picard,
                               'picard_CollectInsertSizeMetrics': wr_picard.Picard,
                               'picard_CollectGcBiasMetrics': wr_picard.Picard,
+                              'picard_MeanQualityByCycle': wr_picard.Picard,
+                              'picard_QualityScoreDistribution': wr_picard.Picard,
                               'picard_SamToFastq': wr_picard.Picard,
                               'gatk_RealignerTargetCreator': wr_gatk.Gatk,
                               'gatk_IndelRealigner': wr_gatk.Gatk,
@@ -356,6 +977,36 @@ class BaseWorkflow:
         else:
             self.job_params['saga_scheduler'] = 'fork'
 
+        # Submit jobs and return without waiting for them to finish. This needs a batch scheduler
+        # as the dependencies between jobs are handed over to it
+        self.job_params['submit_mode'] = self.run_parms.get('job_submit_mode', 'wait')
+        if self.job_params['submit_mode'] == 'poll' and not self.job_params['saga_scheduler'].startswith('slurm'):
+            print "Warning: job_submit_mode poll needs the slurm scheduler, waiting for jobs instead"
+            self.job_params['submit_mode'] = 'wait'
+
+        # Limit on the number of indices of a job array running at the same time
+        self.job_params['array_max_running'] = self.run_parms.get('job_array_max_running', None)
+
+        # Run the jobs on this machine instead of submitting them through SAGA, packed by their cpus and memory
+        self.job_params['executor'] = self.run_parms.get('executor', 'saga')
+        if self.job_params['executor'] == 'local':
+            self.job_params['local_cpus'] = int(self.run_parms.get('local_cpus', multiprocessing.cpu_count()))
+            self.job_params['local_mem'] = int(self.run_parms.get('local_mem', os.sysconf('SC_PAGE_SIZE') *
+                                                                  os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)))
+            self.job_params['submit_mode'] = 'wait'
+
+        # The allocation for the short steps run together in htc_steps
+        self.job_params['htc_ncpus'] = self.run_parms.get('htc_ncpus', None)
+        self.job_params['htc_mem'] = self.run_parms.get('htc_mem', None)
+        self.job_params['htc_time'] = self.run_parms.get('htc_time', None)
+        self.job_params['htc_max_time'] = int(self.run_parms.get('htc_max_time', 1440))
+
+        # Limits on the rate of submissions and on the number of jobs in the queue
+        self.job_params['submit_rate'] = self.run_parms.get('submit_rate', 1.0)
+        self.job_params['submit_burst'] = self.run_parms.get('submit_burst', 10)
+        self.job_params['max_jobs_in_queue'] = self.run_parms.get('max_jobs_in_queue', None)
+        self.job_params['max_pending_jobs'] = self.run_parms.get('max_pending_jobs', None)
+
         return
 
     def set_base_kwargs(self):
@@ -391,6 +1042,10 @@ class BaseWorkflow:
         self.base_kwargs['paired_end'] = self.run_parms.get('paired_end', False)
         self.base_kwargs['local_targets'] = self.run_parms.get('local_targets', False)
         self.base_kwargs['luigi_local_path'] = self.run_parms.get('luigi_local_path', os.getcwd())
+        # node local disk for temporary and staged files, $TMPDIR by default
+        self.base_kwargs['scratch_dir'] = self.run_parms.get('scratch_dir', None)
+        # the BAMs stored as CRAM with `alignment_format: cram`, see cram_alignments
+        self.base_kwargs['cram_suffixes'] = []
 
         # These can be application specific
         self.base_kwargs['gtf_file'] = self.run_parms.get('gtf_file', None)
@@ -497,10 +1152,7 @@ class BaseWorkflow:
         :return:
         """
         if remote:
-            session = saga.Session()
-            ctx = saga.Context("ssh")
-            ctx.user_id = self.run_parms['ssh_user']
-            session.add_context(ctx)
+            session = saga_pool.get_session(self.run_parms['saga_host'], self.run_parms['ssh_user'])
             try:
                 dir = saga.filesystem.Directory(path, session=session)
             except:
@@ -575,7 +1227,9 @@ class BaseWorkflow:
 
     def convert_sra_to_fastq_cmds(self):
         '''
-        Download sra based on ftp urls and process to fastq
+        Convert the downloaded sra files of each sample to fastqs, with one job per sample. The runs of a sample are
+        converted at the same time by fasterq-dump and pigz and concatenated in the order of the runs by
+        bioflows-sra-fastq, see bioflowsutils/sra_fastq.py
         :return:
         '''
 
@@ -584,78 +1238,25 @@ class BaseWorkflow:
 
         # Add samples to a list
         samp_list =[]
+        threads = self.sra_info.get('convert_threads', 8)
         for samp, fileName in self.sample_fastq.iteritems():
-            self.sample_fastq_work[samp] = []
-            if len(fileName) < 2:
-                if not self.paired_end:
-                    sra_name = os.path.basename(fileName[0])
-
-                    cmds.append(' '.join([self.run_parms['conda_command'], ";",
-                                          "fastq-dump", "-v", "-v", "-v", "--gzip",
-                                          os.path.join(self.sra_dir, sra_name), '-O',
-                                          self.fastq_dir, ";",
-                                          " mv -v", os.path.join(self.fastq_dir, sra_name + ".fastq.gz"),
-                                          os.path.join(self.fastq_dir, samp + ".fq.gz"), ";",
-                                          "echo DONE:", fileName[0], "> "]))
-                    samp_list.append(samp)
-                    self.sample_fastq_work[samp].append(os.path.join(self.fastq_dir, samp + ".fq.gz"))
-                else:
-                    sra_name = os.path.basename(fileName[0])
-
-                    cmds.append(' '.join([self.run_parms['conda_command'], ";",
-                                          "fastq-dump", "-v", "-v", "-v", "--gzip", "--split-files",
-                                          os.path.join(self.sra_dir, sra_name),
-                                          '-O',
-                                          self.fastq_dir, ";",
-                                          " mv -v",
-                                          os.path.join(self.fastq_dir, sra_name + "_1.fastq.gz"),
-                                          os.path.join(self.fastq_dir, samp + "_1.fq.gz"), ";",
-                                          " mv -v",
-                                          os.path.join(self.fastq_dir, sra_name + "_2.fastq.gz"),
-                                          os.path.join(self.fastq_dir, samp + "_2.fq.gz"), ";",
-                                          "echo DONE:", fileName[0], "> "]))
-                    samp_list.append(samp)
-
-                    self.sample_fastq_work[samp].append(os.path.join(self.fastq_dir, samp + "_1.fq.gz"))
-                    self.sample_fastq_work[samp].append(os.path.join(self.fastq_dir, samp + "_2.fq.gz"))
+            sra_files = [os.path.join(self.sra_dir, os.path.basename(x)) for x in fileName]
+            convert_cmd = ['bioflows-sra-fastq', '--sample', samp, '--fastq-dir', self.fastq_dir,
+                           '--threads', str(threads)]
+            if self.run_parms.get('scratch_dir') is not None:
+                # the temporary files of fasterq-dump go to the node local disk, $TMPDIR by default
+                convert_cmd += ['--temp-dir', self.run_parms['scratch_dir']]
+            if self.paired_end:
+                convert_cmd.append('--paired-end')
+            cmds.append(' '.join([self.run_parms['conda_command'], ";"] + convert_cmd + sra_files +
+                                 ["&& echo DONE:", samp, "> "]))
+            samp_list.append(samp)
+
+            if self.paired_end:
+                self.sample_fastq_work[samp] = [os.path.join(self.fastq_dir, samp + "_1.fq.gz"),
+                                                os.path.join(self.fastq_dir, samp + "_2.fq.gz")]
             else:
-                if not self.paired_end:
-                    num = 1
-                    for srr_file in fileName:
-                        sra_name = os.path.basename(srr_file)
-                        cmds.append(' '.join([self.run_parms['conda_command'], ";",
-                                              "fastq-dump", "-vvv", "--gzip", os.path.join(self.sra_dir, sra_name),
-                                              '-O',
-                                              self.fastq_dir, ";",
-                                              " cat", os.path.join(self.fastq_dir, sra_name +  ".fastq.gz"),
-                                              ">>", os.path.join(self.fastq_dir, samp + ".fq.gz"), ";",
-                                              "echo DONE:", srr_file, "> "]))
-                        samp_list.append(samp)
-                        num += 1
-                    self.sample_fastq_work[samp].append(os.path.join(self.fastq_dir, samp + ".fq.gz"))
-                else:
-                    num = 1
-                    for srr_file in fileName:
-                        sra_name = os.path.basename(srr_file)
-                        cmds.append(' '.join([self.run_parms['conda_command'], ";",
-                                              "fastq-dump", "-vvv", "--gzip", "--split-files",
-                                              os.path.join(self.sra_dir, sra_name), '-O', self.fastq_dir, ";",
-                                              "cat",
-                                              os.path.join(self.fastq_dir, sra_name + "_1.fastq.gz"),
-                                              ">>", os.path.join(self.fastq_dir, samp + "_1.fq.gz"), ";",
-                                              "rm -v",
-                                              os.path.join(self.fastq_dir, sra_name + "_1.fastq.gz"), ";",
-                                              "cat",
-                                              os.path.join(self.fastq_dir, sra_name + "_2.fastq.gz"),
-                                              ">>", os.path.join(self.fastq_dir, samp + "_2.fq.gz"), ";",
-                                              "rm -v",
-                                              os.path.join(self.fastq_dir, sra_name +  "_2.fastq.gz"), ";",
-                                              "echo DONE:", srr_file, "> "]))
-                        samp_list.append(samp)
-                        num += 1
-
-                    self.sample_fastq_work[samp].append(os.path.join(self.fastq_dir, samp + "_1.fq.gz"))
-                    self.sample_fastq_work[samp].append(os.path.join(self.fastq_dir, samp + "_2.fq.gz"))
+                self.sample_fastq_work[samp] = [os.path.join(self.fastq_dir, samp + ".fq.gz")]
 
         # defaultdict with a default factory of list. A new list is created for each new key.
 
@@ -665,7 +1266,8 @@ class BaseWorkflow:
 
         self.write_cmds(cmds_dict,os.path.join(self.run_parms['work_dir'], "sra_run_cmds.txt"))
 
-        self.symlink_fastqs_submit_jobs(cmds_dict, "symlink.stdout", 300)
+        self.symlink_fastqs_submit_jobs(cmds_dict, "symlink.stdout", self.sra_info.get('convert_time', 300),
+                                        ncpus=threads, mem=self.sra_info.get('convert_mem', 8000))
 
         f=open(os.path.join(self.run_parms['work_dir'],"sra_sample_fastq.csv"),'w')
         for k, v in self.sample_fastq_work.iteritems():
@@ -692,10 +1294,12 @@ class BaseWorkflow:
         f.close()
         return
 
-    def symlink_fastqs_submit_jobs(self, cmds, job_output_suffix, run_time, depend=False):
+    def symlink_fastqs_submit_jobs(self, cmds, job_output_suffix, run_time, depend=False, ncpus=None, mem=None):
         """
         take in a dictionary of sample and associated commands to run for the sample and submit each command as a job
         :param cmds:
+        :param ncpus: cpus of each job, the scheduler default if not given
+        :param mem: memory of each job in MB, the scheduler default if not given
         :return:
         """
         # setup remote session
@@ -703,10 +1307,6 @@ class BaseWorkflow:
         remote_path = self.run_parms['work_dir']
 
         if self.run_parms['saga_host'] != "localhost":
-            session = saga.Session()
-            ctx = saga.Context("ssh")
-            ctx.user_id = self.run_parms['ssh_user']
-            session.add_context(ctx)
             remote_dirs = True
             remote_path = "sftp://" + self.run_parms['saga_host'] + self.run_parms['work_dir']
 
@@ -716,6 +1316,10 @@ class BaseWorkflow:
         jd.executable = ''
         jd.working_directory = self.run_parms['work_dir']
         jd.wall_time_limit = run_time
+        if ncpus is not None:
+            jd.total_cpu_count = ncpus
+        if mem is not None:
+            jd.total_physical_memory = mem
         # jd.output = os.path.join(log_dir, "symlink.stdout")
         # jd.error = os.path.join(log_dir, "symlink.stderr")
         # job_output = os.path.join(self.log_dir, "symlink.stdout")
@@ -723,24 +1327,25 @@ class BaseWorkflow:
 
         # Setup the saga host to use
 
-        js = saga.job.Service("fork://localhost")
+        # The job services come from the shared pool and are not closed here
 
         # Check if the submission is on a remote host
         if self.run_parms['saga_host'] != "localhost":
-            js = saga.job.Service("ssh://" + self.run_parms['saga_host'], session=session)
+            js = saga_pool.get_job_service("ssh", self.run_parms['saga_host'], self.run_parms['ssh_user'])
 
         # check if submission is using a scheduler
 
         elif self.run_parms['saga_host'] == 'localhost' and 'saga_scheduler' in self.run_parms.keys():
-            js = saga.job.Service(self.run_parms['saga_scheduler'] + "://" + self.run_parms['saga_host'])
+            js = saga_pool.get_job_service(self.run_parms['saga_scheduler'], self.run_parms['saga_host'])
 
         # Check if submission is not using a scheduler
         elif self.run_parms['saga_host'] == 'localhost' and 'saga_scheduler' not in self.run_parms.keys():
             self.run_parms['saga_scheduler'] = "fork"
-            js = saga.job.Service("fork://" + self.run_parms['saga_host'])
+            js = saga_pool.get_job_service("fork", self.run_parms['saga_host'])
 
         # Submit jobs
 
+        governor = submit_governor.from_job_parms(self.job_params, self.scripts_dir)
         jobs = []
         for samp,cmd in cmds.iteritems():
             num = 1
@@ -756,8 +1361,7 @@ class BaseWorkflow:
 
                 if num == 1 and depend:
                     jd.arguments = c + " 2>&1 " + job_output
-                    myjob = js.create_job(jd)
-                    myjob.run()
+                    myjob = submit_governor.run_job(js, jd, governor)
                     jobs.append(myjob)
                     prev_job_id = myjob.get_id().split('-')[1].strip('[').strip(']')
                 elif num > 1 and depend:
@@ -765,14 +1369,12 @@ class BaseWorkflow:
                     tmp_args = "#SBATCH--dependency=afterok:" + str(prev_job_id) + "\n"
                     jd.output += "\n" + tmp_args
                     jd.arguments = c + job_output + " 2>&1 "
-                    myjob = js.create_job(jd)
-                    myjob.run()
+                    myjob = submit_governor.run_job(js, jd, governor)
                     jobs.append(myjob)
                     prev_job_id = myjob.get_id().split('-')[1].strip('[').strip(']')
                 else:
                     jd.arguments = c + job_output + " 2>&1 "
-                    myjob = js.create_job(jd)
-                    myjob.run()
+                    myjob = submit_governor.run_job(js, jd, governor)
                     jobs.append(myjob)
 
                 # myjob.run()
@@ -783,15 +1385,10 @@ class BaseWorkflow:
 
         # Wait for all jobs to finish
 
-        while len(jobs) > 0:
-            for job in jobs:
-                jobstate = job.get_state()
-                print ' * Job %s status: %s' % (job.id, jobstate)
-                if jobstate in [saga.job.DONE, saga.job.FAILED]:
-                    jobs.remove(job)
-            print ""
-            time.sleep(60)
-        js.close()
+        tracker = JobTracker(user=self.run_parms.get('ssh_user'))
+        for job in jobs:
+            tracker.add(job)
+        tracker.wait()
         return
 
     def symlink_fastqs(self):
@@ -829,10 +1426,6 @@ class BaseWorkflow:
         remote_path = self.run_parms['work_dir']
 
         if self.run_parms['saga_host'] != "localhost":
-            session = saga.Session()
-            ctx = saga.Context("ssh")
-            ctx.user_id = self.run_parms['ssh_user']
-            session.add_context(ctx)
             remote_dirs = True
             remote_path = "sftp://" + self.run_parms['saga_host'] + self.run_parms['work_dir']
 
@@ -848,15 +1441,15 @@ class BaseWorkflow:
 
         # Setup the saga host to use
 
-        js = saga.job.Service("fork://localhost")
+        # The job services come from the shared pool and are not closed here
+        js = saga_pool.get_job_service("fork", "localhost")
         if self.run_parms['saga_host'] != "localhost":
-            js = saga.job.Service("ssh://" + self.run_parms['saga_host'], session=session)
+            js = saga_pool.get_job_service("ssh", self.run_parms['saga_host'], self.run_parms['ssh_user'])
         elif self.run_parms['saga_host'] == 'localhost' and 'saga_scheduler' in self.run_parms.keys():
             # js = saga.job.Service(self.run_parms['saga_scheduler'] + "://" + self.run_parms['saga_host'])
-            js = saga.job.Service("fork://" + self.run_parms['saga_host'])
+            pass
         elif self.run_parms['saga_host'] == 'localhost' and 'saga_scheduler' not in self.run_parms.keys():
             self.run_parms['saga_scheduler'] = "fork"
-            js = saga.job.Service("fork://" + self.run_parms['saga_host'])
 
         # Submit jobs
         submit_symlink = True
@@ -877,17 +1470,12 @@ class BaseWorkflow:
 
             # Wait for all jobs to finish
 
-            while len(jobs) > 0:
-                for job in jobs:
-                    jobstate = job.get_state()
-                    print ' * Job %s status: %s' % (job.id, jobstate)
-                    if jobstate in [saga.job.DONE, saga.job.FAILED]:
-                        jobs.remove(job)
-                print ""
-                time.sleep(5)
+            tracker = JobTracker(user=self.run_parms.get('ssh_user'), min_interval=2, max_interval=30)
+            for job in jobs:
+                tracker.add(job)
+            tracker.wait()
         else:
             pass
-        js.close()
         return
 
     def symlink_fastqs_local(self):
@@ -996,6 +1584,10 @@ class BaseWorkflow:
                     else:
                         self.prog_job_parms[new_key] = 'default'
 
+                    # Any other settings are passed on to the wrapper for this step
+                    self.prog_step_parms[new_key] = dict((k1, v1) for k1, v1 in v.iteritems()
+                                                         if k1 not in ['subcommand', 'suffix', 'options', 'job_params'])
+
                 # Todo should we use an else here instead of elif
                 elif v == 'default':
 
@@ -1009,6 +1601,7 @@ class BaseWorkflow:
                     self.progs[new_key] = []
                     self.progs[new_key].append('')
                     self.prog_job_parms[new_key] = 'default'
+                    self.prog_step_parms[new_key] = dict()
                     self.prog_input_suffix[new_key] = 'default'
                     self.prog_output_suffix[new_key] = 'default'
                     self.prog_suffix_type[new_key] = 'default'
@@ -1062,6 +1655,38 @@ class BaseWorkflow:
                                           "output": self.prog_output_suffix[key]}
         return self.new_base_kwargs
 
+    def update_step_parms(self, key):
+        self.new_base_kwargs['step_parms'] = self.prog_step_parms.get(key, dict())
+        return self.new_base_kwargs
+
+    def wait_for_submitted_jobs(self, root_task):
+        """
+        Wait for the jobs submitted without blocking (`job_submit_mode: poll`) to finish. All the outstanding jobs
+        are followed with one scheduler query per polling interval. A job has failed if it has left the queue without
+        writing its checkpoint.
+        :param root_task: the luigi task at the top of the workflow
+        :return: list of the failed tasks
+        """
+        tracker = JobTracker(user=self.job_params.get('ssh_user'))
+        pending = []
+        for task in collect_tasks(root_task):
+            for target in luigi.task.flatten(task.output()):
+                if not target.checkpoint_exists():
+                    if target.job_id() is not None:
+                        tracker.add(target.job_id())
+                    pending.append((task, target))
+        print ' * Waiting for %d jobs' % len(pending)
+        tracker.wait()
+
+        failed = []
+        for task, target in pending:
+            if not target.checkpoint_exists():
+                task.fetch_remote_checkpoint()
+            if not target.checkpoint_exists():
+                failed.append(task)
+                print ' * Job %s failed, see %s' % (target.job_id(), task.jobparms['error'])
+        return failed
+
     def create_qiime_inputs(self):
         ln_com = 'ln -s ' + self.base_kwargs['qiime_info']["--input-path"] + ' ' + self.base_kwargs['qiime_dir'] + '/'
         cp_com = 'cp ' + self.base_kwargs['qiime_info']["--m-barcodes-file"] + ' ' + self.run_parms['qiime_dir'] + '/'
@@ -1075,6 +1700,10 @@ class BaseWorkflow:
 class GatkFlow(BaseWorkflow):
     allTasks = []
     progs_job_parms = dict()
+    # interval files of the reference for each number of shards and whether contigs are kept whole
+    interval_files = dict()
+    # the reference the cached copy of the `reference_cache` is made from
+    source_fasta_path = None
 
     def __init__(self, parmsfile):
 
@@ -1123,42 +1752,627 @@ class GatkFlow(BaseWorkflow):
         :return:
         """
 
-        for samp, file in self.sample_fastq_work.iteritems():
+        self.reference_cache_tasks()
+        self.cram_alignments()
+        sample_chains = OrderedDict()
+        step_deps = None
+        gvcf_suffix = None
+        counts_outputs = OrderedDict()
+        for samp, file in sorted(self.sample_fastq_work.iteritems()):
             print "\n *******Commands for Sample:%s ***** \n" % (samp)
-            samp_progs = []
-
-            for key in self.progs.keys():
-                # print "Printing original Parms\n"
-                #print self.prog_job_parms
-                self.update_job_parms(key)
-                self.update_prog_suffixes(key)
-                if self.multi_run_var in key:
-                    input_list = key.split('_')
-                    idx_to_rm = [i for i, s in enumerate(input_list) if self.multi_run_var in s][0]
-                    del input_list[idx_to_rm:]
-                    new_key = '_'.join(input_list)
-                    tmp_prog = self.prog_wrappers[new_key](key, samp, *self.progs[key], **dict(self.new_base_kwargs))
-
-                    # print "new_key", new_key, key
-                    # print self.progs[key], self.progs[new_key]
-                    # print tmp_prog.run_command
-                    # print tmp_prog.job_parms
-
-                    samp_progs.append(jsonpickle.encode(tmp_prog))
-                else:
-                    # print "\n**** Base kwargs *** \n"
-                    # print self.base_kwargs
-                    tmp_prog = self.prog_wrappers[key](key, samp, *self.progs[key], **dict(self.new_base_kwargs))
+            samp_wrappers = self.sample_wrappers(samp)
+            self.intermediate_cleanup(samp_wrappers)
+            sample_chains[samp] = [jsonpickle.encode(x) for x in samp_wrappers]
+            counts_outputs[samp] = self.counts_output(samp_wrappers)
+            # The wiring of the steps is the same for all samples
+            if step_deps is None:
+                step_deps = self.step_dependencies(samp_wrappers)
+                gvcf_suffix = self.gvcf_output(samp_wrappers)
+
+        sample_task = self.chain_step_tasks(sample_chains, step_deps)
+        if self.run_parms.get('joint_genotyping') is not None:
+            if gvcf_suffix is None:
+                print "Error!!! joint_genotyping needs a HaplotypeCaller step writing gVCFs"
+                sys.exit(0)
+            self.joint_genotyping_tasks(sample_chains.keys(), gvcf_suffix[0], gvcf_suffix[1], sample_task)
+        if self.run_parms.get('count_matrix', False):
+            if any(x is None for x in counts_outputs.values()):
+                print "Error!!! count_matrix needs a htseq-count or featureCounts step"
+                sys.exit(0)
+            self.count_matrix_tasks(counts_outputs, sample_task)
+        return
+
+    def sample_wrappers(self, samp):
+        """
+        The wrapper objects of the chain of a sample
+        :param samp: the sample id
+        :return: the wrappers in workflow order
+        """
+        samp_wrappers = []
+        for key in self.progs.keys():
+            # print "Printing original Parms\n"
+            #print self.prog_job_parms
+            self.update_job_parms(key)
+            self.update_prog_suffixes(key)
+            self.update_step_parms(key)
+            if self.multi_run_var in key:
+                input_list = key.split('_')
+                idx_to_rm = [i for i, s in enumerate(input_list) if self.multi_run_var in s][0]
+                del input_list[idx_to_rm:]
+                new_key = '_'.join(input_list)
+                tmp_prog = self.prog_wrappers[new_key](key, samp, *self.progs[key], **dict(self.new_base_kwargs))
+
+                # print "new_key", new_key, key
+                # print self.progs[key], self.progs[new_key]
+                # print tmp_prog.run_command
+                # print tmp_prog.job_parms
+
+                samp_wrappers += reversed(self.scatter_step(samp, key, self.prog_wrappers[new_key], tmp_prog))
+            else:
+                # print "\n**** Base kwargs *** \n"
+                # print self.base_kwargs
+                tmp_prog = self.prog_wrappers[key](key, samp, *self.progs[key], **dict(self.new_base_kwargs))
+
+                # print self.progs[key]
+                # print tmp_prog.run_command
+                # print tmp_prog.job_parms
+                samp_wrappers += reversed(self.scatter_step(samp, key, self.prog_wrappers[key], tmp_prog))
+
+        # self.progs is in reverse order, the chains are kept in the order of the workflow_sequence
+        samp_wrappers.reverse()
+        return self.fuse_picard_metrics(samp, samp_wrappers)
+
+    def cram_alignments(self):
+        """
+        With `alignment_format: cram` work out which BAMs of the chains are stored as CRAM against the reference. A
+        BAM is stored as CRAM when all the programs writing it can write CRAM and all the programs reading it can read
+        CRAM, so files read by tools without CRAM support, e.g. htseq-count, featureCounts or QualiMap, stay BAM. The
+        wiring is the same for all samples so it is worked out on the chain of the first sample, built once with BAMs
+        only, and the chains are then built with the suffixes of the CRAMs in `cram_suffixes`.
+        :return:
+        """
+        self.base_kwargs['cram_suffixes'] = []
+        alignment_format = self.run_parms.get('alignment_format', 'bam')
+        if alignment_format == 'bam':
+            return
+        if alignment_format != 'cram':
+            print "Error!!! alignment_format has to be bam or cram"
+            sys.exit(0)
+        if self.base_kwargs.get('ref_fasta_path') is None:
+            print "Error!!! alignment_format: cram needs the reference_fasta_path"
+            sys.exit(0)
+
+        wrappers = self.sample_wrappers(sorted(self.sample_fastq_work.keys())[0])
+        cram_suffixes = []
+        for i, prog in enumerate(wrappers):
+            for suffix in prog.produces():
+                if not suffix.endswith(".bam") or suffix in cram_suffixes:
+                    continue
+                writers = [x for x in wrappers if suffix in x.produces()]
+                readers = [x for x in wrappers if suffix in x.consumes()]
+                # a program that does not declare its inputs could read the BAM
+                if any(len(x.consumes()) == 0 for x in wrappers[i + 1:]):
+                    continue
+                if all(x.writes_cram() for x in writers) and all(x.reads_cram() for x in readers):
+                    cram_suffixes.append(suffix)
+        print "Stored as CRAM: " + ', '.join(cram_suffixes)
+        self.base_kwargs['cram_suffixes'] = cram_suffixes
+        return
 
-                    # print self.progs[key]
-                    # print tmp_prog.run_command
-                    # print tmp_prog.job_parms
-                    samp_progs.append(jsonpickle.encode(tmp_prog))
+    def reference_cache_tasks(self):
+        """
+        Add the steps building the indexes listed in `reference_cache` into the cache, and point the reference and the
+        `ref_cache:<name>` options of the workflow_sequence to the files in the cache
+        :return:
+        """
+        parms = self.run_parms.get('reference_cache')
+        if parms is None:
+            return
+        cache_dir = parms['dir']
+        sources = {'fasta': parms.get('fasta', self.run_parms.get('reference_fasta_path')),
+                   'gtf': parms.get('gtf', self.run_parms.get('gtf_file')),
+                   'transcripts': parms.get('transcripts')}
+        versions = dict()
+        paths = dict()
+        wrappers = []
+        for index in parms.get('indexes', []):
+            if index not in ref_cache.INDEXES.keys():
+                print "Error!!! unknown index %s in reference_cache, use one of %s" % (
+                    index, ', '.join(sorted(ref_cache.INDEXES.keys())))
+                sys.exit(0)
+            source_keys, tools = ref_cache.INDEXES[index]
+            if sources[source_keys[0]] is None:
+                print "Error!!! the %s index of the reference_cache needs the %s" % (index, source_keys[0])
+                sys.exit(0)
+            for tool in tools:
+                if tool not in versions.keys():
+                    versions[tool] = ref_cache.tool_version(tool, self.run_parms['conda_command'])
+                if versions[tool] is None:
+                    print "Error!!! could not get the version of %s for the reference_cache" % tool
+                    sys.exit(0)
+            key = ref_cache.index_key(index, sources, versions, cache_dir)
+            paths.update(ref_cache.index_paths(index, os.path.join(cache_dir, index, key), sources))
+            wrappers.append(wr.ReferenceIndex(self.bioproject, index, cache_dir, key,
+                                              dict((x, sources[x]) for x in source_keys),
+                                              ref_job_parms=parms.get('job_params'), **dict(self.base_kwargs)))
+        if len(wrappers) == 0:
+            return
+
+        if 'fasta' in paths.keys():
+            # the cached copy is only written by the jobs, the driver keeps reading the source
+            self.source_fasta_path = sources['fasta']
+            self.base_kwargs['ref_fasta_path'] = paths['fasta']
+            self.new_base_kwargs['ref_fasta_path'] = paths['fasta']
+
+        def cached_path(match):
+            if match.group(1) not in paths.keys():
+                print "Error!!! %s is not built by the reference_cache" % match.group(0)
+                sys.exit(0)
+            return paths[match.group(1)]
+        for key in self.progs.keys():
+            self.progs[key] = [re.sub(r'ref_cache:(\w+)', cached_path, x) for x in self.progs[key]]
+
+        # The indexes are built independently of each other
+        step_deps = [[] for x in wrappers]
+        chain_id = store_chain([jsonpickle.encode(x) for x in wrappers])
+        cohort_inputs[chain_id] = [[] for x in wrappers]
+        for i in range(len(wrappers)):
+            reference_tasks.append(jsonpickle.encode(CohortTask(chain_id=chain_id, step=i, step_deps=step_deps)))
+        return
 
-            self.allTasks.append(jsonpickle.encode(TaskSequence(prog_parms=samp_progs, n_tasks=len(samp_progs))))
+    def scatter_step(self, samp, key, wrapper, prog):
+        """
+        Split a step with `scatter: N` in the workflow_sequence into N steps that run in parallel, followed by a step
+        gathering their outputs. GATK steps are split by intervals of the reference and aligners by chunks of reads.
+        :param samp: the sample id
+        :param key: the name of the step in the workflow_sequence
+        :param wrapper: the wrapper class of the step
+        :param prog: the wrapper object of the step run on all the data
+        :return: the wrapper objects replacing the step, in workflow order
+        """
+        n_shards = int(prog.step_parms.get('scatter', 1))
+        if n_shards < 2:
+            return [prog]
+        if isinstance(prog, wr_gatk.Gatk):
+            return self.scatter_gatk_step(samp, key, wrapper, prog, n_shards)
+        elif isinstance(prog, (wr.Bwa, wr.Gsnap)):
+            return self.scatter_alignment_step(samp, key, wrapper, prog, n_shards)
+        print "Warning!!! %s can not be scattered, running it as one step" % key
+        return [prog]
+
+    def scatter_alignment_step(self, samp, key, wrapper, prog, n_chunks):
+        """
+        Split the fastqs of a sample into chunks, align the chunks as separate steps into sorted BAMs and merge them
+        :return: the wrapper objects replacing the aligner, in workflow order
+        """
+        chunks = []
+        for idx in range(n_chunks):
+            chunk_kwargs = dict(self.new_base_kwargs)
+            chunk_kwargs['shard'] = "%04d" % idx
+            # the chunks are merged, so they are sorted as they are aligned
+            chunk_kwargs['step_parms'] = dict(prog.step_parms, stream='sorted_bam')
+            chunks.append(wrapper(key, samp, *self.progs[key], **chunk_kwargs))
+        return [wr.FastqSplit(samp, prog, n_chunks, **dict(self.new_base_kwargs))] + chunks + \
+               [wr.AlignmentMerge(samp, prog, chunks, **dict(self.new_base_kwargs))]
+
+    def reference_interval_files(self, n_shards, whole_contigs=False):
+        """
+        The interval files splitting the reference into `n_shards` shards. The contigs are read from the source of the
+        `reference_cache` copy, which does not exist until its job has run, and a reference without a `.fai` or
+        `.dict` is indexed with `samtools faidx` first
+        :param n_shards: number of shards
+        :param whole_contigs: only cut the reference between contigs
+        :return: list of the interval files, or None if the contig lengths could not be read
+        """
+        if (n_shards, whole_contigs) in self.interval_files.keys():
+            return self.interval_files[(n_shards, whole_contigs)]
+        ref_fasta = self.source_fasta_path or self.base_kwargs['ref_fasta_path']
+        if ref_fasta is None:
+            return None
+        ref_fasta = str(ref_fasta)
+        if intervals.reference_contigs(ref_fasta) is None and os.path.exists(ref_fasta):
+            cmd = "samtools faidx " + ref_fasta
+            if self.run_parms.get('conda_command') is not None:
+                cmd = self.run_parms['conda_command'] + " > /dev/null 2>&1; " + cmd
+            print "Indexing the reference for the interval shards: samtools faidx " + ref_fasta
+            if subprocess.call(['bash', '-c', cmd]) != 0:
+                print "Warning!!! samtools faidx failed on " + ref_fasta
+        self.interval_files[(n_shards, whole_contigs)] = intervals.write_interval_shards(
+            ref_fasta, n_shards, os.path.join(self.gatk_dir, 'intervals'), whole_contigs)
+        return self.interval_files[(n_shards, whole_contigs)]
+
+    def scatter_gatk_step(self, samp, key, wrapper, prog, n_shards):
+        """
+        Split a GATK step into one step per interval shard of the reference and gather their outputs
+        :return: the wrapper objects replacing the step, in workflow order
+        """
+        if not prog.scatterable():
+            print "Warning!!! %s can not be scattered over intervals, running it on the whole genome" % key
+            return [prog]
+
+        # a BAM gathered from shards cut inside contigs would have the reads overlapping the cuts twice
+        interval_files = self.reference_interval_files(n_shards,
+                                                       prog.subcommand not in wr_gatk.SPLIT_CONTIG_TOOLS)
+        if interval_files is None:
+            print "Warning!!! Could not read the contigs of the reference, running %s on the whole genome" % key
+            return [prog]
+        if prog.subcommand == "PrintReads":
+            # keep the unmapped reads in the recalibrated BAM
+            interval_files = interval_files + ['unmapped']
+
+        shards = []
+        for idx, interval_file in enumerate(interval_files):
+            shard_kwargs = dict(self.new_base_kwargs)
+            shard_kwargs['shard'] = "%04d" % idx
+            shard_kwargs['scatter_interval'] = interval_file
+            shards.append(wrapper(key, samp, *self.progs[key], **shard_kwargs))
+        return shards + [wr_gatk.GatkGather(samp, prog, shards, **dict(self.new_base_kwargs))]
+
+    def fuse_picard_metrics(self, samp, wrappers):
+        """
+        Replace the Picard metric steps that read the same BAM by one CollectMultipleMetrics step, which takes the
+        place of the first of them in the chain. Steps with options of their own are left out. Turned off with
+        `fuse_picard_metrics: False`.
+        :param samp: the sample id
+        :param wrappers: the wrapper objects of a chain in workflow order
+        :return: the wrappers with the metric steps fused
+        """
+        if not self.run_parms.get('fuse_picard_metrics', True):
+            return wrappers
+
+        groups = OrderedDict()
+        for i, prog in enumerate(wrappers):
+            # steps with their own options are run on their own, CollectMultipleMetrics can not pass them on
+            if isinstance(prog, wr_picard.Picard) and prog.subcommand in wr_picard.MULTIPLE_METRICS.keys() and \
+                    len(prog.user_args) == 0:
+                groups.setdefault(prog.in_suffix, []).append(i)
+
+        fused = list(wrappers)
+        round_counter = 0
+        for in_suffix, steps in groups.iteritems():
+            if len(steps) < 2:
+                continue
+            round_counter += 1
+            name = "picard_CollectMultipleMetrics"
+            if round_counter > 1:
+                name += "_" + self.multi_run_var + "_" + str(round_counter)
+            # the fused step keeps the settings of the first of the steps, e.g. its step_parms and suffixes, the
+            # files it writes are set up by PicardMultipleMetrics
+            kwargs = dict(wrappers[steps[0]].prog_args)
+            for k in ['target', 'prog_id', 'stdout', 'stdout_append', 'stderr', 'pipe', 'source']:
+                kwargs.pop(k, None)
+            fused[steps[0]] = wr_picard.PicardMultipleMetrics(name, samp, [wrappers[i] for i in steps], **kwargs)
+            for i in steps[1:]:
+                fused[i] = None
+        return [x for x in fused if x is not None]
+
+    def intermediate_cleanup(self, wrappers):
+        """
+        With `cleanup_intermediates` the files a step writes are removed, with their indexes, as soon as all the later
+        steps reading them have written their checkpoints. Each of these steps gets a `cleanup_command` that removes
+        the files if the checkpoints of the other readers exist, so the last one to finish removes them. Files that no
+        later step reads are the products of the workflow and are kept, as are the suffixes matching the `keep` list,
+        files written by more than one step and files written before a step that does not declare its inputs.
+        :param wrappers: the wrapper objects of a chain in workflow order
+        :return:
+        """
+        parms = self.run_parms.get('cleanup_intermediates', False)
+        if not parms:
+            return
+        keep = parms.get('keep', []) if isinstance(parms, dict) else []
+        index_exts = ('.bai', '.crai', '.csi', '.tbi')
+
+        producers = defaultdict(list)
+        for i, prog in enumerate(wrappers):
+            for suffix in prog.produces():
+                producers[suffix].append(i)
+
+        # an index is removed with the file it indexes
+        groups = OrderedDict()
+        for suffix in producers.keys():
+            base = os.path.splitext(suffix)[0] if suffix.endswith(index_exts) else suffix
+            if base not in producers.keys():
+                base = suffix
+            groups.setdefault(base, []).append(suffix)
+
+        cleanups = defaultdict(list)
+        for base, suffixes in groups.iteritems():
+            if any(fnmatch.fnmatch(x, pattern) for x in suffixes for pattern in keep):
+                continue
+            if any(len(producers[x]) > 1 for x in suffixes):
+                continue
+            first = min(producers[x][0] for x in suffixes)
+            consumers = sorted(set(i for i, prog in enumerate(wrappers) for x in suffixes if x in prog.consumes()))
+            if len(consumers) == 0 or consumers[0] <= first:
+                continue
+            if any(len(wrappers[i].consumes()) == 0 for i in range(first + 1, len(wrappers))):
+                continue
+            checks = ' && '.join("[ -e %s ]" % wrappers[i].luigi_target for i in consumers)
+            prog = wrappers[first]
+            # the reads of a pair are only kept apart in the fastq directory
+            paths = [os.path.join(d, prog.input + x) for x in suffixes for d in [prog.align_dir, prog.qc_dir]]
+            paths += [os.path.join(prog.cwd, 'fastq', prog.input + r + x) for x in suffixes for r in ['', '_1', '_2']]
+            paths = OrderedDict.fromkeys(paths).keys()
+            for i in consumers:
+                cleanups[i].append("if %s; then rm -f %s; fi" % (checks, ' '.join(paths)))
+
+        for i, commands in cleanups.iteritems():
+            wrappers[i].cleanup_command = '; '.join(commands)
+        return
 
+    def chain_step_tasks(self, sample_chains, step_deps):
+        """
+        Add the luigi tasks for the last steps of the chains, the other steps are pulled in through their dependencies
+        :param sample_chains: dictionary of sample to the list of encoded programs in workflow order
+        :param step_deps: for each step the list of steps it depends on
+        :return: function giving the task of a step for the sample with the given index, for the cohort steps
+        """
+        final_steps = [i for i in range(len(step_deps)) if not any(i in x for x in step_deps)]
+        chain_ids = [store_chain(x) for x in sample_chains.values()]
+
+        if self.run_parms.get('job_array', False) and self.job_params['saga_scheduler'].startswith('slurm') \
+                and self.job_params['executor'] != 'local':
+            # Submit each step for all samples as one job array, the samples are in the same order in every step
+            for i in final_steps:
+                self.allTasks.append(jsonpickle.encode(ArrayTask(chain_ids=chain_ids, step=i, step_deps=step_deps)))
+            return lambda idx, step: ArrayTask(chain_ids=chain_ids, step=step, step_deps=step_deps)
+        else:
+            # Short steps listed in htc_steps are run for groups of htc_batch samples in one allocation
+            batch_size = max(int(self.run_parms.get('htc_batch', 64)), 1)
+            chain_groups = dict()
+            for b in range(0, len(chain_ids), batch_size):
+                group_id = store_group(chain_ids[b:b + batch_size])
+                chain_groups.update((x, group_id) for x in chain_ids[b:b + batch_size])
+            step_ids = [task_spec(x).prog_id for x in sample_chains.values()[0]]
+            pool_steps = []
+            if self.job_params['saga_scheduler'].startswith('slurm') and self.job_params['executor'] != 'local':
+                pool_steps = [i for i, x in enumerate(step_ids) if x in self.run_parms.get('htc_steps', [])]
+            self.batch_steps(sample_chains, chain_ids, pool_steps)
+            for i in final_steps:
+                final_tasks = OrderedDict()
+                for chain_id in chain_ids:
+                    task = chain_step_task(chain_id, chain_groups[chain_id], i, step_deps, pool_steps)
+                    final_tasks[task.task_id] = task
+                self.allTasks += [jsonpickle.encode(x) for x in final_tasks.values()]
+            return lambda idx, step: chain_step_task(chain_ids[idx], chain_groups[chain_ids[idx]], step, step_deps,
+                                                     pool_steps)
+
+    def batch_steps(self, sample_chains, chain_ids, pool_steps):
+        """
+        Set up the batches of the featureCounts steps with `batch: N` in the workflow_sequence, each batch of N samples
+        is counted by one featureCounts job
+        :param sample_chains: dictionary of sample to the list of encoded programs in workflow order
+        :param chain_ids: the chain ids of the samples
+        :param pool_steps: the steps run for all samples with a `PoolTask`, which are not batched
+        :return:
+        """
+        for i, prog_input in enumerate(sample_chains.values()[0]):
+            prog = jsonpickle.decode(prog_input)
+            if not isinstance(prog, wr.FeatureCounts) or i in pool_steps:
+                continue
+            batch_size = int(prog.step_parms.get('batch', 1))
+            if batch_size < 2:
+                continue
+            members = [jsonpickle.decode(x[i]) for x in sample_chains.values()]
+            for b in range(0, len(members), batch_size):
+                batch_prog = wr.FeatureCountsBatch(self.bioproject, b // batch_size, members[b:b + batch_size],
+                                                   **dict(self.base_kwargs))
+                store_batch(jsonpickle.encode(batch_prog), chain_ids[b:b + batch_size], i)
         return
 
+    def gvcf_output(self, wrappers):
+        """
+        Find the last step of a chain writing a gVCF
+        :param wrappers: the wrapper objects of a chain in workflow order
+        :return: (step, suffix) or None
+        """
+        for i in reversed(range(len(wrappers))):
+            gvcfs = [x for x in wrappers[i].produces() if '.g.vcf' in x and '.shard' not in x]
+            if len(gvcfs) > 0:
+                return i, gvcfs[0]
+        return None
+
+    def joint_genotyping_tasks(self, samples, gvcf_step, gvcf_suffix, sample_task):
+        """
+        Add the cohort stage genotyping the gVCFs of all samples together. The reference is split into interval shards
+        that are genotyped in parallel and merged at the end. In each shard the gVCFs are combined with a tree of
+        CombineGVCFs of `batch_size` gVCFs each, or imported into a GenomicsDB workspace with `method: genomicsdb`,
+        before GenotypeGVCFs, so no single job has to read all the gVCFs of a large cohort at once.
+        :param samples: the sample ids in the order of the chains
+        :param gvcf_step: the step of the sample chains writing the gVCF
+        :param gvcf_suffix: the suffix of the gVCF
+        :param sample_task: function giving the task of a step for the sample with the given index
+        :return:
+        """
+        parms = self.run_parms['joint_genotyping']
+        n_shards = int(parms.get('scatter', 1))
+        batch_size = max(int(parms.get('batch_size', 50)), 2)
+        tool = parms.get('gatk', 'gatk4')
+        cohort = self.bioproject
+        joint_dir = os.path.join(self.gatk_dir, 'joint_genotyping')
+        if not os.path.exists(joint_dir):
+            os.makedirs(joint_dir)
+
+        # GATK3 GenotypeGVCFs cannot drop the calls starting before a shard, so its shards are whole contigs
+        interval_files = self.reference_interval_files(n_shards, tool != 'gatk4')
+        if interval_files is None:
+            print "Error!!! joint_genotyping could not read the contigs of the reference"
+            sys.exit(0)
+
+        options = []
+        for k, v in parms.get('options', dict()).iteritems():
+            if v is None:
+                options.append("%s" % k)
+            else:
+                options += ["%s %s" % (k, x) for x in (v if isinstance(v, list) else [v])]
+
+        gvcfs = [os.path.join(self.gatk_dir, x + gvcf_suffix) for x in samples]
+        kwargs = dict(self.base_kwargs)
+        kwargs['add_job_parms'] = parms.get('job_params')
+        kwargs['cohort_digest'] = hashlib.sha224(','.join(gvcfs)).hexdigest()
+        if parms.get('method', 'combine') == 'genomicsdb':
+            kwargs['sample_map'] = os.path.join(joint_dir, cohort + ".sample_map")
+            kwargs['batch_size'] = batch_size
+            f = open(kwargs['sample_map'], 'w')
+            for samp, gvcf in zip(samples, gvcfs):
+                f.write(samp + "\t" + gvcf + "\n")
+            f.close()
+
+        # The steps of the cohort chain, the steps each depends on and the samples whose gVCFs each reads
+        wrappers = []
+        step_deps = []
+        step_samples = []
+
+        def add_step(wrapper, deps, samps):
+            wrappers.append(wrapper)
+            step_deps.append(sorted(deps))
+            step_samples.append(sorted(samps))
+            return len(wrappers) - 1
+
+        genotyped = []
+        for shard, interval in enumerate(interval_files):
+            shard_id = "shard%04d" % shard
+            kwargs['interval'] = interval
+            if parms.get('method', 'combine') == 'genomicsdb':
+                workspace = os.path.join(joint_dir, cohort + "." + shard_id + ".gdb")
+                step = add_step(wr_gatk.GatkCohort(tool + "_GenomicsDBImport", cohort, shard_id, gvcfs, workspace,
+                                                   **kwargs), [], range(len(samples)))
+                level = [("gendb://" + workspace, [step], [])]
+            else:
+                # each item is a gVCF with the steps and samples it comes from
+                level = [(x, [], [i]) for i, x in enumerate(gvcfs)]
+                depth = 0
+                while len(level) > 1:
+                    depth += 1
+                    next_level = []
+                    for b in range(0, len(level), batch_size):
+                        batch = level[b:b + batch_size]
+                        if len(batch) == 1:
+                            next_level += batch
+                            continue
+                        step_id = "%s_l%d_b%04d" % (shard_id, depth, b // batch_size)
+                        combined = os.path.join(joint_dir, cohort + "." + step_id + ".g.vcf.gz")
+                        step = add_step(wr_gatk.GatkCohort(tool + "_CombineGVCFs", cohort, step_id,
+                                                           [x[0] for x in batch], combined, **kwargs),
+                                        [y for x in batch for y in x[1]], [y for x in batch for y in x[2]])
+                        next_level.append((combined, [step], []))
+                    level = next_level
+            vcf = os.path.join(joint_dir, cohort + "." + shard_id + ".vcf.gz")
+            genotyped.append(add_step(wr_gatk.GatkCohort(tool + "_GenotypeGVCFs", cohort, shard_id, [level[0][0]],
+                                                         vcf, *options, **kwargs), level[0][1], level[0][2]))
+
+        final_step = genotyped[0]
+        if len(genotyped) > 1:
+            kwargs['interval'] = None
+            final_step = add_step(wr_gatk.GatkCohort("picard_MergeVcfs", cohort, "gather",
+                                                     [wrappers[x].output for x in genotyped],
+                                                     os.path.join(joint_dir, cohort + ".vcf.gz"), **kwargs),
+                                  genotyped, [])
+
+        self.cohort_chain_tasks(wrappers, step_deps, step_samples, gvcf_step, sample_task, final_step)
+        return
+
+    def counts_output(self, wrappers):
+        """
+        Find the last counting step of a chain
+        :param wrappers: the wrapper objects of a chain in workflow order
+        :return: (step, wrapper) or None
+        """
+        for i in reversed(range(len(wrappers))):
+            if getattr(wrappers[i], 'counts_file', None) is not None:
+                return i, wrappers[i]
+        return None
+
+    def count_matrix_tasks(self, counts_outputs, sample_task):
+        """
+        Add the cohort step adding the counts of the samples to the count matrix of the project
+        :param counts_outputs: dictionary of sample to the step and wrapper of its counting step
+        :param sample_task: function giving the task of a step for the sample with the given index
+        :return:
+        """
+        parms = self.run_parms['count_matrix']
+        if not isinstance(parms, dict):
+            parms = dict()
+        counts_step, counts_prog = counts_outputs.values()[0]
+        expression_dir = self.base_kwargs.get('expression_dir', os.path.join(self.work_dir, 'expression'))
+        sample_list = os.path.join(expression_dir, self.bioproject + "_" + counts_prog.counts_source + "_samples.txt")
+        f = open(sample_list, 'w')
+        for samp, x in counts_outputs.iteritems():
+            f.write(samp + "\t" + x[1].counts_file + "\n")
+        f.close()
+
+        kwargs = dict(self.base_kwargs)
+        kwargs['expression_dir'] = expression_dir
+        kwargs['sparse'] = parms.get('sparse', False)
+        kwargs['cohort_digest'] = hashlib.sha224(open(sample_list).read()).hexdigest()
+        wrapper = wr.CountMatrixBuilder(self.bioproject, counts_prog.counts_source, sample_list, **kwargs)
+        self.cohort_chain_tasks([wrapper], [[]], [range(len(counts_outputs))], counts_step, sample_task, 0)
+        return
+
+    def cohort_chain_tasks(self, wrappers, step_deps, step_samples, sample_step, sample_task, final_step):
+        """
+        Store the steps of a cohort as a chain and add the task of its last step
+        :param wrappers: the wrapper objects of the cohort steps
+        :param step_deps: for each cohort step the cohort steps it depends on
+        :param step_samples: for each cohort step the indexes of the samples whose outputs it reads
+        :param sample_step: the step of the sample chains writing these outputs
+        :param sample_task: function giving the task of a step for the sample with the given index
+        :param final_step: the last cohort step
+        :return:
+        """
+        chain_id = store_chain([jsonpickle.encode(x) for x in wrappers])
+        cohort_inputs[chain_id] = [sorted(set([jsonpickle.encode(sample_task(i, sample_step)) for i in x]))
+                                   for x in step_samples]
+        self.allTasks.append(jsonpickle.encode(CohortTask(chain_id=chain_id, step=final_step, step_deps=step_deps)))
+        return
+
+    def step_dependencies(self, wrappers):
+        """
+        Work out which steps each step has to wait for. With `task_graph: dag` a step depends on the last earlier step
+        that writes each suffix it reads, and on earlier steps that read or write the suffixes it writes so files
+        are not overwritten while in use. Suffixes that no earlier step writes are either the fastqs, which are
+        ready at the start, or files whose origin is unknown, in which case the step waits for the step before it.
+        Without `task_graph: dag` every step depends on the step before it, except for the shards of a step scattered
+        over intervals of the reference, which run together.
+        :param wrappers: the wrapper objects of a chain in workflow order
+        :return: list with the list of steps each step depends on
+        """
+        if self.run_parms.get('task_graph', 'linear') != 'dag':
+            # The shards of a scattered step all wait for the step before them and the gather step waits for the shards
+            step_deps = []
+            for i, prog in enumerate(wrappers):
+                if prog.gather_group is not None:
+                    step_deps.append([j for j in range(i) if wrappers[j].scatter_group == prog.gather_group])
+                    continue
+                first = i
+                while prog.scatter_group is not None and first > 0 \
+                        and wrappers[first - 1].scatter_group == prog.scatter_group:
+                    first -= 1
+                step_deps.append([first - 1] if first > 0 else [])
+            return step_deps
+
+        step_deps = []
+        for i, prog in enumerate(wrappers):
+            deps = set()
+            if len(prog.consumes()) == 0 and i > 0:
+                # the wrapper does not declare its inputs
+                deps.add(i - 1)
+            for suffix in prog.consumes():
+                producers = [j for j in range(i) if suffix in wrappers[j].produces()]
+                if len(producers) > 0:
+                    deps.add(producers[-1])
+                    # BAMs and CRAMs also need their index if an earlier step built one
+                    index_producers = [j for j in range(i) if suffix + ".bai" in wrappers[j].produces() or
+                                       suffix + ".crai" in wrappers[j].produces()]
+                    if len(index_producers) > 0:
+                        deps.add(index_producers[-1])
+                elif not suffix.endswith(("fq.gz", "fastq.gz")) and i > 0:
+                    deps.add(i - 1)
+            for suffix in prog.produces():
+                deps.update([j for j in range(i) if suffix in wrappers[j].consumes() + wrappers[j].produces()])
+            step_deps.append(sorted(deps))
+        return step_deps
+
     def chain_commands_qiime(self):
         """
         Create a n ordered list of commands to be run sequentially for each sample for use with the Luigi scheduler.
@@ -1180,6 +2394,7 @@ class GatkFlow(BaseWorkflow):
             print self.prog_job_parms
             self.update_job_parms(key)
             self.update_prog_suffixes(key)
+            self.update_step_parms(key)
             if self.multi_run_var in key:
                 input_list = key.split('_')
                 idx_to_rm = [i for i, s in enumerate(input_list) if self.multi_run_var in s][0]
@@ -1203,7 +2418,8 @@ class GatkFlow(BaseWorkflow):
                 #print tmp_prog.job_parms
                 samp_progs.append(jsonpickle.encode(tmp_prog))
 
-            self.allTasks.append(jsonpickle.encode(TaskSequence(prog_parms=samp_progs, n_tasks=len(samp_progs))))
+            self.allTasks.append(jsonpickle.encode(TaskSequence(chain_id=store_chain(samp_progs),
+                                                                n_tasks=len(samp_progs))))
 
         return
 
@@ -1219,6 +2435,10 @@ def gatk_main():
 
     # Actual jobs start here
     gt1.test_paths()
+    # the submission state of an earlier run of the workflow is not carried over
+    governor = submit_governor.from_job_parms(gt1.job_params, gt1.scripts_dir)
+    if governor is not None:
+        governor.reset()
 
     if 'sra' in gt1.sample_manifest.keys():
         gt1.download_sra_cmds()
@@ -1235,14 +2455,31 @@ def gatk_main():
     else:
         gt1.chain_commands()
         luigi_workers = len(gt1.sample_fastq_work.keys())
-    # todo make the number of workers a parameter for luigi as slurm has limits on the number of submissions and
-    # this can breask luigi
+    # The submissions themselves are throttled by the submit governor, the number of workers only limits
+    # the number of jobs luigi waits on at the same time
+    luigi_workers = min(gt1.run_parms.get('luigi_workers', 50), luigi_workers)
+    if gt1.job_params['executor'] == 'local':
+        # Enough workers to fill the machine, luigi holds back the tasks that do not fit in the resources
+        luigi_workers = gt1.run_parms.get('luigi_workers', gt1.job_params['local_cpus'])
+        config = luigi.configuration.get_config()
+        if not config.has_section('resources'):
+            config.add_section('resources')
+        config.set('resources', 'cpu', str(gt1.job_params['local_cpus']))
+        config.set('resources', 'mem', str(gt1.job_params['local_mem']))
     luigi_exe = os.path.join(os.environ['CONDA_PREFIX'], "bin/luigid")
     # luigi_srv = subprocess.Popen([luigi_exe,'--port=9000'], stdout=subprocess.PIPE,stderr=subprocess.PIPE)
     # print "ProcessID:", luigi_srv.pid
 
-    luigi.build([TaskFlow(tasks=gt1.allTasks, task_name=gt1.bioproject)], local_scheduler=True,
-                workers=min(50, luigi_workers), lock_size=1, log_level='INFO')
+    if gt1.job_params['executor'] != 'local':
+        # the forked luigi workers submit their jobs through the driver, which keeps the SAGA connections open
+        saga_pool.start_submit_server()
+    flow = TaskFlow(tasks=gt1.allTasks, task_name=gt1.bioproject)
+    luigi.build([flow], local_scheduler=True,
+                workers=luigi_workers, lock_size=1, log_level='INFO')
+
+    # With job_submit_mode poll luigi returns once all the jobs are submitted
+    if gt1.job_params['submit_mode'] == 'poll':
+        gt1.wait_for_submitted_jobs(flow)
 
     # luigi_srv.terminate()
     # print luigi_srv.communicate()
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bioflows.bioflowsutils.count_matrix import CountMatrix
+
+
+class TestCountMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.counts = dict()
+        for samp, counts in [('s1', [5, 0, 3]), ('s2', [0, 0, 7]), ('s3', [1, 2, 0])]:
+            self.counts[samp] = os.path.join(self.tmp_dir, samp + "_htseq_counts")
+            f = open(self.counts[samp], 'w')
+            for gene, count in zip(['g1', 'g2', 'g3'], counts):
+                f.write("%s\t%d\n" % (gene, count))
+            f.write("__no_feature\t10\n__ambiguous\t0\n")
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build_matrix(self, sparse):
+        matrix_dir = os.path.join(self.tmp_dir, 'matrix')
+        matrix = CountMatrix(matrix_dir, sparse)
+        matrix.add_sample('s1', self.counts['s1'], 'htseq')
+        matrix.add_sample('s2', self.counts['s2'], 'htseq')
+        # samples are appended to an existing matrix
+        matrix = CountMatrix(matrix_dir)
+        self.assertFalse(matrix.add_sample('s1', self.counts['s1'], 'htseq'))
+        self.assertTrue(matrix.add_sample('s3', self.counts['s3'], 'htseq'))
+        tsv = os.path.join(self.tmp_dir, 'matrix.tsv')
+        matrix.write_tsv(tsv, block_size=2)
+        return open(tsv).read()
+
+    def test_dense_matrix(self):
+        print "\n***** Testing the count matrix *****\n"
+        self.assertEqual(self.build_matrix(False), "gene_id\ts1\ts2\ts3\ng1\t5\t0\t1\ng2\t0\t0\t2\ng3\t3\t7\t0\n")
+
+    def test_sparse_matrix(self):
+        print "\n***** Testing the sparse count matrix *****\n"
+        self.assertEqual(self.build_matrix(True), "gene_id\ts1\ts2\ts3\ng1\t5\t0\t1\ng2\t0\t0\t2\ng3\t3\t7\t0\n")
+
+    def test_changed_counts(self):
+        print "\n***** Testing updating a sample of the count matrix *****\n"
+        matrix_dir = os.path.join(self.tmp_dir, 'matrix')
+        matrix = CountMatrix(matrix_dir)
+        matrix.add_sample('s1', self.counts['s1'], 'htseq')
+        matrix.add_sample('s2', self.counts['s2'], 'htseq')
+        f = open(self.counts['s1'], 'w')
+        f.write("g1\t6\ng2\t1\ng3\t3\n")
+        f.close()
+        # the column of a sample is written again when its counts change
+        matrix = CountMatrix(matrix_dir)
+        self.assertTrue(matrix.add_sample('s1', self.counts['s1'], 'htseq'))
+        self.assertFalse(matrix.add_sample('s1', self.counts['s1'], 'htseq'))
+        tsv = os.path.join(self.tmp_dir, 'matrix.tsv')
+        CountMatrix(matrix_dir).write_tsv(tsv)
+        self.assertEqual(open(tsv).read(), "gene_id\ts1\ts2\ng1\t6\t0\ng2\t1\t0\ng3\t3\t7\n")
+
+    def test_gene_order(self):
+        print "\n***** Testing the gene order check of the count matrix *****\n"
+        matrix = CountMatrix(os.path.join(self.tmp_dir, 'matrix'))
+        matrix.add_sample('s1', self.counts['s1'], 'htseq')
+        f = open(self.counts['s2'], 'w')
+        f.write("g2\t1\ng1\t1\ng3\t1\n")
+        f.close()
+        self.assertRaises(ValueError, matrix.add_sample, 's2', self.counts['s2'], 'htseq')
+        self.assertEqual(matrix.samples, ['s1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from bioflows.bioflowsutils import intervals
+
+
+class TestIntervals(unittest.TestCase):
+
+    def test_split_intervals(self):
+        print "\n***** Testing splitting of the reference into shards *****\n"
+        contigs = [('chr1', 1000), ('chr2', 600), ('chrM', 16), ('chrUn', 384)]
+        shards = intervals.split_intervals(contigs, 4)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards[0], [('chr1', 1, 500)])
+        self.assertEqual(shards[1], [('chr1', 501, 1000)])
+        self.assertEqual(shards[3], [('chr2', 501, 600), ('chrM', 1, 16), ('chrUn', 1, 384)])
+        # every base is in exactly one shard
+        self.assertEqual(sum([x[2] - x[1] + 1 for s in shards for x in s]), 2000)
+
+    def test_more_shards_than_bases(self):
+        print "\n***** Testing splitting of a small reference *****\n"
+        shards = intervals.split_intervals([('chr1', 3)], 10)
+        self.assertEqual(shards, [[('chr1', 1, 1)], [('chr1', 2, 2)], [('chr1', 3, 3)]])
+
+    def test_whole_contig_shards(self):
+        print "\n***** Testing splitting of the reference on whole contigs *****\n"
+        contigs = [('chr1', 1000), ('chr2', 600), ('chrM', 16), ('chrUn', 384)]
+        shards = intervals.split_intervals(contigs, 4, whole_contigs=True)
+        self.assertEqual(shards, [[('chr1', 1, 1000)], [('chr2', 1, 600), ('chrM', 1, 16), ('chrUn', 1, 384)]])
+        # no shard boundary falls inside a contig, e.g. for PrintReads
+        for shard in intervals.split_intervals(contigs + [('chrX', 300), ('chrY', 100)], 6, whole_contigs=True):
+            for name, start, end in shard:
+                self.assertEqual((start, end), (1, dict(contigs + [('chrX', 300), ('chrY', 100)])[name]))
+        # shards are not smaller than the longest contig
+        self.assertEqual(len(intervals.split_intervals(contigs, 10, whole_contigs=True)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
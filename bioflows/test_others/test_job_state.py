@@ -0,0 +1,58 @@
+import unittest
+
+from bioflows.bioflowsutils import job_state as js
+
+
+class TestJobState(unittest.TestCase):
+
+    def test_parse_saga_job_id(self):
+        print "\n***** Testing parsing of SAGA job ids *****\n"
+        self.assertEqual(js.parse_saga_job_id('[slurm+ssh://ssh.ccv.brown.edu]-[1234]'),
+                         ('slurm+ssh', 'ssh.ccv.brown.edu', '1234'))
+        self.assertEqual(js.native_job_id('[slurm://localhost]-[1234_5]'), '1234_5')
+
+    def test_parse_slurm_states(self):
+        print "\n***** Testing parsing of squeue/sacct output *****\n"
+        squeue_out = "100_0,RUNNING\n100_1,PENDING\n200,COMPLETING\n"
+        states = js.parse_slurm_states(squeue_out, ',')
+        self.assertEqual(states['100_1'], js.PENDING)
+        self.assertEqual(states['100'], js.RUNNING)
+        self.assertEqual(states['200'], js.RUNNING)
+
+        sacct_out = "300|COMPLETED\n301|CANCELLED by 5\n302_0|COMPLETED\n302_1|TIMEOUT\n"
+        states = js.parse_slurm_states(sacct_out, '|')
+        self.assertEqual(states['300'], js.DONE)
+        self.assertEqual(states['301'], js.CANCELED)
+        self.assertEqual(states['302'], js.FAILED)
+
+    def test_job_is_queued(self):
+        print "\n***** Testing checking submitted jobs against the cached queue *****\n"
+        calls = []
+
+        def queue_states(scheduler, host, user):
+            calls.append(host)
+            return js.parse_slurm_states("100,RUNNING\n101_2,PENDING\n", ',')
+
+        slurm_queue_states = js.slurm_queue_states
+        js.slurm_queue_states = queue_states
+        js.queue_cache.clear()
+        try:
+            self.assertTrue(js.job_is_queued('[slurm://localhost]-[100]'))
+            self.assertTrue(js.job_is_queued('[slurm://localhost]-[101_2]'))
+            self.assertFalse(js.job_is_queued('[slurm://localhost]-[102]'))
+            # the queue is read once for all the checks
+            self.assertEqual(calls, ['localhost'])
+            js.job_is_queued('[slurm://localhost]-[100]', max_age=-1)
+            self.assertEqual(calls, ['localhost', 'localhost'])
+
+            # jobs are not reported as finished when the controller cannot be reached
+            js.slurm_queue_states = lambda scheduler, host, user: None
+            js.queue_cache.clear()
+            self.assertTrue(js.job_is_queued('[slurm://localhost]-[102]'))
+        finally:
+            js.slurm_queue_states = slurm_queue_states
+            js.queue_cache.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
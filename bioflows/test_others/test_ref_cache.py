@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bioflows.bioflowsutils import ref_cache
+
+
+class TestRefCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.fasta = os.path.join(self.tmp_dir, 'genome.fa')
+        f = open(self.fasta, 'w')
+        f.write(">chr1\nACGT\n")
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_key(self):
+        print "\n***** Testing the keys of the reference cache *****\n"
+        versions = {'bwa': 'Version: 0.7.17-r1188'}
+        key = ref_cache.index_key('bwa', {'fasta': self.fasta}, versions, self.cache_dir)
+        self.assertTrue(key.startswith('genome-'))
+        self.assertEqual(key, ref_cache.index_key('bwa', {'fasta': self.fasta}, versions, self.cache_dir))
+        # a new tool version or a changed source gives a new entry
+        self.assertNotEqual(key, ref_cache.index_key('bwa', {'fasta': self.fasta}, {'bwa': 'Version: 0.7.18'},
+                                                     self.cache_dir))
+        f = open(self.fasta, 'a')
+        f.write(">chr2\nTTTT\n")
+        f.close()
+        self.assertNotEqual(key, ref_cache.index_key('bwa', {'fasta': self.fasta}, versions, self.cache_dir))
+
+    def test_publish(self):
+        print "\n***** Testing publication of reference cache entries *****\n"
+        builds = []
+
+        def build(build_dir):
+            builds.append(build_dir)
+            open(os.path.join(build_dir, 'genome.fa.bwt'), 'w').close()
+
+        entry = ref_cache.publish(self.cache_dir, 'bwa', 'genome-0000', build)
+        self.assertTrue(os.path.exists(os.path.join(entry, 'genome.fa.bwt')))
+        self.assertTrue(os.path.exists(os.path.join(entry, 'BUILD_INFO.json')))
+        self.assertEqual(ref_cache.publish(self.cache_dir, 'bwa', 'genome-0000', build), entry)
+        self.assertEqual(len(builds), 1)
+
+    def test_failed_build(self):
+        print "\n***** Testing a failed build of a reference cache entry *****\n"
+
+        def build(build_dir):
+            open(os.path.join(build_dir, 'genome.fa.bwt'), 'w').close()
+            raise RuntimeError("bwa index failed")
+
+        self.assertRaises(RuntimeError, ref_cache.publish, self.cache_dir, 'bwa', 'genome-0000', build)
+        # nothing is left that could be taken for the index
+        self.assertEqual([x for x in os.listdir(os.path.join(self.cache_dir, 'bwa')) if not x.endswith('.lock')],
+                         [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from bioflows.bioflowsutils import shm_index
+
+
+class RecordingIndex(shm_index.SharedIndex):
+    """
+    Shared index that records the loads and unloads instead of running the aligner
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingIndex, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def load(self):
+        self.calls.append('load')
+        return True
+
+    def unload(self):
+        self.calls.append('unload')
+        return
+
+
+class TestSharedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shm_dir = shm_index.SHM_DIR
+        shm_index.SHM_DIR = self.tmp_dir
+        self.shared = RecordingIndex('bwa', '/ref/genome.fa')
+
+    def tearDown(self):
+        shm_index.SHM_DIR = self.shm_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def state(self):
+        return json.load(open(self.shared.state_file))
+
+    def dead_pid(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        return proc.pid
+
+    def test_acquire_release(self):
+        print "\n***** Testing acquiring and releasing a shared index *****\n"
+        self.assertTrue(self.shared.state_file.startswith(self.tmp_dir))
+        self.shared.acquire(os.getpid())
+        self.shared.acquire(os.getppid())
+        # the index is only loaded by the first user
+        self.assertEqual(self.shared.calls, ['load'])
+        self.assertEqual(self.state()['loaded'], ['/ref/genome.fa'])
+        self.assertEqual(sorted(self.state()['owners']), sorted([os.getpid(), os.getppid()]))
+
+        self.shared.release(os.getppid())
+        self.assertEqual(self.shared.calls, ['load'])
+        self.assertEqual(self.state()['owners'], [os.getpid()])
+
+    def test_last_owner_unloads(self):
+        print "\n***** Testing unloading a shared index by its last user *****\n"
+        self.shared.acquire(os.getpid())
+        self.shared.release(os.getpid())
+        self.assertEqual(self.shared.calls, ['load', 'unload'])
+        self.assertEqual(self.state(), dict(loaded=[], owners=[], tool='bwa', db_dir=None))
+        # the next user loads it again
+        self.shared.acquire(os.getpid())
+        self.assertEqual(self.shared.calls, ['load', 'unload', 'load'])
+
+    def test_dead_owners_pruned(self):
+        print "\n***** Testing dropping the killed users of a shared index *****\n"
+        self.shared.acquire(self.dead_pid())
+        self.shared.acquire(os.getpid())
+        self.assertEqual(self.state()['owners'], [os.getpid()])
+
+        # a user killed without releasing the index does not keep it loaded
+        self.shared.acquire(self.dead_pid())
+        self.shared.release(os.getpid())
+        self.assertEqual(self.shared.calls, ['load', 'unload'])
+        self.assertEqual(self.state()['owners'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bioflows.bioflowsutils import sra_fastq
+
+
+class TestSraFastq(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fake_convert(self, sra, run_dir, paired_end, threads, temp_dir):
+        # the first run finishes last
+        time.sleep(0.2 if sra == 'SRR1.sra' else 0)
+        fastqs = []
+        for suffix in sra_fastq.read_suffixes(paired_end):
+            fastq = os.path.join(run_dir, sra_fastq.run_name(sra) + suffix + '.fastq.gz')
+            f = gzip.open(fastq, 'wb')
+            f.write("@%s%s\nACGT\n+\nIIII\n" % (sra_fastq.run_name(sra), suffix))
+            f.close()
+            fastqs.append(fastq)
+        return fastqs
+
+    def test_convert_sample(self):
+        print "\n***** Testing the conversion of the SRA runs of a sample *****\n"
+        fastqs = sra_fastq.convert_sample('s1', ['SRR1.sra', 'SRR2.sra', 'SRR3.sra'], self.tmp_dir, paired_end=True,
+                                          threads=8, parallel_runs=3, convert=self.fake_convert)
+        self.assertEqual(fastqs, [os.path.join(self.tmp_dir, 's1_1.fq.gz'), os.path.join(self.tmp_dir, 's1_2.fq.gz')])
+        # the runs are concatenated in the order they are given
+        reads = [x for x in gzip.open(fastqs[1]).read().split('\n') if x.startswith('@')]
+        self.assertEqual(reads, ['@SRR1_2', '@SRR2_2', '@SRR3_2'])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['s1_1.fq.gz', 's1_2.fq.gz'])
+
+    def test_failed_run(self):
+        print "\n***** Testing a failed conversion of an SRA run *****\n"
+
+        def convert(sra, run_dir, paired_end, threads, temp_dir):
+            raise RuntimeError("fasterq-dump failed")
+
+        self.assertRaises(RuntimeError, sra_fastq.convert_sample, 's1', ['SRR1.sra'], self.tmp_dir,
+                          convert=convert)
+        # no partial fastq is left
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
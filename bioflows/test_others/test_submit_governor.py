@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bioflows.bioflowsutils import submit_governor
+
+
+class TestSubmitGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def governor(self, submit_rate):
+        return submit_governor.from_job_parms(dict(saga_scheduler='slurm', submit_rate=submit_rate, submit_burst=2),
+                                              self.tmp_dir)
+
+    def test_rate_limit(self):
+        print "\n***** Testing the rate limit of submissions *****\n"
+        governor = self.governor(0.5)
+        self.assertEqual(governor.try_acquire(2), 0)
+        # the burst is used up, the next job waits for a token
+        self.assertGreater(governor.try_acquire(1), 0)
+
+    def test_no_rate_limit(self):
+        print "\n***** Testing submissions without a rate limit *****\n"
+        governor = self.governor(0)
+        for i in range(5):
+            self.assertEqual(governor.try_acquire(2), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, ".submit_governor")))
+
+
+if __name__ == '__main__':
+    unittest.main()
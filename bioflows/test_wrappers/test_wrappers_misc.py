@@ -1,6 +1,12 @@
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 
 import bioflows.bioflowsutils.wrappers as wr
+import bioflows.bioflowsutils.wrappers_gatk as wr_gatk
+import bioflows.bioflowsutils.wrappers_picard as wr_picard
 import bioflows.bioflowsutils.wrappers_samtools as wr_samtools
 from bioflows.definedworkflows.rnaseq.rnaseqworkflow import GatkFlow as rsw
 
@@ -74,7 +80,10 @@ class TestGsnap(unittest.TestCase):
         print "\n***** Testing Gsnap_wrapper command *****\n"
         print self.gsnap_test.run_command
         print self.gsnap_test.job_parms
-        out_command = "gsnap  -t 16 --gunzip -A sam -N1 --use-shared-memory=0 -d c_elegans_Ws8 "
+        # the read group is named after the sample when the fastq does not exist
+        out_command = "gsnap  -t 16 --gunzip -A sam -N1 --use-shared-memory=0 --read-group-id=test_samp "
+        out_command += "--read-group-name=test_samp --read-group-library=test_samp --read-group-platform=ILLUMINA "
+        out_command += "-d c_elegans_Ws8 "
         out_command += "-s caenorhabditis_elegans.PRJNA13758.WBPS8.canonical_geneset.splicesites.iit "
         out_command += "/gpfs/scratch/fastq/test_samp_1.fq.gz /gpfs/scratch/fastq/test_samp_2.fq.gz 2>>/gpfs/scratch/logs/test_samp_gsnap_err.log "
         out_command += "1>/gpfs/scratch/alignments/test_samp.sam"
@@ -215,11 +224,442 @@ class TestBwaMem(unittest.TestCase):
         print "\n***** Testing Bwa_wrapper command *****\n"
         print self.bwa_test.run_command
         print self.bwa_test.job_parms
-        out_command = "bwa mem  -t 16 index.db /gpfs/scratch/fastq/test_samp_1.fq.gz /gpfs/scratch/fastq/test_samp_2.fq.gz"
+        out_command = "bwa mem  -t 16 -R '@RG\\tID:test_samp\\tSM:test_samp\\tLB:test_samp\\tPL:ILLUMINA\\tPU:test_samp' "
+        out_command += "index.db /gpfs/scratch/fastq/test_samp_1.fq.gz /gpfs/scratch/fastq/test_samp_2.fq.gz"
         out_command += " 2>>/gpfs/scratch/logs/test_samp_bwa_mem_err.log"
         out_command += " 1>/gpfs/scratch/alignments/test_samp.sam"
+        self.assertEqual(self.bwa_test.run_command.split(), out_command.split())
 
 
+class TestStreamedAligners(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+
+    def streamed_kwargs(self, wrapper_name, stream):
+        self.rw1.prog_step_parms[wrapper_name] = {'stream': stream}
+        self.rw1.update_job_parms(wrapper_name)
+        self.rw1.update_prog_suffixes(wrapper_name)
+        return self.rw1.update_step_parms(wrapper_name)
+
+    def test_bwa_stream_bam_wrapper(self):
+        print "\n***** Testing Bwa piped into samtools view *****\n"
+        new_base_kwargs = self.streamed_kwargs('bwa_mem', 'bam')
+        bwa_test = wr.Bwa('bwa_mem', "test_samp", *self.rw1.progs['bwa_mem'], **dict(new_base_kwargs))
+        print bwa_test.run_command
+        out_command = "bwa mem  -t 16 -R '@RG\\tID:test_samp\\tSM:test_samp\\tLB:test_samp\\tPL:ILLUMINA\\tPU:test_samp' "
+        out_command += "index.db /gpfs/scratch/fastq/test_samp_1.fq.gz /gpfs/scratch/fastq/test_samp_2.fq.gz"
+        out_command += " 2>>/gpfs/scratch/logs/test_samp_bwa_mem_err.log"
+        out_command += " | samtools view -@ 16 -b -o /gpfs/scratch/alignments/test_samp.bam -"
+        out_command += " 2>>/gpfs/scratch/logs/test_samp_bwa_mem_err.log"
+        self.assertEqual(bwa_test.run_command.split(), out_command.split())
+        self.assertEqual(bwa_test.produces(), [".bam"])
+
+    def test_gsnap_stream_sorted_bam_wrapper(self):
+        print "\n***** Testing Gsnap piped into samtools sort *****\n"
+        new_base_kwargs = self.streamed_kwargs('gsnap', 'sorted_bam')
+        gsnap_test = wr.Gsnap('gsnap', "test_samp", *self.rw1.progs['gsnap'], **dict(new_base_kwargs))
+        print gsnap_test.run_command
+        # half of the memory of the job is left to the aligner
+        out_command = "gsnap  -t 16 --gunzip -A sam -N1 --use-shared-memory=0 --read-group-id=test_samp "
+        out_command += "--read-group-name=test_samp --read-group-library=test_samp --read-group-platform=ILLUMINA "
+        out_command += "-d c_elegans_Ws8 "
+        out_command += "-s caenorhabditis_elegans.PRJNA13758.WBPS8.canonical_geneset.splicesites.iit "
+        out_command += "/gpfs/scratch/fastq/test_samp_1.fq.gz /gpfs/scratch/fastq/test_samp_2.fq.gz 2>>/gpfs/scratch/logs/test_samp_gsnap_err.log "
+        out_command += "| samtools sort -@ 16 -m 1250M -T ${TMPDIR:-/tmp}/test_samp.srtd.bam.tmp "
+        out_command += "-o /gpfs/scratch/alignments/test_samp.srtd.bam - 2>>/gpfs/scratch/logs/test_samp_gsnap_err.log"
+        self.assertEqual(gsnap_test.run_command.split(), out_command.split())
+        self.assertEqual(gsnap_test.produces(), [".srtd.bam"])
+
+
+class TestSormadup(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+
+    def test_samtools_sormadup_wrapper(self):
+        print "\n***** Testing samtools sormadup wrapper command *****\n"
+        self.wrapper_name = 'samtools_sormadup'
+        self.rw1.update_job_parms(self.wrapper_name)
+        new_base_kwargs = self.rw1.update_prog_suffixes(self.wrapper_name)
+        sormadup_test = wr_samtools.SamTools(self.wrapper_name, "test_samp", *self.rw1.progs[self.wrapper_name],
+                                             **dict(new_base_kwargs))
+        print sormadup_test.run_command
+        out_command = "samtools fixmate -m -u -@ 4 /gpfs/scratch/alignments/test_samp.bam - "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_samtools_sormadup_err.log | "
+        out_command += "samtools sort -u -@ 4 -m 3000M -T ${TMPDIR:-/tmp}/test_samp.dup.srtd.bam.tmp - "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_samtools_sormadup_err.log | "
+        out_command += "samtools markdup -@ 4 -f /gpfs/scratch/qc/test_samp.dup.metrics.txt --write-index - "
+        out_command += "/gpfs/scratch/alignments/test_samp.dup.srtd.bam##idx##/gpfs/scratch/alignments/test_samp.dup.srtd.bam.bai "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_samtools_sormadup_err.log "
+        out_command += "1>/gpfs/scratch/logs/test_samp_samtools_sormadup.log"
+        self.assertEqual(sormadup_test.run_command.split(), out_command.split())
+        self.assertEqual(sormadup_test.produces(), [".dup.srtd.bam", ".dup.srtd.bam.bai"])
+
+    def test_bamsormadup_wrapper(self):
+        print "\n***** Testing bamsormadup wrapper command *****\n"
+        self.wrapper_name = 'bamsormadup'
+        self.rw1.update_job_parms(self.wrapper_name)
+        new_base_kwargs = self.rw1.update_prog_suffixes(self.wrapper_name)
+        bamsormadup_test = wr.Biobambam(self.wrapper_name, "test_samp", **dict(new_base_kwargs))
+        print bamsormadup_test.run_command
+        out_command = "bamsormadup threads=1 inputformat=bam "
+        out_command += "indexfilename=/gpfs/scratch/alignments/test_samp.dup.srtd.bam.bai "
+        out_command += "M=/gpfs/scratch/qc/test_samp.dup.metrics.txt tmpfile=${TMPDIR:-/tmp}/test_samp.dup.srtd.bam.tmp "
+        out_command += "< /gpfs/scratch/alignments/test_samp.bam 2>>/gpfs/scratch/logs/test_samp_bamsormadup_err.log "
+        out_command += "1>/gpfs/scratch/alignments/test_samp.dup.srtd.bam"
+        self.assertEqual(bamsormadup_test.run_command.split(), out_command.split())
+        self.assertEqual(bamsormadup_test.produces(), [".dup.srtd.bam", ".dup.srtd.bam.bai"])
+
+
+class TestScatterAlignment(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+        self.wrapper_name = 'bwa_mem'
+        self.rw1.prog_step_parms[self.wrapper_name] = {'scatter': 2}
+        self.rw1.update_job_parms(self.wrapper_name)
+        self.rw1.update_prog_suffixes(self.wrapper_name)
+        new_base_kwargs = self.rw1.update_step_parms(self.wrapper_name)
+        self.bwa_test = wr.Bwa(self.wrapper_name, "test_samp", *self.rw1.progs[self.wrapper_name],
+                               **dict(new_base_kwargs))
+        self.scatter_test = self.rw1.scatter_step("test_samp", self.wrapper_name, wr.Bwa, self.bwa_test)
+
+    def test_fastq_split_wrapper(self):
+        print "\n***** Testing FastqSplit wrapper command *****\n"
+        self.assertEqual(len(self.scatter_test), 4)
+        split_test = self.scatter_test[0]
+        print split_test.run_command
+        chunks = "/gpfs/scratch/fastq/test_samp_1.shard0000.fq.gz /gpfs/scratch/fastq/test_samp_1.shard0001.fq.gz "
+        chunks += "/gpfs/scratch/fastq/test_samp_2.shard0000.fq.gz /gpfs/scratch/fastq/test_samp_2.shard0001.fq.gz"
+        out_command = "rm -f " + chunks + "; "
+        out_command += "lines=$(( ($(zcat /gpfs/scratch/fastq/test_samp_1.fq.gz | wc -l) / 4 + 1) / 2 * 4 )); "
+        out_command += "[ $lines -gt 0 ] || lines=4; "
+        for read in ["_1", "_2"]:
+            out_command += "zcat /gpfs/scratch/fastq/test_samp" + read + ".fq.gz | "
+            out_command += "split -l $lines -d -a 4 --additional-suffix=.fq.gz --filter='gzip -1 > $FILE' - "
+            out_command += "/gpfs/scratch/fastq/test_samp" + read + ".shard "
+            out_command += "2>>/gpfs/scratch/logs/test_samp_bwa_mem_split_err.log; "
+        out_command += "for f in " + chunks + "; do [ -e $f ] || gzip -c < /dev/null > $f; done"
+        self.assertEqual(split_test.run_command.split(), out_command.split())
+        self.assertEqual(split_test.produces(), [".shard0000.fq.gz", ".shard0001.fq.gz"])
+
+    def test_chunk_alignment_wrapper(self):
+        print "\n***** Testing the alignment of a chunk of reads *****\n"
+        chunk_test = self.scatter_test[2]
+        print chunk_test.run_command
+        # the chunks are sorted as they are aligned
+        self.assertEqual(chunk_test.consumes(), [".shard0001.fq.gz"])
+        self.assertEqual(chunk_test.produces(), [".shard0001.srtd.bam"])
+        self.assertIn("/gpfs/scratch/fastq/test_samp_1.shard0001.fq.gz /gpfs/scratch/fastq/test_samp_2.shard0001.fq.gz",
+                      chunk_test.run_command)
+        self.assertIn("-o /gpfs/scratch/alignments/test_samp.shard0001.srtd.bam -", chunk_test.run_command)
+
+    def test_alignment_merge_wrapper(self):
+        print "\n***** Testing AlignmentMerge wrapper command *****\n"
+        merge_test = self.scatter_test[3]
+        print merge_test.run_command
+        # the sorted chunks are merged into the SAM bwa writes without streaming
+        out_command = "samtools merge -@ 8 -c -p -f -O SAM /gpfs/scratch/alignments/test_samp.sam "
+        out_command += "/gpfs/scratch/alignments/test_samp.shard0000.srtd.bam "
+        out_command += "/gpfs/scratch/alignments/test_samp.shard0001.srtd.bam "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_bwa_mem_merge_err.log "
+        out_command += "1>>/gpfs/scratch/logs/test_samp_bwa_mem_merge_err.log"
+        self.assertEqual(merge_test.run_command.split(), out_command.split())
+        # the merge writes the checkpoint of the aligner, so the steps after it do not change
+        self.assertEqual(merge_test.luigi_target, self.bwa_test.luigi_target)
+        self.assertEqual(merge_test.consumes(), [".shard0000.srtd.bam", ".shard0001.srtd.bam"])
+
+
+class TestFeatureCountsBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+        self.wrapper_name = 'featureCounts'
+        self.rw1.update_job_parms(self.wrapper_name)
+        new_base_kwargs = self.rw1.update_prog_suffixes(self.wrapper_name)
+        self.members = [wr.FeatureCounts(self.wrapper_name, x, *self.rw1.progs[self.wrapper_name],
+                                         **dict(new_base_kwargs)) for x in ["test_samp", "test_samp2"]]
+        self.batch_test = wr.FeatureCountsBatch("test_cohort", 0, self.members, **dict(self.rw1.base_kwargs))
+
+    def test_feature_counts_batch_wrapper(self):
+        print "\n***** Testing FeatureCountsBatch wrapper command *****\n"
+        print self.batch_test.run_command
+        batch_counts = "/gpfs/scratch/expression/test_cohort_featureCounts_batch0000.featureCounts.txt"
+        out_command = "featureCounts -p -M --fracOverlap 80 -O -s 1 -T 1 "
+        out_command += "-a /gpfs/scratch/aragaven/lapierre/caenorhabditis_elegans.PRJNA13758.WBPS8.canonical_geneset.gtf "
+        out_command += "-o " + batch_counts + " "
+        out_command += "/gpfs/scratch/alignments/test_samp.dup.srtd.bam /gpfs/scratch/alignments/test_samp2.dup.srtd.bam "
+        out_command += "2>>/gpfs/scratch/logs/test_cohort_featureCounts_batch0000_err.log "
+        out_command += "1>/gpfs/scratch/logs/test_cohort_featureCounts_batch0000.log"
+        # the counts of each BAM are split back into the files of its sample, then its checkpoint is written
+        for i, prog in enumerate(self.members):
+            out_command += "; { head -n 1 %s; tail -n +2 %s | cut -f1-6,%d; } > %s" % (
+                batch_counts, batch_counts, 7 + i, prog.counts_file)
+            out_command += "; cut -f1,%d %s.summary > %s.summary" % (2 + i, batch_counts, prog.counts_file)
+            out_command += "; echo 'DONE' > " + prog.luigi_target
+        self.assertEqual(self.batch_test.run_command.split(), out_command.split())
+        self.assertEqual(self.members[1].counts_file, "/gpfs/scratch/expression/test_samp2.featureCounts.txt")
+
+
+class TestIntermediateCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+        # bwa writes test_samp.bam, read by sormadup, whose test_samp.dup.srtd.bam is read by featureCounts
+        self.rw1.prog_step_parms['bwa_mem'] = {'stream': 'bam'}
+        self.wrappers = []
+        for wrapper_name, wrapper in [('bwa_mem', wr.Bwa), ('samtools_sormadup', wr_samtools.SamTools),
+                                      ('featureCounts', wr.FeatureCounts)]:
+            self.rw1.update_job_parms(wrapper_name)
+            self.rw1.update_prog_suffixes(wrapper_name)
+            new_base_kwargs = self.rw1.update_step_parms(wrapper_name)
+            self.wrappers.append(wrapper(wrapper_name, "test_samp", *self.rw1.progs[wrapper_name],
+                                         **dict(new_base_kwargs)))
+
+    def test_intermediate_cleanup(self):
+        print "\n***** Testing the removal of intermediate files *****\n"
+        self.rw1.run_parms['cleanup_intermediates'] = True
+        self.rw1.intermediate_cleanup(self.wrappers)
+        for prog in self.wrappers:
+            print prog.prog_id, prog.cleanup_command
+        self.assertIsNone(self.wrappers[0].cleanup_command)
+        # the BAM of the aligner is removed once sormadup, its only reader, has written its checkpoint
+        cleanup = self.wrappers[1].cleanup_command
+        self.assertTrue(cleanup.startswith("if [ -e " + self.wrappers[1].luigi_target + " ]; then rm -f "))
+        self.assertIn(" /gpfs/scratch/alignments/test_samp.bam ", cleanup)
+        self.assertNotIn("/gpfs/scratch/alignments/test_samp.dup.srtd.bam", cleanup)
+        # the BAM of sormadup is removed with its index
+        cleanup = self.wrappers[2].cleanup_command
+        self.assertTrue(cleanup.startswith("if [ -e " + self.wrappers[2].luigi_target + " ]; then rm -f "))
+        self.assertIn(" /gpfs/scratch/alignments/test_samp.dup.srtd.bam ", cleanup)
+        self.assertIn(" /gpfs/scratch/alignments/test_samp.dup.srtd.bam.bai ", cleanup)
+
+    def test_intermediate_cleanup_keep(self):
+        print "\n***** Testing keeping intermediate files *****\n"
+        self.rw1.run_parms['cleanup_intermediates'] = {'keep': ['*.dup.srtd.bam']}
+        self.rw1.intermediate_cleanup(self.wrappers)
+        self.assertIn(" /gpfs/scratch/alignments/test_samp.bam ", self.wrappers[1].cleanup_command)
+        self.assertIsNone(self.wrappers[2].cleanup_command)
+
+    def test_no_intermediate_cleanup(self):
+        print "\n***** Testing keeping all the files by default *****\n"
+        self.rw1.intermediate_cleanup(self.wrappers)
+        self.assertEqual([x.cleanup_command for x in self.wrappers], [None, None, None])
+
+
+class TestCram(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+
+    def cram_kwargs(self, wrapper_name, cram_suffixes):
+        self.rw1.update_job_parms(wrapper_name)
+        self.rw1.update_prog_suffixes(wrapper_name)
+        new_base_kwargs = self.rw1.update_step_parms(wrapper_name)
+        # worked out by the workflow from the steps writing and reading each BAM with `alignment_format: cram`
+        new_base_kwargs['cram_suffixes'] = cram_suffixes
+        return new_base_kwargs
+
+    def test_samtools_sort_cram_wrapper(self):
+        print "\n***** Testing samtools sort writing CRAM *****\n"
+        self.wrapper_name = 'samtools_sort'
+        new_base_kwargs = self.cram_kwargs(self.wrapper_name, ['.tst.srtd.bam'])
+        sort_test = wr_samtools.SamTools(self.wrapper_name, "test_samp", *self.rw1.progs[self.wrapper_name],
+                                         **dict(new_base_kwargs))
+        print sort_test.run_command
+        out_command = "samtools sort -@ 3 -m 10000M -T /tmp/scratch/tmp__test_samp "
+        out_command += "--reference /gpfs/scratch/test.fa -O cram -o /gpfs/scratch/alignments/test_samp.tst.srtd.cram "
+        out_command += "/gpfs/scratch/alignments/test_samp.mapped.bam 2>>/gpfs/scratch/logs/test_samp_samtools_sort_err.log "
+        out_command += "1>/gpfs/scratch/logs/test_samp_samtools_sort.log"
+        self.assertEqual(sort_test.run_command.split(), out_command.split())
+        self.assertEqual(sort_test.produces(), [".tst.srtd.cram"])
+
+    def test_samtools_sormadup_cram_wrapper(self):
+        print "\n***** Testing samtools sormadup writing CRAM *****\n"
+        self.wrapper_name = 'samtools_sormadup'
+        new_base_kwargs = self.cram_kwargs(self.wrapper_name, ['.dup.srtd.bam'])
+        sormadup_test = wr_samtools.SamTools(self.wrapper_name, "test_samp", *self.rw1.progs[self.wrapper_name],
+                                             **dict(new_base_kwargs))
+        print sormadup_test.run_command
+        out_command = "samtools fixmate -m -u -@ 4 /gpfs/scratch/alignments/test_samp.bam - "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_samtools_sormadup_err.log | "
+        out_command += "samtools sort -u -@ 4 -m 3000M -T ${TMPDIR:-/tmp}/test_samp.dup.srtd.cram.tmp - "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_samtools_sormadup_err.log | "
+        out_command += "samtools markdup -@ 4 --reference /gpfs/scratch/test.fa -O cram "
+        out_command += "-f /gpfs/scratch/qc/test_samp.dup.metrics.txt --write-index - "
+        out_command += "/gpfs/scratch/alignments/test_samp.dup.srtd.cram##idx##/gpfs/scratch/alignments/test_samp.dup.srtd.cram.crai "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_samtools_sormadup_err.log "
+        out_command += "1>/gpfs/scratch/logs/test_samp_samtools_sormadup.log"
+        self.assertEqual(sormadup_test.run_command.split(), out_command.split())
+        self.assertEqual(sormadup_test.produces(), [".dup.srtd.cram", ".dup.srtd.cram.crai"])
+
+    def test_markduplicates_cram_wrapper(self):
+        print "\n***** Testing picard MarkDuplicates writing CRAM *****\n"
+        self.wrapper_name = 'picard_MarkDuplicates'
+        new_base_kwargs = self.cram_kwargs(self.wrapper_name, ['.picdup.rg.srtd.bam'])
+        markdup_test = wr_picard.Picard(self.wrapper_name, "test_samp", *self.rw1.progs[self.wrapper_name],
+                                        **dict(new_base_kwargs))
+        print markdup_test.run_command
+        # picard does not index CRAM, the index is written by samtools
+        out_command = "picard MarkDuplicates -Xmx10000M INPUT=/gpfs/scratch/alignments/test_samp.rg.srtd.bam "
+        out_command += "M=/gpfs/scratch/qc/test_samp_mark_duplicates_picard.txt CREATE_INDEX=false "
+        out_command += "VALIDATION_STRINGENCY=LENIENT TMP_DIR=${TMPDIR:-/tmp} "
+        out_command += "OUTPUT=/gpfs/scratch/alignments/test_samp.picdup.rg.srtd.cram REFERENCE_SEQUENCE=/gpfs/scratch/test.fa "
+        out_command += "2>>/gpfs/scratch/logs/test_samp_picard_MarkDuplicates_err.log "
+        out_command += "1>>/gpfs/scratch/logs/test_samp_picard_MarkDuplicates_err.log; "
+        out_command += "samtools index /gpfs/scratch/alignments/test_samp.picdup.rg.srtd.cram"
+        self.assertEqual(markdup_test.run_command.split(), out_command.split())
+        self.assertEqual(markdup_test.produces(), [".picdup.rg.srtd.cram", ".picdup.rg.srtd.cram.crai"])
+
+    def test_bwa_stream_cram_wrapper(self):
+        print "\n***** Testing Bwa piped into samtools sort writing CRAM *****\n"
+        self.wrapper_name = 'bwa_mem'
+        self.rw1.prog_step_parms[self.wrapper_name] = {'stream': 'sorted_bam'}
+        new_base_kwargs = self.cram_kwargs(self.wrapper_name, ['.srtd.bam'])
+        bwa_test = wr.Bwa(self.wrapper_name, "test_samp", *self.rw1.progs[self.wrapper_name], **dict(new_base_kwargs))
+        print bwa_test.run_command
+        out_command = "bwa mem  -t 16 -R '@RG\\tID:test_samp\\tSM:test_samp\\tLB:test_samp\\tPL:ILLUMINA\\tPU:test_samp' "
+        out_command += "index.db /gpfs/scratch/fastq/test_samp_1.fq.gz /gpfs/scratch/fastq/test_samp_2.fq.gz"
+        out_command += " 2>>/gpfs/scratch/logs/test_samp_bwa_mem_err.log"
+        out_command += " | samtools sort -@ 16 -m 100M -T ${TMPDIR:-/tmp}/test_samp.srtd.cram.tmp"
+        out_command += " --reference /gpfs/scratch/test.fa -O cram -o /gpfs/scratch/alignments/test_samp.srtd.cram -"
+        out_command += " 2>>/gpfs/scratch/logs/test_samp_bwa_mem_err.log"
+        self.assertEqual(bwa_test.run_command.split(), out_command.split())
+        self.assertTrue(bwa_test.writes_cram())
+
+
+class TestPicardMultipleMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+
+    def metric_wrappers(self):
+        wrappers = []
+        for wrapper_name in ['picard_CollectAlignmentSummaryMetrics', 'picard_CollectInsertSizeMetrics']:
+            self.rw1.update_job_parms(wrapper_name)
+            self.rw1.update_prog_suffixes(wrapper_name)
+            new_base_kwargs = self.rw1.update_step_parms(wrapper_name)
+            wrappers.append(wr_picard.Picard(wrapper_name, "test_samp", *self.rw1.progs[wrapper_name],
+                                             **dict(new_base_kwargs)))
+        return wrappers
+
+    def test_fused_metrics_wrapper(self):
+        print "\n***** Testing the fused Picard metrics command *****\n"
+        self.rw1.prog_step_parms['picard_CollectAlignmentSummaryMetrics'] = {'stage': True}
+        metrics = self.metric_wrappers()
+        fused = self.rw1.fuse_picard_metrics("test_samp", metrics)
+        self.assertEqual(len(fused), 1)
+        fused_test = fused[0]
+        print fused_test.run_command
+        # the fused step keeps the settings of the first metric step, here staging its BAM to the local disk
+        self.assertEqual(fused_test.step_parms, {'stage': True})
+        self.assertEqual(fused_test.job_parms['mem'], 12000)
+        out_command = "picard CollectMultipleMetrics -Xmx12000M "
+        out_command += "INPUT=${TMPDIR:-/tmp}/bioflows_test_samp_picard_CollectMultipleMetrics_$$/test_samp.rg.srtd.bam "
+        out_command += "OUTPUT=/gpfs/scratch/qc/test_samp_picard_CollectMultipleMetrics "
+        out_command += "REFERENCE_SEQUENCE=/gpfs/scratch/test.fa VALIDATION_STRINGENCY=LENIENT PROGRAM=null "
+        out_command += "PROGRAM=CollectAlignmentSummaryMetrics PROGRAM=CollectInsertSizeMetrics "
+        self.assertIn(' '.join(out_command.split()), ' '.join(fused_test.run_command.split()))
+        for prog in metrics:
+            self.assertIn("echo 'DONE' > " + prog.luigi_target, fused_test.run_command)
+
+    def test_fused_metrics_without_reference(self):
+        print "\n***** Testing the fused Picard metrics without a reference *****\n"
+        metrics = self.metric_wrappers()
+        metrics[0].prog_args['ref_fasta_path'] = None
+        self.assertRaises(SystemExit, self.rw1.fuse_picard_metrics, "test_samp", metrics)
+
+
+class TestGatkCohort(unittest.TestCase):
+
+    def setUp(self):
+        self.parmsfile = "test_wrappers_pe.yaml"
+        self.rw1 = rsw(self.parmsfile)
+        self.rw1.set_base_kwargs()
+        self.rw1.parse_prog_info()
+        self.kwargs = dict(self.rw1.base_kwargs)
+        self.kwargs['interval'] = "/gpfs/scratch/shard0000.intervals"
+
+    def genotype_gvcfs(self, tool):
+        return wr_gatk.GatkCohort(tool + "_GenotypeGVCFs", "test_cohort", "shard0000",
+                                  ["/gpfs/scratch/test_cohort.g.vcf.gz"], "/gpfs/scratch/test_cohort.shard0000.vcf.gz",
+                                  **self.kwargs)
+
+    def test_gatk4_genotype_gvcfs_wrapper(self):
+        print "\n***** Testing GenotypeGVCFs of an interval shard *****\n"
+        genotype_test = self.genotype_gvcfs("gatk4")
+        print genotype_test.run_command
+        # the variants spanning the end of the shard are written by the next shard only
+        out_command = 'gatk4 --java-options "-Xmx3000M" GenotypeGVCFs -R /gpfs/scratch/test.fa '
+        out_command += "-L /gpfs/scratch/shard0000.intervals --only-output-calls-starting-in-intervals "
+        out_command += "-V /gpfs/scratch/test_cohort.g.vcf.gz -O /gpfs/scratch/test_cohort.shard0000.vcf.gz "
+        out_command += "2>>/gpfs/scratch/logs/test_cohort_gatk4_GenotypeGVCFs_shard0000_err.log "
+        out_command += "1>/gpfs/scratch/logs/test_cohort_gatk4_GenotypeGVCFs_shard0000.log"
+        self.assertEqual(genotype_test.run_command.split(), out_command.split())
+
+    def test_gatk3_genotype_gvcfs_wrapper(self):
+        print "\n***** Testing GATK3 GenotypeGVCFs of a whole contig shard *****\n"
+        genotype_test = self.genotype_gvcfs("gatk")
+        print genotype_test.run_command
+        self.assertNotIn("--only-output-calls-starting-in-intervals", genotype_test.run_command)
+
+
+class TestReadGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_fastq(self, header):
+        fastq = os.path.join(self.tmp_dir, "test_samp.fq.gz")
+        f = gzip.open(fastq, 'w')
+        f.write(header + "\nACGT\n+\nIIII\n")
+        f.close()
+        return fastq
+
+    def test_casava_read_group(self):
+        print "\n***** Testing read groups from Casava 1.8 read names *****\n"
+        fastq = self.write_fastq("@A00123:8:HXXYYDSXX:2:1101:1000:1000 1:N:0:ACGTACGT")
+        read_group = wr.fastq_read_group("test_samp", fastq)
+        self.assertEqual(read_group['ID'], "HXXYYDSXX.2.test_samp")
+        self.assertEqual(read_group['PU'], "HXXYYDSXX.2.ACGTACGT")
+        self.assertEqual(read_group['SM'], "test_samp")
+
+    def test_old_illumina_read_group(self):
+        print "\n***** Testing read groups from older Illumina read names *****\n"
+        fastq = self.write_fastq("@HWUSI-EAS100R:6:73:941:1973#ATCACG/1")
+        read_group = wr.fastq_read_group("test_samp", fastq, "lib1")
+        self.assertEqual(read_group['PU'], "HWUSI-EAS100R.6.ATCACG")
+        self.assertEqual(read_group['LB'], "lib1")
+
+    def test_missing_fastq_read_group(self):
+        print "\n***** Testing read groups without a fastq *****\n"
+        read_group = wr.fastq_read_group("test_samp", os.path.join(self.tmp_dir, "missing.fq.gz"))
+        self.assertEqual(read_group['ID'], "test_samp")
 
 
 class TestTrimmomaticPE(unittest.TestCase):
@@ -15,7 +15,11 @@ setup(
     entry_points={
         'console_scripts': ['bioflows-run = bioflows.definedworkflows.rnaseq.rnaseqworkflow:gatk_main',
                             'bioflows-dnaseq = bioflows.definedworkflows.rnaseq.rnaseqworkflow:dna_seq_main',
-                            'bioflows-gatk = bioflows.definedworkflows.rnaseq.rnaseqworkflow:gatk_main'],
+                            'bioflows-gatk = bioflows.definedworkflows.rnaseq.rnaseqworkflow:gatk_main',
+                            'bioflows-count-matrix = bioflows.bioflowsutils.count_matrix:main',
+                            'bioflows-shm-index = bioflows.bioflowsutils.shm_index:main',
+                            'bioflows-ref-cache = bioflows.bioflowsutils.ref_cache:main',
+                            'bioflows-sra-fastq = bioflows.bioflowsutils.sra_fastq:main'],
     },
     include_package_data=True,
 )